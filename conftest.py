@@ -0,0 +1,112 @@
+"""pytest configuration of the benchmark suite
+
+The benchmarks in defector/test/test_benchmark.py only run with --benchmark. Their frames per
+second are printed after the tests, can be saved as a baseline with --benchmark-save, and can be
+compared to a saved baseline with --benchmark-compare. A benchmark fails if it's more than
+--benchmark-tolerance slower than its baseline.
+"""
+
+import json
+import platform
+from time import perf_counter
+
+import pytest
+
+RESULTS = {}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--benchmark', action='store_true', help='Run the benchmarks')
+    group.addoption('--benchmark-rounds', type=int, default=5, help='Rounds per benchmark, the fastest is used. Default: 5')
+    group.addoption('--benchmark-save', metavar='PATH', help='Save the results as a JSON baseline')
+    group.addoption('--benchmark-compare', metavar='PATH', help='Compare the results to a JSON baseline')
+    group.addoption('--benchmark-tolerance', type=float, default=0.25, help='Allowed slowdown compared to the baseline. Default: 0.25')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: Benchmark, only run with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+
+    skip = pytest.mark.skip(reason='Benchmarks only run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+class Benchmark:
+    """Times a function processing a number of frames"""
+
+    def __init__(self, name, rounds, baseline=None, tolerance=0.25):
+        self.name = name
+        self.rounds = rounds
+        self.baseline = baseline
+        self.tolerance = tolerance
+
+    def __call__(self, func, frames, setup=None):
+        """Time func, and fail if it's slower than the baseline
+
+        Args:
+            func: The function to time. Gets the result of setup as argument, if given
+            frames: The number of frames func processes
+            setup: Function run before every round, outside the timing
+
+        Returns:
+            fps: The frames per second of the fastest round
+        """
+        best = float('inf')
+        for _ in range(self.rounds):
+            args = (setup(), ) if setup is not None else ()
+            start = perf_counter()
+            func(*args)
+            best = min(best, perf_counter() - start)
+
+        fps = frames / best
+        RESULTS.setdefault(self.name, {}).update({'fps': fps, 'frames': frames, 'seconds': best})
+
+        if self.baseline is not None:
+            RESULTS[self.name]['baseline_fps'] = self.baseline
+            assert fps >= self.baseline * (1 - self.tolerance), f"{self.name} ran at {fps:.1f} fps, the baseline is {self.baseline:.1f} fps"
+
+        return fps
+
+    def note(self, **values):
+        """Record other measurements of the benchmark, like memory. Printed after the fps"""
+        RESULTS.setdefault(self.name, {}).setdefault('notes', {}).update(values)
+
+
+@pytest.fixture
+def bench(request):
+    config = request.config
+    name = request.node.name
+
+    baseline = None
+    if config.getoption('--benchmark-compare'):
+        with open(config.getoption('--benchmark-compare')) as baseline_file:
+            baseline = json.load(baseline_file)['results'].get(name, {}).get('fps')
+
+    return Benchmark(name, config.getoption('--benchmark-rounds'), baseline, config.getoption('--benchmark-tolerance'))
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not RESULTS:
+        return
+
+    terminalreporter.section('benchmarks')
+    terminalreporter.write_line(f"{'benchmark':<60} {'fps':>10} {'baseline':>10} {'change':>8}")
+    for name, result in RESULTS.items():
+        line = f"{name:<60} {result['fps']:>10.1f}"
+        if 'baseline_fps' in result:
+            line += f" {result['baseline_fps']:>10.1f} {result['fps'] / result['baseline_fps'] - 1:>+8.0%}"
+        if 'notes' in result:
+            line += '  ' + ' '.join(f'{key}={value:.4g}' for key, value in result['notes'].items())
+        terminalreporter.write_line(line)
+
+    if config.getoption('--benchmark-save'):
+        with open(config.getoption('--benchmark-save'), 'w') as baseline_file:
+            json.dump({'machine': platform.node(), 'processor': platform.processor(), 'python': platform.python_version(), 'results': RESULTS}, baseline_file, indent=1)
+        terminalreporter.write_line(f"Saved the results to {config.getoption('--benchmark-save')}")
@@ -3,7 +3,7 @@
 """
 
 from pathlib import Path
-from argparse import ArgumentError
+from argparse import ArgumentTypeError
 
 
 def dir_path(path):
@@ -13,9 +13,46 @@ def dir_path(path):
         path (str): A string to test if it's a path
 
     Returns:
-        path (Path): A Path() object with the path when path is a dir, False otherwise
+        path (Path): A Path() object with the path
+
+    Raises:
+        ArgumentTypeError: If path isn't a directory, shown as a usage error by argparse
     """
     if Path(path).is_dir():
         return Path(path)
     else:
-        raise ArgumentError(f'{path} is not a directory')
+        raise ArgumentTypeError(f'{path} is not a directory')
+
+
+def sequence_path(path):
+    """Tests if the given path is a directory or a sequence file
+
+    Args:
+        path (str): A string to test
+
+    Returns:
+        path (Path): A Path() object with the path
+
+    Raises:
+        ArgumentTypeError: If path isn't a directory or a file, shown as a usage error by argparse
+    """
+    if Path(path).is_dir() or Path(path).is_file():
+        return Path(path)
+    else:
+        raise ArgumentTypeError(f'{path} is not a directory or a sequence file')
+
+
+def pattern_size(value):
+    """Parses a checkerboard pattern size like 9x6
+
+    Args:
+        value (str): Columns and rows of inner corners, separated by an x
+
+    Returns:
+        (columns, rows) tuple of ints
+    """
+    try:
+        columns, rows = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise ArgumentTypeError(f'{value} is not a pattern size like 9x6')
+    return columns, rows
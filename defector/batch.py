@@ -0,0 +1,164 @@
+"""Runs the detection and tracking pipeline on many sequences in parallel
+
+Every sequence is processed by a single worker process, with its own ROI transform,
+stationary filter and tracker. The summary of every sequence is appended to a JSON Lines
+results file as soon as it's done, so an interrupted batch can be resumed by running it
+again with the same results file.
+"""
+
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from time import perf_counter
+
+from defector.helpers import RoiCache, roi_sidecar_path
+from defector.pipeline import SequenceTracker, detect_sequence, open_input, skip_last_frames
+from defector.profiling import profiler
+from defector.sequence import close_sequence_file, is_sequence_file
+
+
+def find_sequences(patterns):
+    """Expand a list of sequence paths and glob patterns
+
+    Args:
+        patterns: Sequence directories, sequence files or glob patterns matching them. Files
+            matched by a pattern that aren't sequence files, like ROI sidecars, are skipped
+
+    Returns:
+        List of the resolved sequence paths, sorted and without duplicates
+    """
+    sequences = set()
+    for pattern in patterns:
+        if glob.has_magic(str(pattern)):
+            matches = [match for match in glob.glob(str(pattern)) if Path(match).is_dir() or is_sequence_file(match)]
+        else:
+            matches = [pattern]
+        sequences.update(Path(match).resolve() for match in matches if Path(match).exists())
+    return sorted(sequences)
+
+
+def read_results(path):
+    """Get the summaries in a results file
+
+    Lines that can't be parsed, like a line cut off by a crash, are skipped.
+
+    Returns:
+        Dict of the summaries by sequence path
+    """
+    results = {}
+    if not Path(path).is_file():
+        return results
+
+    with open(path) as results_file:
+        for line in results_file:
+            try:
+                summary = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[summary['sequence']] = summary
+    return results
+
+
+def summarize_sequence(path, roi=True, distance=1, threads=2, min_detections=5, profile=False, roi_file=None, roi_sidecar=False, calibration=None, detector=None):
+    """Run the pipeline on a sequence and summarize the result
+
+    Args:
+        path: A sequence directory or sequence file
+        roi: Cut the vial out of every frame
+        distance: The number of frames at the end of the sequence to skip, see skip_last_frames()
+        threads: The number of decoding threads
+        min_detections: The number of frames a track has to be detected in to count as a particle
+        profile: Add the summary of the stage times and counts of the frames, see Profiler.summary()
+        roi_file: File to reuse the ROI transform from while it matches the frames, see RoiCache
+        roi_sidecar: Reuse the ROI transform saved next to the sequence. Ignored with roi_file
+        calibration: The CameraCalibration to undistort the frames with, or None
+        detector: The ContourDetector or MotionDetector to use. Default: The shared ContourDetector with the default arguments
+
+    Returns:
+        summary (dict): The frame, track, particle and contour counts, if the ROI transform was
+            reused, and the timings in seconds
+    """
+    profiler.enable(profile)
+    profiler.reset()
+
+    start = perf_counter()
+    summary = {'sequence': str(path)}
+    if roi and (roi_file or roi_sidecar or calibration):
+        roi = RoiCache(roi_file or (roi_sidecar_path(path) if roi_sidecar else None), calibration=calibration)
+    try:
+        frames, read = open_input(path)
+        detections = iter(detect_sequence(skip_last_frames(frames, distance, detector), roi, threads=threads, read=read, detector=detector))
+        sequence_tracker = SequenceTracker()
+
+        detect_time = track_time = 0
+        while True:
+            detect_start = perf_counter()
+            frame_detections = next(detections, None)
+            track_start = perf_counter()
+            detect_time += track_start - detect_start
+            if frame_detections is None:
+                break
+
+            sequence_tracker.update(frame_detections)
+            track_time += perf_counter() - track_start
+    except Exception as e:
+        summary['error'] = f'{type(e).__name__}: {e}'
+        return summary
+    finally:
+        close_sequence_file(path)
+
+    summary.update({
+        'frames': sequence_tracker.frames,
+        'tracks': sequence_tracker.tracks_started,
+        'particles': sequence_tracker.particles(min_detections),
+        'moving': sequence_tracker.moving,
+        'stationary': sequence_tracker.stationary,
+        'roi_reused': isinstance(roi, RoiCache) and not roi.found,
+        'detect_time': detect_time,
+        'track_time': track_time,
+        'total_time': perf_counter() - start,
+    })
+    if profile:
+        summary['profile'] = profiler.summary()
+    return summary
+
+
+def run_batch(sequences, results_path, workers=None, **options):
+    """Summarize every sequence that isn't in the results file yet, in parallel
+
+    Summaries are appended to the results file as the sequences finish. Sequences that
+    failed are tried again when the batch is resumed.
+
+    Args:
+        sequences: The sequence paths
+        results_path: The JSON Lines results file
+        workers: The number of worker processes. Default: The number of CPUs
+        options: Keyword arguments for summarize_sequence()
+
+    Returns:
+        Generator of the summaries of the processed sequences, in the order they finish
+    """
+    done = {sequence for sequence, summary in read_results(results_path).items() if 'error' not in summary}
+    todo = [str(sequence) for sequence in sequences if str(sequence) not in done]
+    if not todo:
+        return
+
+    # Finish a line cut off by a crash, so it doesn't swallow the next summary
+    if Path(results_path).is_file():
+        with open(results_path, 'rb+') as results_file:
+            size = results_file.seek(0, os.SEEK_END)
+            if size:
+                results_file.seek(size - 1)
+                if results_file.read(1) != b'\n':
+                    results_file.write(b'\n')
+
+    with ProcessPoolExecutor(workers) as executor, open(results_path, 'a') as results_file:
+        futures = [executor.submit(summarize_sequence, sequence, **options) for sequence in todo]
+        for future in as_completed(futures):
+            summary = future.result()
+            results_file.write(json.dumps(summary) + '\n')
+            results_file.flush()
+            os.fsync(results_file.fileno())
+            yield summary
@@ -0,0 +1,161 @@
+"""Checkerboard calibration of the camera lens
+
+A CameraCalibration holds the camera matrix and distortion coefficients found by
+cv2.calibrateCamera from images of a checkerboard. RoiTransform folds the undistortion
+into its remap tables, so the frames of a calibrated camera are undistorted, straightened
+and cropped in a single pass.
+"""
+
+import json
+
+import cv2
+import numpy as np
+
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+
+def find_checkerboard(image, pattern_size):
+    """Find the inner corners of a checkerboard
+
+    Args:
+        image: A BGR or gray image of the checkerboard
+        pattern_size: (columns, rows) of inner corners
+
+    Returns:
+        (N, 1, 2) float32 array of the corners, refined to subpixel accuracy, or None if the
+        board wasn't found
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    found, corners = cv2.findChessboardCorners(gray, pattern_size, cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE)
+    if not found:
+        return None
+
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), SUBPIX_CRITERIA).reshape(-1, 1, 2)
+
+
+def board_points(pattern_size, square_size=1.0):
+    """Get the coordinates of the inner corners of a checkerboard, in the plane of the board
+
+    Args:
+        pattern_size: (columns, rows) of inner corners
+        square_size: The side length of a square
+
+    Returns:
+        (N, 3) float32 array of the corners, in the order findChessboardCorners finds them
+    """
+    columns, rows = pattern_size
+    points = np.zeros((rows * columns, 3), np.float32)
+    points[:, :2] = np.mgrid[0:columns, 0:rows].T.reshape(-1, 2) * square_size
+    return points
+
+
+class CameraCalibration:
+    """The intrinsic parameters and lens distortion of a camera
+
+    Attributes:
+        camera_matrix: 3x3 camera matrix
+        dist_coeffs: Distortion coefficients (k1, k2, p1, p2[, k3...]) of the OpenCV model
+        image_size: (width, height) of the calibration images
+        rms: The RMS reprojection error of the calibration in pixels, or None
+        views: The number of images the checkerboard was found in
+    """
+
+    def __init__(self, camera_matrix, dist_coeffs, image_size, rms=None, views=0):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64).reshape(3, 3)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64).ravel()
+        self.image_size = tuple(int(v) for v in image_size)
+        self.rms = rms
+        self.views = views
+
+    @classmethod
+    def from_images(cls, images, pattern_size=(9, 6), square_size=1.0, min_views=3):
+        """Calibrate the camera from images of a checkerboard
+
+        Args:
+            images: Iterable of BGR or gray images, all of the same size
+            pattern_size: (columns, rows) of inner corners of the checkerboard
+            square_size: The side length of a square. Doesn't change the calibration
+            min_views: The min number of images the board has to be found in
+
+        Returns:
+            The CameraCalibration
+
+        Raises:
+            ValueError: If the board was found in fewer than min_views images, or the images
+                have different sizes
+        """
+        object_points = []
+        image_points = []
+        image_size = None
+        for image in images:
+            size = (image.shape[1], image.shape[0])
+            if image_size is None:
+                image_size = size
+            elif size != image_size:
+                raise ValueError(f"The calibration images have different sizes, {size} and {image_size}")
+
+            corners = find_checkerboard(image, pattern_size)
+            if corners is not None:
+                object_points.append(board_points(pattern_size, square_size))
+                image_points.append(corners)
+
+        if len(image_points) < min_views:
+            raise ValueError(f"Found the checkerboard in {len(image_points)} images, at least {min_views} are needed")
+
+        rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(object_points, image_points, image_size, None, None)
+        return cls(camera_matrix, dist_coeffs, image_size, rms, len(image_points))
+
+    def distort_points(self, points):
+        """Map pixel coordinates of the undistorted image to the raw image
+
+        Args:
+            points: (..., 2) array of pixel coordinates in the undistorted image
+
+        Returns:
+            Array of the same shape, with the coordinates in the raw image
+        """
+        points = np.asarray(points, dtype=np.float64)
+        focal = self.camera_matrix[[0, 1], [0, 1]]
+        center = self.camera_matrix[[0, 1], [2, 2]]
+
+        normalized = np.ones((points.size // 2, 3))
+        normalized[:, :2] = (points.reshape(-1, 2) - center) / focal
+        distorted, _ = cv2.projectPoints(normalized, np.zeros(3), np.zeros(3), self.camera_matrix, self.dist_coeffs)
+        return distorted.reshape(points.shape)
+
+    def undistort(self, frame):
+        """Undistort a whole frame"""
+        return cv2.undistort(frame, self.camera_matrix, self.dist_coeffs)
+
+    def __eq__(self, other):
+        if not isinstance(other, CameraCalibration):
+            return NotImplemented
+        return np.array_equal(self.camera_matrix, other.camera_matrix) and np.array_equal(self.dist_coeffs, other.dist_coeffs)
+
+    __hash__ = None
+
+    def to_dict(self):
+        """Convert the calibration to a dict that can be written as JSON"""
+        return {
+            'camera_matrix': self.camera_matrix.tolist(),
+            'dist_coeffs': self.dist_coeffs.tolist(),
+            'image_size': list(self.image_size),
+            'rms': self.rms,
+            'views': self.views,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a calibration from the output of to_dict()"""
+        return cls(data['camera_matrix'], data['dist_coeffs'], data['image_size'], data.get('rms'), data.get('views', 0))
+
+    def save(self, path):
+        """Write the calibration to a JSON file"""
+        with open(path, 'w') as calibration_file:
+            json.dump(self.to_dict(), calibration_file, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        """Read a calibration written by save()"""
+        with open(path) as calibration_file:
+            return cls.from_dict(json.load(calibration_file))
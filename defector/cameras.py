@@ -1,13 +1,17 @@
 """Provides functions to get camera matrix and calibration vector
 """
 
-from shutil import rmtree
-import os
-from pathlib import Path
-from time import sleep
+import sys
+import threading
+from typing import TYPE_CHECKING, Optional
 
 import cv2 as cv
-from pymba import Vimba, Frame
+
+from defector.framebuffer import FrameRingBuffer
+from defector.writer import make_output_dir
+
+if TYPE_CHECKING:
+    from pymba import Frame
 
 
 class PymbaCam:
@@ -15,22 +19,44 @@ class PymbaCam:
         'BayerRG8': cv.COLOR_BAYER_RG2RGB,
     }
 
-    def __init__(self, mode='Continuous', cam_idx=0):
+    PIXEL_FORMAT_CHANNELS = {
+        'RGB8Packed': 3,
+        'BGR8Packed': 3,
+    }
+
+    def __init__(self, mode='Continuous', cam_idx=0, buffer_size=100):
+        """
+        Args:
+            mode: The acquisition mode. Only Continuous is implemented
+            cam_idx: The index of the camera to use
+            buffer_size: The number of raw frames to preallocate buffer space for
+        """
+        # pymba needs the Vimba SDK, so it's only imported when a camera is opened
+        from pymba import Vimba
+
         self.vimba = Vimba()
         self.vimba.startup()
         self.camera = self.vimba.camera(cam_idx)
 
         self.is_last_frame = True
         self.framerate = 0
-        self.framerate_sum = 0
-        self.img_buffer = []
-        self.img_IDs = []
+        self.frame_count = 0
+        self.target_count = 0
+        self.consumer = False
+        self.first_frame = None
+        self.last_frame = None
+        self.done = threading.Event()
         if mode not in 'Continuous':  # SingleFrame']:
             raise NotImplementedError(f"{mode} is not a valid mode or not implemented. Use Continuous")
 
         self.camera.open()
         exposure = self.camera.feature('ExposureTimeAbs')
         exposure.value = 1000
+
+        self.pixel_format = self.camera.feature('PixelFormat').value
+        self.tick_frequency = self.camera.feature('GevTimestampTickFrequency').value
+        self.buffer = self.allocate_buffer(buffer_size)
+
         self.camera.arm('Continuous', self.continous_cb)
 
     def __del__(self):
@@ -40,53 +66,182 @@ class PymbaCam:
         self.camera.disarm()
         self.camera.close()
 
-    def continous_cb(self, frame: Frame):
+    def allocate_buffer(self, capacity):
+        """Allocate a ring buffer for raw frames of the current camera format
+
+        Args:
+            capacity: The number of frames the buffer holds
+
+        Returns:
+            FrameRingBuffer sized to the camera frames
+        """
+        shape = (self.camera.feature('Height').value, self.camera.feature('Width').value)
+        channels = self.PIXEL_FORMAT_CHANNELS.get(self.pixel_format, 1)
+        if channels > 1:
+            shape += (channels, )
+
+        return FrameRingBuffer(capacity, shape)
+
+    def continous_cb(self, frame: 'Frame'):
         """Callback for receiving frames when they're ready
 
+        The raw frame is copied into the preallocated ring buffer, no memory is allocated per frame.
+        Once target_count complete frames are stored, done is set and later frames are ignored.
+
         Args:
             frame: The frame object
 
         """
+        if self.done.is_set():
+            return
 
-        self.img_IDs.append([frame.data.frameID, False])
-
-        # If the frame is incomplte, discard it (VmbFrame_t.receiveStatus does not equal VmbFrameStatusComplete)
+        # If the frame is incomplte, only record its ID (VmbFrame_t.receiveStatus does not equal VmbFrameStatusComplete)
         if frame.data.receiveStatus == -1:
             print(f"Incomplete frame: ID{frame.data.frameID}")
+            self.store(None, frame.data.frameID, frame.data.timestamp, complete=False)
             return
 
-        # get a copy of the frame data
+        # get a view of the frame data
         try:
             image = frame.buffer_data_numpy()
         except NotImplementedError:
             print(f"Empty frame: ID{frame.data.frameID}")
+            self.store(None, frame.data.frameID, frame.data.timestamp, complete=False)
             return
 
-        # convert colour space if desired
+        self.store(image, frame.data.frameID, frame.data.timestamp)
+
+    def store(self, data, frame_id, timestamp, complete=True):
+        """Put a frame in the buffer, and set done when target_count complete frames are stored
+
+        Incomplete frames are stored too, so their IDs end up in the index, but they don't count
+        toward target_count. Without a consumer nothing frees the slots of the buffer, so done is
+        also set when it overflows.
+
+        Returns:
+            The sequence number of the frame, or None if the buffer was full
+        """
+        seq = self.buffer.put(data, frame_id, timestamp, complete)
+        if seq is None:
+            print(f"Frame buffer overflow, dropped frame: ID{frame_id}")
+            if not self.consumer:
+                self.done.set()
+            return None
+
+        if self.first_frame is None:
+            self.first_frame = (frame_id, timestamp)
+        self.last_frame = (frame_id, timestamp)
+
+        if complete:
+            self.frame_count += 1
+            if self.frame_count >= self.target_count:
+                self.done.set()
+        return seq
+
+    def measured_framerate(self):
+        """Get the average framerate of the last capture from the camera frame IDs and timestamps
+
+        Frames dropped by the buffer are included, as their IDs are still counted.
+        """
+        if self.first_frame is None or self.last_frame[1] <= self.first_frame[1]:
+            return 0
+
+        frames = self.last_frame[0] - self.first_frame[0]
+        seconds = (self.last_frame[1] - self.first_frame[1]) / self.tick_frequency
+        return frames / seconds
+
+    def convert(self, raw):
+        """Convert a raw frame to colour, if the pixel format needs it"""
         try:
-            image = cv.cvtColor(image, self.PIXEL_FORMATS_CONVERSIONS[frame.pixel_format])
+            return cv.cvtColor(raw, self.PIXEL_FORMATS_CONVERSIONS[self.pixel_format])
         except KeyError:
-            pass
+            return raw
+
+    def good_frames(self):
+        """Get the sequence numbers of the complete frames in the buffer"""
+        return [seq for seq in self.buffer.stored() if self.buffer.complete[self.buffer.slot(seq)]]
+
+    def capture(self, num_of_images=100, writer=None, timeout=30):
+        """Capture a sequence of frames
 
-        self.img_IDs[-1][1] = True
-        self.framerate_sum += self.camera.AcquisitionFrameRateAbs
-        self.img_buffer.append(image)
+        Returns as soon as num_of_images complete frames are stored and the acquisition is stopped.
+        The incomplete frames received in between are stored as well, and aren't counted.
 
-    def capture(self, num_of_images=100):
+        Args:
+            num_of_images: The number of complete frames to capture
+            writer: A FrameWriter to stream the frames to disk with during the capture.
+                If None the frames are kept in the buffer. Default: None
+            timeout: Max seconds to wait for the frames. Default: 30
+        """
         print("Started capture")
-        self.img_buffer = []
+        if writer is None and self.buffer.capacity < num_of_images:
+            self.buffer = self.allocate_buffer(num_of_images)
+        self.buffer.reset()
+        self.frame_count = 0
+        self.target_count = num_of_images
+        self.consumer = writer is not None
+        self.first_frame = None
+        self.last_frame = None
+        self.done.clear()
+        if writer is not None:
+            writer.start(self.buffer)
         self.camera.start_frame_acquisition()
 
-        # stream images for a while... stop one image before, as an additional frame is captured when acquisition is stopped
-        while len(self.img_buffer) < num_of_images - 1:
-            sleep(0.001)
-
+        if not self.done.wait(timeout):
+            print(f"Capture timed out after {timeout}s with {self.frame_count}/{num_of_images} frames")
+        self.done.set()
         self.camera.stop_frame_acquisition()
-        sleep(0.5)
 
-        self.framerate = self.framerate_sum / len(self.img_buffer)
+        self.framerate = self.measured_framerate()
         print(f"Average framerate: {self.framerate}")
-        print(f"Good frames {len(self.img_buffer)}/{len(self.img_IDs)}")
+        print(f"Good frames {self.frame_count}/{self.buffer.count}")
+        if self.buffer.overflows:
+            print(f"Frame buffer overflowed, {self.buffer.overflows} frames were dropped")
+
+        if writer is not None:
+            writer.finish(self.framerate)
+
+    def wait_until_settled(self, detector):
+        """Stream frames to a SettleDetector until it reports that the vial is settled
+
+        The detector always gets the newest frame, older frames are skipped if it falls behind.
+
+        Args:
+            detector: The SettleDetector
+
+        Returns:
+            timed_out (bool): If the detector gave up at its max_time
+        """
+        self.buffer.reset()
+        self.target_count = sys.maxsize
+        self.consumer = True
+        self.first_frame = None
+        self.last_frame = None
+        self.done.clear()
+        detector.reset()
+        self.camera.start_frame_acquisition()
+
+        try:
+            settled = False
+            while not settled:
+                seq = self.buffer.get(timeout=detector.max_time)
+                if seq is None:
+                    print("No frames received while waiting for the vial to settle")
+                    return True
+
+                newer = self.buffer.get(timeout=0)
+                while newer is not None:
+                    self.buffer.release(seq)
+                    seq, newer = newer, self.buffer.get(timeout=0)
+
+                if self.buffer.complete[self.buffer.slot(seq)]:
+                    settled = detector.update(self.buffer.frame(seq))
+                self.buffer.release(seq)
+        finally:
+            self.done.set()
+            self.camera.stop_frame_acquisition()
+
+        return detector.timed_out
 
     def save_images(self, dir, overwrite=False):
         """Save the image buffer to a folder of frames
@@ -97,28 +252,13 @@ class PymbaCam:
         """
         print("Saving images:")
 
-        out_dir = Path(dir)
-        if out_dir.is_dir():
-            if not overwrite:
-                raise FileExistsError(f"{dir} already exists, and overwrite=False")
-
-            rmtree(out_dir)
-            while out_dir.is_dir():
-                pass
-
-        os.makedirs(out_dir)
+        out_dir = make_output_dir(dir, overwrite)
         with open(f'{out_dir.as_posix()}/framerate', 'w') as framerate_file:
             framerate_file.write(str(self.framerate))
 
-        for img in self.img_buffer:
-
-            # Get the next valid frame ID
-            idx = self.img_IDs.pop(0)
-            while not idx[1]:
-                idx = self.img_ID
-                self.img_IDs.pop(0)
-                print('a')
-            idx = idx[0]
+        for seq in self.good_frames():
+            idx = self.buffer.frame_ids[self.buffer.slot(seq)]
+            img = self.convert(self.buffer.frame(seq))
 
             cv.imwrite(f'{out_dir.as_posix()}/VimbaImage_{idx}.png', img)
             print(f"\t{out_dir.as_posix()}/VimbaImage_{idx}.png")
@@ -133,14 +273,81 @@ class PymbaCam:
         Returns:
             frame (list): RGB values or []
         """
+        frames = self.good_frames()
+        if not frames:
+            return []
 
-        if self.idx == len(self.img_buffer) - 1:
-            self.is_last_frame = True
-        else:
-            self.is_last_frame = False
+        if self.idx >= len(frames):
+            self.idx = 0
 
-        if self.idx >= len(self.img_buffer):
-            idx = 0
+        self.is_last_frame = self.idx == len(frames) - 1
 
         self.idx += 1
-        return self.img_buffer[idx - 1]
+        return self.convert(self.buffer.frame(frames[self.idx - 1]))
+
+
+def display_frame(frame: 'Frame', delay: Optional[int] = 1) -> None:
+    """Displays the acquired frame.
+
+    Args:
+        frame: The frame object to display.
+        delay: Display delay in milliseconds, use 0 for indefinite.
+            Default 1
+    """
+    print('frame {}'.format(frame.data.frameID))
+
+    # get a copy of the frame data
+    image = frame.buffer_data_numpy()
+
+    # convert colour space if desired
+    try:
+        image = cv.cvtColor(image, PymbaCam.PIXEL_FORMATS_CONVERSIONS[frame.pixel_format])
+    except KeyError:
+        pass
+
+    # display image
+    cv.imshow('Image', image)
+    cv.waitKey(delay)
+
+
+def get_frame(frames=1, cam=0):
+    """Get a frame from a vimba camera
+
+    Args:
+        frames (int): The amount of frames to get.
+            Default 1
+        cam: The index(int) or camera_id(str)
+            Default 0
+
+    Returns:
+        list of images
+
+    Raises:
+        Stuff
+    """
+    from pymba import Vimba, VimbaException
+
+    frames = []
+    with Vimba() as vimba:
+        camera = vimba.camera(cam)
+        camera.open()
+
+        camera.arm('SingleFrame')
+
+        # capture a single frame, more than once if desired
+        for i in range(frames):
+            try:
+                frames.append(camera.acquire_frame())
+                display_frame(frames[i], 0)
+            except VimbaException as e:
+                # rearm camera upon frame timeout
+                if e.error_code == VimbaException.ERR_TIMEOUT:
+                    print(e)
+                    camera.disarm()
+                    camera.arm('SingleFrame')
+                else:
+                    raise
+
+        camera.disarm()
+        camera.close()
+        return frames
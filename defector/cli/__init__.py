@@ -2,3 +2,6 @@ from . import calibrate
 from . import framediff
 from . import hello
 from . import capture
+from . import convert
+from . import inspect
+from . import batch
@@ -0,0 +1,53 @@
+from pathlib import Path
+
+from milc import cli
+
+from defector.cli.framediff import DETECTIONS, warn_unused_threads
+
+
+@cli.argument('--profile', help='Add the stage times and counts of the frames to the summaries', action='store_true')
+@cli.argument('-w', '--workers', help='Number of sequences processed in parallel. Default: The number of CPUs', type=int)
+@cli.argument('-t', '--threads', help='Number of threads decoding images, per worker', type=int, default=2)
+@cli.argument('-m', '--min_detections', type=int, help="Number of frames a track has to be detected in to count as a particle.", default=5)
+@cli.argument('-d', '--distance', help='The distance in frames between the background of the median and mog2 detections and the current frame. black_hat and pyramid skip as many frames at the end', type=int, default=1)
+@cli.argument('--history', type=int, help="Number of frames in the background of the median and mog2 detections.", default=5)
+@cli.argument('--pyramid_levels', type=int, help="Number of times the pyramid detection halves the frames to find the candidates.", default=2)
+@cli.argument('--detection', help="How particles are found. black_hat finds dark spots in every frame, pyramid only looks at the full resolution near the dark spots of a downscaled frame, median and mog2 find the dark spots moving against the background of the recent frames.", choices=DETECTIONS, default='black_hat')
+@cli.argument('--threshold', type=int, help="Min black hat response, or difference to the background, of a particle pixel.", default=7)
+@cli.argument('--black_hat_threads', type=int, help="Number of strips of the frame the black hat detection, or windows the pyramid detection, processes in parallel. Independent of the OpenCV threads. Not used by median and mog2.", default=1)
+@cli.argument('--black_hat_size', type=int, help="Size of the black hat kernel, in pixels. Has to be larger than the particles.", default=25)
+@cli.argument('--calibration', type=Path, help='Lens calibration from the calibrate command, to undistort the frames while cutting out the vial')
+@cli.argument('--roi_sidecar', help='Reuse the ROI transform saved next to the sequence while it matches the frames, and save it there otherwise', action='store_true')
+@cli.argument('--roi_file', type=Path, help='Reuse the ROI transform saved in this file while it matches the frames, and save it there otherwise. Use one file per camera and fixture')
+@cli.argument('-r', '--roi', help='Crop ROI of all images', action='store_false')
+@cli.argument('-o', '--output', type=Path, help='JSON Lines file to append the sequence summaries to. Sequences already in it are skipped', default='batch_results.jsonl')
+@cli.argument('-i', '--input', nargs='+', help='Sequence directories, sequence files, or glob patterns matching them', required=True)
+@cli.subcommand('Run the detection and tracking on many sequences in parallel')
+def batch(cli):
+    from defector.batch import find_sequences, run_batch
+    from defector.calibration import CameraCalibration
+    from defector.helpers import create_detector
+
+    config = cli.config.batch
+    warn_unused_threads(config.detection, config.black_hat_threads)
+
+    sequences = find_sequences(config.input)
+    if not sequences:
+        cli.log.error('No sequences found')
+        return False
+
+    failed = 0
+    processed = 0
+    options = {'roi': config.roi, 'distance': config.distance, 'threads': config.threads, 'min_detections': config.min_detections, 'profile': config.profile, 'roi_file': config.roi_file, 'roi_sidecar': config.roi_sidecar, 'detector': create_detector(config.detection, config.threshold, config.black_hat_size, config.history, config.distance, config.pyramid_levels, config.black_hat_threads)}
+    if config.calibration:
+        options['calibration'] = CameraCalibration.load(config.calibration)
+    for summary in run_batch(sequences, config.output, config.workers, **options):
+        processed += 1
+        if 'error' in summary:
+            failed += 1
+            cli.log.error(f"{summary['sequence']}: {summary['error']}")
+        else:
+            cli.log.info(f"{summary['sequence']}: {summary['particles']} particles, {summary['tracks']} tracks, {summary['frames']} frames in {summary['total_time']:.1f}s")
+
+    cli.log.info(f'Processed {processed} of {len(sequences)} sequences, {len(sequences) - processed} were already done. Results in {config.output}')
+    return not failed
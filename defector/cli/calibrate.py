@@ -1,6 +1,35 @@
 """This provides functions for calibrating the vision system
 """
+from pathlib import Path
 
+from milc import cli
 
-def checker():
-    pass
+from defector.argument_types import dir_path, pattern_size
+
+
+@cli.argument('-q', '--square_size', type=float, help='Side length of the checkerboard squares. Only scales the board poses, not the calibration', default=1.0)
+@cli.argument('-p', '--pattern', type=pattern_size, help='Inner corners of the checkerboard, columns x rows. Default: 9x6', default=(9, 6))
+@cli.argument('-o', '--output', type=Path, help='JSON file to save the calibration in, for the --calibration argument of the other commands', default='calibration.json')
+@cli.argument('-i', '--input', type=dir_path, help='Directory containing images of a checkerboard, in different positions and angles', required=True)
+@cli.subcommand('Calibrate the camera lens from images of a checkerboard')
+def calibrate(cli):
+    from defector.calibration import CameraCalibration
+    from defector.helpers import get_folder
+    from defector.loader import read_image
+
+    config = cli.config.calibrate
+
+    paths = get_folder(config.input)
+    if not paths:
+        cli.log.error(f'No images found in {config.input}')
+        return False
+
+    try:
+        calibration = CameraCalibration.from_images((read_image(path) for path in paths), config.pattern, config.square_size)
+    except ValueError as e:
+        cli.log.error(str(e))
+        return False
+
+    calibration.save(config.output)
+    cli.log.info(f'Found the checkerboard in {calibration.views} of {len(paths)} images. RMS reprojection error {calibration.rms:.3f} px')
+    cli.log.info(f'Saved the calibration to {config.output}')
@@ -1,24 +1,47 @@
 from pathlib import Path
-from time import sleep
 
 from milc import cli
 
-from defector.cameras import PymbaCam
-from defector.communication import set_speed
+# The keys of FrameWriter.ENCODINGS, kept here so the writer is only imported when capturing
+ENCODINGS = ('png', 'tiff', 'bmp')
 
 
+@cli.argument('-b', '--buffer_size', type=int, help="Number of raw frames buffered between the camera and the writer threads.", default=100)
+@cli.argument('-t', '--writer_threads', type=int, help="Number of threads writing frames to disk.", default=2)
+@cli.argument('-c', '--png_compression', type=int, help="PNG compression level 0-9. 0 is fastest.", default=1)
+@cli.argument('-e', '--encoding', help="Image encoding of the saved frames. sequence saves the raw frames in a single sequence file.", choices=ENCODINGS + ('sequence', ), default='png')
+@cli.argument('--settle_max', type=float, help="Max seconds to wait for the liquid to settle after stopping the vial.", default=4)
+@cli.argument('--settle_min', type=float, help="Min seconds to wait for the liquid to settle after stopping the vial.", default=0.5)
+@cli.argument('--settle_threshold', type=float, help="Mean absolute frame difference in the vial below which the liquid is settled.", default=2.0)
+@cli.argument('--spin_time', type=float, help="Seconds to spin the vial for.", default=4)
 @cli.argument('-s', '--speed', type=int, help="Speed to spin the vial at 0-1000", default=200)
 @cli.argument('-n', '--img_count', type=int, help="Number of images to capture.", default=100)
 @cli.argument('-f', '--force', help='Remove output directory if it exists. !!THIS REMOVES THE ENTIRE DIRECTORY!!', action='store_true')
 @cli.argument('-o', '--output', type=Path, help='Output directory to save images sequence in', default='framediff_output', required=True)
 @cli.subcommand('Capture a sequence of images and save them')
 def capture(cli):
-    cam = PymbaCam()
+    from defector.cameras import PymbaCam
+    from defector.sequence import SUFFIX
+    from defector.settle import SettleDetector, spin_and_settle
+    from defector.writer import FrameWriter, SequenceFrameWriter
 
-    set_speed(cli.config.capture.speed, 5000, 5000)
-    sleep(4)
-    set_speed(0, 5000, 5000)
-    sleep(4)
+    config = cli.config.capture
+    cam = PymbaCam(buffer_size=config.buffer_size)
+    if config.encoding == 'sequence':
+        writer = SequenceFrameWriter(config.output.with_suffix(SUFFIX), cam.pixel_format, config.img_count, config.force)
+    else:
+        writer = FrameWriter(config.output, config.encoding, config.png_compression, config.writer_threads, cam.convert, config.force)
 
-    cam.capture(cli.config.capture.img_count)
-    cam.save_images(cli.config.capture.output, cli.config.capture.force)
+    detector = SettleDetector(config.settle_threshold, config.settle_min, config.settle_max, convert=cam.convert)
+    try:
+        settle_time = spin_and_settle(cam, detector, config.speed, config.spin_time)
+    except TimeoutError as error:
+        cli.log.error(error)
+        return False
+
+    if detector.timed_out:
+        cli.log.warning(f'The liquid did not settle within {config.settle_max}s')
+    else:
+        cli.log.info(f'The liquid settled after {settle_time:.2f}s')
+
+    cam.capture(config.img_count, writer)
@@ -0,0 +1,29 @@
+from pathlib import Path
+
+from milc import cli
+
+from defector.argument_types import dir_path
+
+
+@cli.argument('-f', '--force', help='Replace the sequence files if they exist', action='store_true')
+@cli.argument('-o', '--output', type=Path, help='Sequence file to write. Only for a single input. Default: <input>.dfseq')
+@cli.argument('-i', '--input', type=dir_path, nargs='+', help='Directories containing image sequences', required=True)
+@cli.subcommand('Convert folders of images to sequence files')
+def convert(cli):
+    from defector.sequence import SUFFIX, convert_folder
+
+    config = cli.config.convert
+
+    if config.output and len(config.input) > 1:
+        cli.log.error('--output can only be used with a single input')
+        return False
+
+    for folder in config.input:
+        output = config.output or folder.resolve().with_suffix(SUFFIX)
+        try:
+            count = convert_folder(folder, output, config.force)
+        except (OSError, ValueError) as e:
+            cli.log.error(str(e))
+            return False
+
+        cli.log.info(f'Converted {count} frames from {folder} to {output}')
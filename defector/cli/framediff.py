@@ -3,113 +3,166 @@ import os
 from pathlib import Path
 from time import sleep
 
-import cv2
 from milc import cli
 
-from defector.argument_types import dir_path
-from defector.helpers import roi_crop, get_folder, find_contours, remove_stationary_contours, get_centroid
-from defector.tracker import Tracker
+from defector.argument_types import sequence_path
 
+# The keys of helpers.DETECTIONS, kept here so the helpers are only imported when running
+DETECTIONS = ('black_hat', 'pyramid', 'median', 'mog2')
+# The detections that use --black_hat_threads
+THREADED_DETECTIONS = ('black_hat', 'pyramid')
 
-@cli.argument('-d', '--distance', help='The distance in frames to diff over', type=int, default=1)
+TRACK_COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (0, 255, 255), (255, 0, 255), (255, 127, 255), (127, 0, 255), (127, 0, 127)]
+
+
+def draw_detections(img, contours, centroids, radius):
+    """Draw the contours and the stationary radius around their centroids"""
+    import cv2
+
+    cv2.drawContours(img, contours, -1, (0, 0, 255), 2)
+
+    for x, y in centroids:
+        # draw the radius of the points, deciding if points are considered stationary
+        cv2.circle(img, (int(x), int(y)), radius, (0, 255, 0), 1)
+
+
+def draw_tracks(img, tracks):
+    """Draw the trace of every track, using various colors to indicate different track_id"""
+    import cv2
+
+    for track in tracks:
+        trace = track.trace
+        if (len(trace) > 1):
+            for j in range(len(trace) - 1):
+                # Draw trace line
+                x1 = int(trace[j][0][0])
+                y1 = int(trace[j][1][0])
+                x2 = int(trace[j + 1][0][0])
+                y2 = int(trace[j + 1][1][0])
+                clr = track.track_id % 9
+                cv2.line(img, (x1, y1), (x2, y2), TRACK_COLORS[clr], 1)
+            if track.point is not None:
+                cv2.line(img, (x2, y2), (int(track.point[0][0]), int(track.point[1][0])), TRACK_COLORS[clr], 1)
+
+
+def warn_unused_threads(detection, threads):
+    """Warn if black hat threads are given to a detection that doesn't use them"""
+    if threads > 1 and detection not in THREADED_DETECTIONS:
+        cli.log.warning(f'--black_hat_threads is only used by the {" and ".join(THREADED_DETECTIONS)} detections, {detection} runs on a single thread')
+
+
+def show_frame(img):
+    """Display the resulting tracking frame and handle key strokes
+
+    Returns:
+        False if the user asked to exit, True otherwise
+    """
+    import cv2
+
+    cv2.imshow('Tracking', img)
+
+    # Check for key strokes
+    k = cv2.waitKey(10) & 0xff
+    if k == 27:  # 'esc' key has been pressed, exit program.
+        return False
+    if k == 112:  # 'p' has been pressed. this will pause/resume the code.
+        print("Code is paused. Press 'p' to resume..")
+        while True:
+            # stay in this loop until
+            key = cv2.waitKey(30) & 0xff
+            if key == 112:
+                print("Resume code..!!")
+                break
+    return True
+
+
+@cli.argument('--profile_trace', type=Path, help='Write the per-frame stage times and counts to this CSV file, or JSON if it ends in .json. Implies --profile')
+@cli.argument('--profile', help='Time every stage of the pipeline, and print a summary', action='store_true')
+@cli.argument('--save', help='Write every processed frame to the output directory. Default: save', action='store_boolean', default=True)
+@cli.argument('--overlay', help='Draw contours and tracks on the frames. Default: overlay', action='store_boolean', default=True)
+@cli.argument('--headless', help='Don\'t display the frames or wait for key strokes', action='store_true')
+@cli.argument('-w', '--workers', help='Number of processes detecting contours. 1 detects in this process', type=int, default=1)
+@cli.argument('-t', '--threads', help='Number of threads decoding images', type=int, default=4)
+@cli.argument('-p', '--prefetch', help='Number of images to decode ahead of processing', type=int, default=8)
+@cli.argument('-d', '--distance', help='The distance in frames between the background of the median and mog2 detections and the current frame. black_hat and pyramid skip as many frames at the end', type=int, default=1)
+@cli.argument('--history', type=int, help="Number of frames in the background of the median and mog2 detections.", default=5)
+@cli.argument('--pyramid_levels', type=int, help="Number of times the pyramid detection halves the frames to find the candidates.", default=2)
+@cli.argument('--detection', help="How particles are found. black_hat finds dark spots in every frame, pyramid only looks at the full resolution near the dark spots of a downscaled frame, median and mog2 find the dark spots moving against the background of the recent frames.", choices=DETECTIONS, default='black_hat')
+@cli.argument('--threshold', type=int, help="Min black hat response, or difference to the background, of a particle pixel.", default=7)
+@cli.argument('--black_hat_threads', type=int, help="Number of strips of the frame the black hat detection, or windows the pyramid detection, processes in parallel. Independent of the OpenCV threads. Not used by median and mog2.", default=1)
+@cli.argument('--black_hat_size', type=int, help="Size of the black hat kernel, in pixels. Has to be larger than the particles.", default=25)
+@cli.argument('--calibration', type=Path, help='Lens calibration from the calibrate command, to undistort the frames while cutting out the vial')
+@cli.argument('--roi_sidecar', help='Reuse the ROI transform saved next to the sequence while it matches the frames, and save it there otherwise', action='store_true')
+@cli.argument('--roi_file', type=Path, help='Reuse the ROI transform saved in this file while it matches the frames, and save it there otherwise. Use one file per camera and fixture')
 @cli.argument('-r', '--roi', help='Crop ROI of all images', action='store_false')
 @cli.argument('-f', '--force', help='Remove output directory if it exists. !!THIS REMOVES THE ENTIRE DIRECTORY!!', action='store_true')
-@cli.argument('-i', '--input', type=dir_path, help='Directory containing the image sequence. Has to end in a number sequence', required=True)
+@cli.argument('-i', '--input', type=sequence_path, help='Directory containing the image sequence, or a sequence file. Image names have to end in a number sequence', required=True)
 @cli.argument('-o', '--output', type=Path, help='Output directory to save images sequence in', default='framediff_output')
 @cli.subcommand("Generates sequence of frame differences from input image sequence")
 def framediff(cli):  # noqa: C901
     """
     Create a series of frame differences between all subsequent frames of VirtCam.
     """
-
-    if cli.config.framediff.output.is_dir():
-        if cli.config.framediff.force:
-            shutil.rmtree(cli.config.framediff.output)
-            while cli.config.framediff.output.is_dir():
-                pass
-            sleep(0.5)
-        else:
-            cli.log.error(f'{str(cli.config.framediff.output)} already exists, and overwrite isn\'t forced')
-            return False
-    os.makedirs(cli.config.framediff.output)
-
-    images = get_folder(cli.config.framediff.input.resolve())
-
-    # test implementation of track #
-    # center_points = []
-    # size = None
-
-    # Create Object Tracker
-    tracker = Tracker(50, 5, 5, 100, 0.5)
-
-    # Variables initialization
-    # skip_frame_count = 0
-    track_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (0, 255, 255), (255, 0, 255), (255, 127, 255), (127, 0, 255), (127, 0, 127)]
-
-    ##############################################################
-
-    first_run = True
-    pause = False
-    for idx, img in enumerate(images[:-cli.config.framediff.distance]):
-        background = cv2.imread(img, cv2.IMREAD_COLOR)
-        # frame = cv2.imread(images[idx + cli.config.framediff.distance], cv2.IMREAD_COLOR)
-
-        if cli.config.framediff.roi:
-            first_run, background = roi_crop(background, first_run)
-
-        contours, center_img = find_contours(background)
-
-        stationary_threshhold = 5
-        contours_found = len(contours)
-        contours = remove_stationary_contours(contours, stationary_threshhold, 5, 10)
-        print(f"Contours: {len(contours)} moving | {contours_found - len(contours)} stationary")
-
-        centroids = [get_centroid(c) for c in contours]
-
-        cv2.drawContours(center_img, contours, -1, (0, 0, 255), 2)
-
-        for centroid in centroids:
-            # draw the radius of the points, deciding if points are considered stationary
-            cv2.circle(center_img, (centroid[0][0], centroid[1][0]), stationary_threshhold, (0, 255, 0), 1)
-
-        # tracker #
-        tracker.Update(contours)
-
-        # For identified object tracks draw tracking line
-        # Use various colors to indicate different track_id
-        for i in range(len(tracker.tracks)):
-            if (len(tracker.tracks[i].trace) > 1):
-                for j in range(len(tracker.tracks[i].trace) - 1):
-                    # Draw trace line
-                    x1 = int(tracker.tracks[i].trace[j][0][0])
-                    y1 = int(tracker.tracks[i].trace[j][1][0])
-                    x2 = int(tracker.tracks[i].trace[j + 1][0][0])
-                    y2 = int(tracker.tracks[i].trace[j + 1][1][0])
-                    clr = tracker.tracks[i].track_id % 9
-                    cv2.line(center_img, (x1, y1), (x2, y2), track_colors[clr], 1)
-                if tracker.tracks[i].point is not None:
-                    cv2.line(center_img, (x2, y2), (tracker.tracks[i].point[0][0], tracker.tracks[i].point[1][0]), track_colors[clr], 1)
-
-        # Display the resulting tracking frame
-
-        cv2.imshow('Tracking', center_img)
-        cv2.waitKey(10)
-
-        # Check for key strokes
-        k = cv2.waitKey(50) & 0xff
-        if k == 27:  # 'esc' key has been pressed, exit program.
+    import cv2
+    from defector.calibration import CameraCalibration
+    from defector.helpers import RoiCache, create_detector, roi_sidecar_path
+    from defector.pipeline import detect_sequence, open_input, SequenceTracker, skip_last_frames
+    from defector.profiling import profiler
+
+    config = cli.config.framediff
+    save = config.save
+    warn_unused_threads(config.detection, config.black_hat_threads)
+    overlay = config.overlay and (save or not config.headless)
+
+    if save:
+        if config.output.is_dir():
+            if config.force:
+                shutil.rmtree(config.output)
+                while config.output.is_dir():
+                    pass
+                sleep(0.5)
+            else:
+                cli.log.error(f'{str(config.output)} already exists, and overwrite isn\'t forced')
+                return False
+        os.makedirs(config.output)
+
+    profile = config.profile or config.profile_trace is not None
+    profiler.enable(profile)
+
+    calibration = CameraCalibration.load(config.calibration) if config.calibration else None
+    roi = config.roi
+    if roi and (config.roi_file or config.roi_sidecar or calibration):
+        roi_path = config.roi_file or (roi_sidecar_path(config.input.resolve()) if config.roi_sidecar else None)
+        roi = RoiCache(roi_path, calibration=calibration)
+
+    images, read = open_input(config.input.resolve())
+    detector = create_detector(config.detection, config.threshold, config.black_hat_size, config.history, config.distance, config.pyramid_levels, config.black_hat_threads)
+    detections = detect_sequence(skip_last_frames(images, config.distance, detector), roi, config.workers, config.prefetch, config.threads, keep_frames=save or not config.headless, draw=overlay, read=read, detector=detector)
+
+    sequence_tracker = SequenceTracker()
+
+    for idx, frame_detections in enumerate(detections):
+        center_img = frame_detections.frame
+
+        moving = sequence_tracker.update(frame_detections)
+        print(f"Contours: {len(moving)} moving | {len(frame_detections) - len(moving)} stationary")
+
+        if overlay:
+            contours = [frame_detections.contours[contour_idx] for contour_idx in moving['index']]
+            draw_detections(center_img, contours, moving['centroid'], sequence_tracker.stationary_filter.thresh)
+            draw_tracks(center_img, sequence_tracker.tracker.tracks)
+
+        if not config.headless and not show_frame(center_img):
             break
-        if k == 112:  # 'p' has been pressed. this will pause/resume the code.
-            pause = not pause
-            if (pause is True):
-                print("Code is paused. Press 'p' to resume..")
-                while (pause is True):
-                    # stay in this loop until
-                    key = cv2.waitKey(30) & 0xff
-                    if key == 112:
-                        pause = False
-                        print("Resume code..!!")
-                        break
-        ###########################################
-        cv2.imwrite(str(cli.config.framediff.output.joinpath(f'out{idx}.png')), center_img)
-    cv2.destroyAllWindows()
+
+        if save:
+            cv2.imwrite(str(config.output.joinpath(f'out{idx}.png')), center_img)
+
+    if not config.headless:
+        cv2.destroyAllWindows()
+
+    if profile:
+        print(profiler.format_summary())
+        if config.profile_trace is not None:
+            profiler.write_trace(config.profile_trace)
+            cli.log.info(f'Wrote the profile trace to {config.profile_trace}')
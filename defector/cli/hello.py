@@ -4,7 +4,6 @@ from time import sleep
 from milc import cli
 
 from defector.argument_types import dir_path
-from defector.communication import set_speed
 
 
 @cli.argument('-i', '--input', type=dir_path, help='Directory containing the image sequence. Has to end in a number sequence')
@@ -21,6 +20,12 @@ def hello(cli):
 @cli.argument('-s', '--speed', type=int, help="Speed to spin the vial at 0-1000", default=200)
 @cli.subcommand("Test stuff")
 def test(cli):
-    set_speed(cli.config.test.speed, cli.config.test.accel, cli.config.test.decel)
-    sleep(10)
-    set_speed(0, cli.config.test.accel, cli.config.test.decel)
+    from defector.communication import set_speed
+
+    try:
+        set_speed(cli.config.test.speed, cli.config.test.accel, cli.config.test.decel)
+        sleep(10)
+        set_speed(0, cli.config.test.accel, cli.config.test.decel)
+    except TimeoutError as error:
+        cli.log.error(error)
+        return False
@@ -0,0 +1,98 @@
+from pathlib import Path
+
+from milc import cli
+
+
+def report(summary, buffer_size):
+    """Log the summary of an inspection
+
+    Args:
+        summary: The summary from LiveInspector.summary()
+        buffer_size: The capacity of the frame buffer
+
+    Returns:
+        accepted (bool): If the vial was accepted
+    """
+    cli.log.info(f"Processed {summary['frames']} frames at {summary['fps']:.1f} fps, {summary['incomplete']} incomplete, {summary['dropped']} dropped, max backlog {summary['max_backlog']}/{buffer_size}")
+    if summary['dropped']:
+        cli.log.warning(f"{summary['dropped']} frames were dropped because the pipeline fell behind the camera")
+
+    if summary['verdict'] == 'reject':
+        cli.log.error(f"Rejected: {summary['particles']} particles found")
+        return False
+
+    cli.log.info(f"Accepted: {summary['particles']} particles found")
+    return True
+
+
+@cli.argument('--profile_trace', type=Path, help='Write the per-frame stage times and counts to this CSV file, or JSON if it ends in .json. Implies --profile')
+@cli.argument('--profile', help='Time every stage of the pipeline, and print a summary', action='store_true')
+@cli.argument('-b', '--buffer_size', type=int, help="Number of raw frames buffered between the camera and the pipeline. Frames are dropped when it's full.", default=100)
+@cli.argument('-m', '--max_particles', type=int, help="Max number of particles in an accepted vial.", default=0)
+@cli.argument('-d', '--min_detections', type=int, help="Number of frames a track has to be detected in to count as a particle.", default=5)
+@cli.argument('--threshold', type=int, help="Min black hat response of a particle pixel.", default=7)
+@cli.argument('--black_hat_threads', type=int, help="Number of strips of the frame the black hat detection processes in parallel. Independent of the OpenCV threads.", default=1)
+@cli.argument('--black_hat_size', type=int, help="Size of the black hat kernel, in pixels. Has to be larger than the particles.", default=25)
+@cli.argument('--calibration', type=Path, help='Lens calibration from the calibrate command, to undistort the frames while cutting out the vial')
+@cli.argument('--roi_file', type=Path, help='Reuse the ROI transform saved in this file while it matches the frames, and save it there otherwise. Use one file per camera and fixture')
+@cli.argument('-r', '--roi', help='Don\'t cut the vial out of the frames', action='store_false')
+@cli.argument('--settle_max', type=float, help="Max seconds to wait for the liquid to settle after stopping the vial.", default=4)
+@cli.argument('--settle_min', type=float, help="Min seconds to wait for the liquid to settle after stopping the vial.", default=0.5)
+@cli.argument('--settle_threshold', type=float, help="Mean absolute frame difference in the vial below which the liquid is settled.", default=2.0)
+@cli.argument('--spin_time', type=float, help="Seconds to spin the vial for.", default=4)
+@cli.argument('-s', '--speed', type=int, help="Speed to spin the vial at 0-1000", default=200)
+@cli.argument('-n', '--img_count', type=int, help="Number of images to inspect.", default=100)
+@cli.argument('-f', '--force', help='Replace the sequence file if it exists', action='store_true')
+@cli.argument('-o', '--output', type=Path, help='Sequence file to save the raw frames in. Default: Don\'t save the frames')
+@cli.subcommand('Inspect a vial, running the detection on the frames while they are captured')
+def inspect(cli):
+    from defector.cameras import PymbaCam
+    from defector.calibration import CameraCalibration
+    from defector.helpers import ContourDetector, RoiCache
+    from defector.pipeline import LiveInspector
+    from defector.profiling import profiler
+    from defector.sequence import SUFFIX
+    from defector.settle import SettleDetector, spin_and_settle
+
+    config = cli.config.inspect
+
+    output = None
+    if config.output:
+        output = config.output.with_suffix(SUFFIX)
+        if output.exists() and not config.force:
+            cli.log.error(f'{str(output)} already exists, and overwrite isn\'t forced')
+            return False
+
+    cam = PymbaCam(buffer_size=config.buffer_size)
+    calibration = CameraCalibration.load(config.calibration) if config.calibration else None
+    roi = RoiCache(config.roi_file, calibration=calibration) if config.roi and (config.roi_file or calibration) else config.roi
+    inspector = LiveInspector(cam.convert, roi, output, cam.pixel_format, config.img_count, min_detections=config.min_detections, max_particles=config.max_particles, detector=ContourDetector(config.black_hat_size, config.threshold, threads=config.black_hat_threads))
+
+    detector = SettleDetector(config.settle_threshold, config.settle_min, config.settle_max, convert=cam.convert)
+    try:
+        settle_time = spin_and_settle(cam, detector, config.speed, config.spin_time)
+    except TimeoutError as error:
+        cli.log.error(error)
+        return False
+
+    if detector.timed_out:
+        cli.log.warning(f'The liquid did not settle within {config.settle_max}s')
+    else:
+        cli.log.info(f'The liquid settled after {settle_time:.2f}s')
+
+    profile = config.profile or config.profile_trace is not None
+    profiler.enable(profile)
+
+    cam.capture(config.img_count, inspector)
+    summary = inspector.summary()
+
+    if profile:
+        print(profiler.format_summary())
+        if config.profile_trace is not None:
+            profiler.write_trace(config.profile_trace)
+            cli.log.info(f'Wrote the profile trace to {config.profile_trace}')
+
+    if output is not None:
+        cli.log.info(f'Saved the frames to {output}')
+
+    return report(summary, config.buffer_size)
@@ -1,46 +1,250 @@
-import serial
 import platform
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, wait
+from time import monotonic
+
+import serial
 
-from crcmod.predefined import Crc
+from crcmod.predefined import mkPredefinedCrcFun
 
 port = 'COM3'
 if 'linux' in platform.system().lower():
     port = '/dev/ttyUSB0'
 
+START_BYTE = b'!'
+ACK = b'A'
+NACK = b'N'
 
-def set_speed(speed, acceleration, deceleration=None):
-    """Set the speed of the vial spinner
+crc16 = mkPredefinedCrcFun('crc-ccitt-false')
+
+
+def make_packet(speed, acceleration, deceleration=None):
+    """Build a framed speed packet for the PacketCom firmware
+
+    The packet is the start byte, followed by the little endian int16 speed, uint16 acceleration,
+    uint16 deceleration and the uint16 CRC16 (CCITT-FALSE) of the data.
+
+    The firmware restarts a packet whenever it receives the start byte, so it may only be the
+    first byte. If the data or the CRC contains it, the acceleration and deceleration are nudged
+    by ±1 until the packet is clean, and speeds with the start byte in their low byte (e.g. 33)
+    are moved one step towards 0.
 
     Args:
         speed (int): The permille to spin the vial at (-1000 to 1000)
         acceleration: The acceleration in units/s^2
         deceleration: The deceleration in units/s^2
             Default acceleration
-    """
 
+    Returns:
+        packet (bytes): The framed packet
+
+    Raises:
+        ValueError: If speed is out of range
+    """
     if deceleration is None:
         deceleration = acceleration
 
     if not (-1000 <= speed <= 1000):
         raise ValueError(f'{speed} is outside the permitted range (-1000 to 1000)')
 
-    speed = speed.to_bytes(2, byteorder='little', signed=True)
-    acceleration = acceleration.to_bytes(2, byteorder='little')
-    deceleration = deceleration.to_bytes(2, byteorder='little')
+    speed_bytes = speed.to_bytes(2, byteorder='little', signed=True)
+    if START_BYTE in speed_bytes:
+        speed_bytes = (speed - 1 if speed > 0 else speed + 1).to_bytes(2, byteorder='little', signed=True)
+
+    for step in range(0x10000):
+        for nudge in (step, -step):
+            if not (0 <= acceleration + nudge <= 0xffff and 0 <= deceleration + nudge <= 0xffff):
+                continue
+
+            data = speed_bytes + (acceleration + nudge).to_bytes(2, byteorder='little') + (deceleration + nudge).to_bytes(2, byteorder='little')
+            packet = data + crc16(data).to_bytes(2, byteorder='little')
+            if START_BYTE not in packet:
+                return START_BYTE + packet
+
+
+class JigController:
+    """Keeps a serial connection to the jig open, and sends speed commands without blocking
+
+    Commands are queued and written by a sender thread, and a receiver thread matches the
+    A/N acks of the firmware to the commands. Only one command is in flight at a time: the
+    sender waits for the ack, or the timeout, of a command before sending the next, so an
+    ack is never attributed to the wrong command. Every command returns a Future, which
+    resolves to True on A, False on N, or fails with TimeoutError if the firmware doesn't
+    answer within ack_timeout.
+
+    A speed profile is a list of (speed, acceleration, deceleration, hold) steps. The sender
+    waits hold seconds after a step before sending the next command, so queued profiles run
+    in the background. stop() clears the queue and stops the vial immediately.
+
+    Note: The firmware restarts a packet whenever it receives the start byte, so make_packet()
+    adjusts commands that would contain '!' (0x21) in their data or CRC by one unit.
+    """
+
+    def __init__(self, port=port, baudrate=115200, ack_timeout=0.5):
+        """
+        Args:
+            port: The serial port of the jig
+            baudrate: The baudrate of the firmware
+            ack_timeout: Max seconds to wait for the ack of a command
+        """
+        self.ack_timeout = ack_timeout
+
+        self.serial = serial.Serial()
+        self.serial.baudrate = baudrate
+        self.serial.port = port
+        self.serial.timeout = 0.05
+        self.serial.dtr = None
+
+        self._commands = queue.Queue()
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
+        self._interrupt = threading.Event()
+        self._closed = threading.Event()
+        self._threads = []
+
+    def open(self):
+        """Open the serial port and start the sender and receiver threads"""
+        self.serial.open()
+        self._closed.clear()
+        self._threads = [
+            threading.Thread(target=self._send_loop, name='JigController-send', daemon=True),
+            threading.Thread(target=self._receive_loop, name='JigController-receive', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def close(self):
+        """Send the queued commands, wait for their acks, and close the port"""
+        if not self._threads:
+            return
+
+        self._commands.put(None)
+        self._threads[0].join()
+        self._closed.set()
+        self._threads[1].join()
+        self._threads = []
+        self.serial.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def send(self, speed, acceleration, deceleration=None, hold=0):
+        """Queue a speed command
 
-    packet = speed + acceleration + deceleration
+        Args:
+            speed (int): The permille to spin the vial at (-1000 to 1000)
+            acceleration: The acceleration in units/s^2
+            deceleration: The deceleration in units/s^2
+                Default acceleration
+            hold: Seconds to wait after sending the command, before sending the next
 
-    crc16 = Crc('crc-ccitt-false')
-    crc16.update(packet)
-    packet += crc16.crcValue.to_bytes(2, byteorder='little')
+        Returns:
+            Future of the ack
+        """
+        future = Future()
+        self._commands.put((make_packet(speed, acceleration, deceleration), hold, future))
+        return future
 
-    ser = serial.Serial()
-    ser.baudrate = 115200
-    ser.port = port
-    ser.timeout = 0.1
-    ser.dtr = None
+    def set_speed(self, speed, acceleration, deceleration=None):
+        """Send a speed command and wait for the ack
+
+        Returns:
+            ack (bool): True if the firmware accepted the command
+        """
+        return self.send(speed, acceleration, deceleration).result()
+
+    def run_profile(self, steps):
+        """Queue a speed profile
+
+        Args:
+            steps: List of (speed, acceleration, deceleration, hold) steps
+
+        Returns:
+            List of the Futures of the acks of the steps
+        """
+        return [self.send(*step) for step in steps]
+
+    def stop(self, deceleration=5000):
+        """Drop the queued commands and profiles, and stop the vial
+
+        Returns:
+            Future of the ack of the stop command
+        """
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                break
+            if command is not None:
+                command[2].cancel()
+            else:
+                self._commands.put(None)
+                break
+
+        self._interrupt.set()
+        return self.send(0, deceleration, deceleration)
+
+    def _send_loop(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+
+            packet, hold, future = command
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self._pending_lock:
+                self._pending.append((monotonic() + self.ack_timeout, future))
+            self.serial.write(packet)
+            # The receiver resolves the future on the ack, or when it times out
+            wait([future])
+
+            if hold:
+                self._interrupt.wait(hold)
+            self._interrupt.clear()
+
+    def _receive_loop(self):
+        while True:
+            ack = self.serial.read(1)
+            with self._pending_lock:
+                # Expire the commands first, so a late ack isn't attributed to a command that timed out
+                now = monotonic()
+                while self._pending and self._pending[0][0] < now:
+                    self._pending.popleft()[1].set_exception(TimeoutError('The jig did not acknowledge the command'))
+
+                if ack in (ACK, NACK) and self._pending:
+                    self._pending.popleft()[1].set_result(ack == ACK)
+
+                if self._closed.is_set() and not self._pending:
+                    return
+
+
+_controller = None
+
+
+def set_speed(speed, acceleration, deceleration=None):
+    """Set the speed of the vial spinner
+
+    Uses a JigController that stays connected for the lifetime of the process.
+
+    Args:
+        speed (int): The permille to spin the vial at (-1000 to 1000)
+        acceleration: The acceleration in units/s^2
+        deceleration: The deceleration in units/s^2
+            Default acceleration
+
+    Returns:
+        ack (bool): True if the firmware accepted the command
+    """
+    global _controller
+    if _controller is None:
+        _controller = JigController(port).open()
 
-    with ser as com:
-        com.write(b'!' + packet)
-        line = com.read(1)
-        print(line.decode())
+    return _controller.set_speed(speed, acceleration, deceleration)
@@ -0,0 +1,108 @@
+"""Emulates the jig firmware on a pseudo-terminal, for testing without hardware
+
+The emulator parses the byte stream the same way PacketCom::poke() in jig/lib/PacketCom does:
+the start byte starts a new packet wherever it is received, the next 8 bytes are the packet,
+and the firmware answers A if the CRC is valid and N if it isn't.
+"""
+
+import os
+import pty
+import select
+import struct
+import threading
+import tty
+from time import sleep
+
+from defector.communication import ACK, NACK, START_BYTE, crc16
+
+# int16 speed, uint16 acceleration, uint16 deceleration, uint16 CRC
+PACKET = struct.Struct('<hHHH')
+
+
+class JigEmulator:
+    """A PacketCom firmware on the slave end of a pseudo-terminal
+
+    Attributes:
+        port: The device path to connect to, e.g. with JigController(emulator.port)
+        packets: List of the (speed, acceleration, deceleration) of the valid packets received
+        speed: The speed the jig is set to. Like the firmware, negative speeds spin forwards
+        rejected: The number of packets with an invalid CRC
+    """
+
+    def __init__(self, reply_delay=0):
+        """
+        Args:
+            reply_delay: Seconds the firmware takes to answer a packet
+        """
+        self.reply_delay = reply_delay
+        self.packets = []
+        self.speed = 0
+        self.rejected = 0
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._received = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='JigEmulator', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        packet = None
+        while self._running:
+            if not select.select([self._master], [], [], 0.05)[0]:
+                continue
+            try:
+                data = os.read(self._master, 64)
+            except OSError:
+                return
+
+            for byte in data:
+                if byte == START_BYTE[0]:
+                    packet = bytearray()
+                elif packet is not None:
+                    packet.append(byte)
+
+                if packet is not None and len(packet) == PACKET.size:
+                    self._receive(bytes(packet))
+                    packet = None
+
+    def _receive(self, packet):
+        speed, acceleration, deceleration, crc = PACKET.unpack(packet)
+        if self.reply_delay:
+            sleep(self.reply_delay)
+
+        valid = crc16(packet[:-2]) == crc
+        os.write(self._master, ACK if valid else NACK)
+
+        with self._received:
+            if valid:
+                self.packets.append((speed, acceleration, deceleration))
+                self.speed = abs(speed)
+            else:
+                self.rejected += 1
+            self._received.notify_all()
+
+    def wait_for(self, count, timeout=1):
+        """Wait until count packets are received, valid or not
+
+        Returns:
+            True if the packets were received before the timeout
+        """
+        with self._received:
+            return self._received.wait_for(lambda: len(self.packets) + self.rejected >= count, timeout)
+
+    def close(self):
+        """Stop the emulator and close the pseudo-terminal"""
+        self._running = False
+        self._thread.join()
+        os.close(self._slave)
+        os.close(self._master)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
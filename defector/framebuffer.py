@@ -0,0 +1,147 @@
+"""A preallocated ring buffer of camera frames
+"""
+
+import threading
+
+import numpy as np
+
+
+class FrameRingBuffer:
+    """Fixed capacity ring buffer of raw frames, with parallel arrays of frame metadata
+
+    All memory is allocated up front. The producer (the camera callback) copies every
+    frame into the next free slot, and consumers take the frames in order and release
+    the slots when they're done with them. If every slot is still in use when a frame
+    arrives, the frame is counted as an overflow instead of being stored.
+
+    Frames are identified by their sequence number, the number of frames stored before
+    them. The slot of a frame is its sequence number modulo the capacity.
+
+    Attributes:
+        frames: (capacity, *shape) array of frame data
+        frame_ids: The camera frame ID of each slot
+        complete: If the frame in each slot was received completely
+        timestamps: The camera timestamp of each slot
+        overflows: The number of frames that didn't fit in the buffer
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint8):
+        """
+        Args:
+            capacity: The number of frames the buffer holds
+            shape: The shape of a single frame
+            dtype: The data type of the frames
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity has to be at least 1, got {capacity}")
+
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.frames = np.zeros((capacity, ) + self.shape, dtype=dtype)
+        self.frame_ids = np.zeros(capacity, dtype=np.int64)
+        self.complete = np.zeros(capacity, dtype=bool)
+        self.timestamps = np.zeros(capacity, dtype=np.uint64)
+        self._released = np.zeros(capacity, dtype=bool)
+        self._condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        """Empty the buffer. Must not be called while frames are being added or consumed"""
+        with self._condition:
+            self._head = 0  # frames stored
+            self._next = 0  # frames handed to consumers
+            self._tail = 0  # frames released
+            self._released[:] = False
+            self.overflows = 0
+            self.closed = False
+
+    @property
+    def count(self):
+        """The number of frames stored since the last reset"""
+        return self._head
+
+    def __len__(self):
+        """The number of slots currently in use"""
+        return self._head - self._tail
+
+    def put(self, data, frame_id, timestamp=0, complete=True):
+        """Copy a frame into the next free slot
+
+        Only one thread may add frames.
+
+        Args:
+            data: The frame data, or None for frames without data
+            frame_id: The camera frame ID
+            timestamp: The camera timestamp
+            complete: If the frame was received completely. The data of incomplete frames isn't copied
+
+        Returns:
+            The sequence number of the frame, or None if the buffer was full
+        """
+        with self._condition:
+            if self._head - self._tail >= self.capacity:
+                self.overflows += 1
+                return None
+            seq = self._head
+
+        # The slot is free, and consumers can't see it until _head is advanced
+        slot = seq % self.capacity
+        if complete and data is not None:
+            np.copyto(self.frames[slot], data.reshape(self.shape), casting='no')
+        self.frame_ids[slot] = frame_id
+        self.timestamps[slot] = timestamp
+        self.complete[slot] = complete and data is not None
+        self._released[slot] = False
+
+        with self._condition:
+            self._head += 1
+            self._condition.notify_all()
+
+        return seq
+
+    def get(self, timeout=None):
+        """Take the next frame that hasn't been handed to a consumer
+
+        The frame has to be released with release() when the consumer is done with it.
+
+        Args:
+            timeout: Max seconds to wait for a frame. None waits until a frame arrives or the buffer is closed
+
+        Returns:
+            The sequence number of the frame, or None on timeout or if the buffer is closed and empty
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._next < self._head or self.closed, timeout):
+                return None
+            if self._next >= self._head:
+                return None
+
+            seq = self._next
+            self._next += 1
+            return seq
+
+    def slot(self, seq):
+        """Get the slot index of a sequence number"""
+        return seq % self.capacity
+
+    def frame(self, seq):
+        """Get a view of the data of a frame. Only valid until the frame is released"""
+        return self.frames[seq % self.capacity]
+
+    def release(self, seq):
+        """Give the slot of a frame back to the producer"""
+        with self._condition:
+            self._released[seq % self.capacity] = True
+            while self._tail < self._next and self._released[self._tail % self.capacity]:
+                self._released[self._tail % self.capacity] = False
+                self._tail += 1
+
+    def close(self):
+        """Wake up waiting consumers, get() returns None once all frames are taken"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def stored(self):
+        """Get the sequence numbers of all frames currently in the buffer, oldest first"""
+        return range(self._tail, self._head)
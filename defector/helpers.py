@@ -1,123 +1,147 @@
 """A collection of helper functions used for the main program
 """
 
-from typing import Optional
 from pathlib import Path
 from glob import glob
 
+import base64
+import json
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import cv2
 import numpy as np
-from scipy.spatial.distance import euclidean, cdist
-#from matplotlib import pyplot as plt
-
-from pymba import Vimba, VimbaException, Frame
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 
-# todo add more colours
-PIXEL_FORMATS_CONVERSIONS = {
-    'BayerRG8': cv2.COLOR_BAYER_RG2RGB,
-}
+from defector.calibration import CameraCalibration
+from defector.profiling import profiler
+#from matplotlib import pyplot as plt
 
 
-def display_frame(frame: Frame, delay: Optional[int] = 1) -> None:
-    """Displays the acquired frame.
+def get_plug_crop(frame, black_columns=None):
+    """Find the columns where the plug and the background end
 
     Args:
-        frame: The frame object to display.
-        delay: Display delay in milliseconds, use 0 for indefinite.
-            Default 1
+        frame: The rotated BGR frame
+        black_columns: The black pixel count of every column. Calculated if not given
+
+    Returns:
+        crop_params: (x1, y1, x2, y2) crop of the frame
     """
-    print('frame {}'.format(frame.data.frameID))
+    if black_columns is None:
+        black_columns = count_black_columns(frame)
 
-    # get a copy of the frame data
-    image = frame.buffer_data_numpy()
+    x, y = search_vertical(frame, 1, black_columns)
+    w, h = search_vertical(frame, -1, black_columns)
 
-    # convert colour space if desired
-    try:
-        image = cv2.cvtColor(image, PIXEL_FORMATS_CONVERSIONS[frame.pixel_format])
-    except KeyError:
-        pass
+    return x, y, w, h
 
-    # display image
-    cv2.imshow('Image', image)
-    cv2.waitKey(delay)
 
+def locate_plug(frame, max_black_ratio=1.50):
+    """Find the crop parameters of a rotated frame, if enough of it is still background
 
-def get_frame(frames=1, cam=0):
-    """Get a frame from a vimba camera
+    The frame is thresholded and projected onto its columns once, and both the
+    black ratio and the plug and background edges are found from that projection.
 
     Args:
-        frames (int): The amount of frames to get.
-            Default 1
-        cam: The index(int) or camera_id(str)
-            Default 0
+        frame: The rotated BGR frame
+        max_black_ratio: The percentage of black pixels allowed before the frame is cropped
 
     Returns:
-        list of images
-
-    Raises:
-        Stuff
+        crop_params: (x1, y1, x2, y2) crop of the frame, or None if no crop is needed
     """
+    black_columns = count_black_columns(frame)
 
-    frames = []
-    with Vimba() as vimba:
-        camera = vimba.camera(cam)
-        camera.open()
-
-        camera.arm('SingleFrame')
-
-        # capture a single frame, more than once if desired
-        for i in range(frames):
-            try:
-                frames.append(camera.acquire_frame())
-                display_frame(frames[i], 0)
-            except VimbaException as e:
-                # rearm camera upon frame timeout
-                if e.error_code == VimbaException.ERR_TIMEOUT:
-                    print(e)
-                    camera.disarm()
-                    camera.arm('SingleFrame')
-                else:
-                    raise
+    if check_for_black(frame, black_columns) > max_black_ratio:
+        return get_plug_crop(frame, black_columns)
 
-        camera.disarm()
-        camera.close()
-        return frames
+    return None
 
 
-def get_plug_crop(frame):
+ROI_SUFFIX = '.roi.json'
+ROI_THRESHOLD = 40
+SILHOUETTE_SCALE = 0.25
+ROI_BORDER = (255, 255, 255)
 
-    x, y = search_vertical(frame, 1)
-    w, h = search_vertical(frame, -1)
+# Remap tables of the transforms used by this process, by RoiTransform.key()
+_remap_tables = {}
+MAX_REMAP_TABLES = 8
 
-    return x, y, w, h
 
+def vial_silhouette(gray):
+    """Get a low resolution mask of the bright vial in a gray frame"""
+    small = cv2.resize(gray, None, fx=SILHOUETTE_SCALE, fy=SILHOUETTE_SCALE, interpolation=cv2.INTER_AREA)
+    return small > ROI_THRESHOLD
 
-transformation_matrix = None
-crop_size = None
-crop_params = None
 
+def roi_sidecar_path(path):
+    """Get the path of the RoiTransform saved next to a sequence folder or file
 
-def roi_crop(frame, first_run):
-    """ Takes an image and returns a cropped image
-        Crops frames to remove background
+    A folder and the sequence file converted from it share the sidecar, e.g. vial0 and
+    vial0.dfseq both use vial0.roi.json
+    """
+    path = Path(path)
+    return path.parent.joinpath((path.stem if path.is_file() else path.name) + ROI_SUFFIX)
 
-        Args:
-            img: An gray scale openCV image
 
-        Returns:
-            A cropped image
+class RoiTransform:
+    """The lens undistortion, rotation and crop that cut the vial out of a frame
+
+    apply() does all three in a single cv2.remap, with fixed-point tables that only cover
+    the pixels of the output. The tables are built on first use, and shared by the
+    transforms with the same key() in a process.
+
+    The transform only holds arrays and tuples, so it can be pickled and passed
+    to worker processes. It can be saved, and checked against the frames of a new
+    sequence with matches(), to skip finding the vial again for the same fixture.
     """
-    global transformation_matrix
-    global crop_size
-    global crop_params
 
-    if first_run:
-        first_run = False
+    def __init__(self, transformation_matrix, crop_size, crop_params=None, frame_shape=None, silhouette=None, calibration=None):
+        """
+        Args:
+            transformation_matrix: 3x3 perspective transform straightening the vial in the undistorted frame
+            crop_size: (width, height) of the straightened vial
+            crop_params: (x1, y1, x2, y2) crop removing the plug and background, or None
+            frame_shape: The shape of the frame the transform was found in
+            silhouette: vial_silhouette() of the frame the transform was found in
+            calibration: The CameraCalibration of the lens, or None to not undistort the frames
+        """
+        self.transformation_matrix = transformation_matrix
+        self.crop_size = crop_size
+        self.crop_params = crop_params
+        self.frame_shape = frame_shape
+        self.silhouette = silhouette
+        self.calibration = calibration
+        self._tables = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tables'] = None
+        return state
+
+    @classmethod
+    def from_frame(cls, frame, calibration=None):
+        """Find the transform of the vial in a frame
+
+        Args:
+            frame: A BGR frame of the vial
+            calibration: The CameraCalibration of the lens, or None to not undistort the frames
 
+        Returns:
+            RoiTransform of the vial
+        """
+        frame_shape = frame.shape
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        _, threshed_img = cv2.threshold(gray, 40, 255, cv2.THRESH_BINARY)
+        silhouette = vial_silhouette(gray)
+        if calibration is not None:
+            frame = calibration.undistort(frame)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        _, threshed_img = cv2.threshold(gray, ROI_THRESHOLD, 255, cv2.THRESH_BINARY)
         # find contours and get the external one
 
         kernel = np.ones((15, 15), np.uint8)
@@ -129,78 +153,320 @@ def roi_crop(frame, first_run):
         rect = cv2.minAreaRect(chosen_contour)
 
         # Get the transformation matrix and crop size for the vial in frame
-        transformation_matrix, crop_size = get_transform_params(frame, rect)
+        transform = cls(*get_transform_params(frame, rect))
 
         # Crop out the right side of the frame if over 2% of the frame is still background
-        rotated = cv2.warpPerspective(frame, transformation_matrix, crop_size, None, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT, (255, 255, 255))
-        if check_for_black(rotated) > 1.50:
-            crop_params = get_plug_crop(rotated)
+        transform.crop_params = locate_plug(transform.rotate(frame))
 
-    else:
-        rotated = cv2.warpPerspective(frame, transformation_matrix, crop_size, None, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT, (255, 255, 255))
+        transform.frame_shape = frame_shape
+        transform.silhouette = silhouette
+        transform.calibration = calibration
+        return transform
 
-    if crop_params is not None:
-        rotated = second_crop(rotated, crop_params)
+    def matches(self, frame, min_overlap=0.98):
+        """Check if the vial is still where the transform was found
 
-    return first_run, rotated
+        Compares the low resolution silhouette of the vial in the frame to the one the
+        transform was found in, which costs a fraction of finding the transform.
 
+        Args:
+            frame: A BGR frame of the vial
+            min_overlap: The min intersection over union of the silhouettes
 
-def second_crop(frame, crop_params):
-    tolerance = 5  # remove extra pixels to be sure
+        Returns:
+            True if the transform can be used for the frame
+        """
+        if self.silhouette is None or tuple(frame.shape) != tuple(self.frame_shape):
+            return False
+
+        silhouette = vial_silhouette(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        union = np.count_nonzero(silhouette | self.silhouette)
+        return union > 0 and np.count_nonzero(silhouette & self.silhouette) / union >= min_overlap
+
+    def to_dict(self):
+        """Convert the transform to a dict that can be written as JSON"""
+        silhouette = None
+        if self.silhouette is not None:
+            silhouette = {
+                'shape': list(self.silhouette.shape),
+                'bits': base64.b64encode(np.packbits(self.silhouette).tobytes()).decode('ascii'),
+            }
+
+        return {
+            'transformation_matrix': np.asarray(self.transformation_matrix).tolist(),
+            'crop_size': [int(v) for v in self.crop_size],
+            'crop_params': [int(v) for v in self.crop_params] if self.crop_params is not None else None,
+            'frame_shape': [int(v) for v in self.frame_shape] if self.frame_shape is not None else None,
+            'silhouette': silhouette,
+            'calibration': self.calibration.to_dict() if self.calibration is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a transform from the output of to_dict()"""
+        silhouette = None
+        if data.get('silhouette') is not None:
+            shape = data['silhouette']['shape']
+            bits = np.frombuffer(base64.b64decode(data['silhouette']['bits']), dtype=np.uint8)
+            silhouette = np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+        return cls(np.array(data['transformation_matrix'], dtype=np.float64),
+                   tuple(data['crop_size']),
+                   tuple(data['crop_params']) if data.get('crop_params') is not None else None,
+                   tuple(data['frame_shape']) if data.get('frame_shape') is not None else None,
+                   silhouette,
+                   CameraCalibration.from_dict(data['calibration']) if data.get('calibration') is not None else None)
+
+    def save(self, path):
+        """Write the transform to a JSON file
+
+        The file is replaced atomically, so parallel runs can share it.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as roi_file:
+            json.dump(self.to_dict(), roi_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a transform written by save()"""
+        with open(path) as roi_file:
+            return cls.from_dict(json.load(roi_file))
+
+    def rotate(self, frame):
+        """Straighten the vial in an undistorted frame, without cropping it"""
+        return cv2.warpPerspective(frame, self.transformation_matrix, self.crop_size, None, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT, ROI_BORDER)
+
+    def key(self):
+        """Get a hashable key identifying the output of apply()"""
+        return (
+            np.asarray(self.transformation_matrix, dtype=np.float64).tobytes(),
+            tuple(int(v) for v in self.crop_size),
+            tuple(int(v) for v in self.crop_params) if self.crop_params is not None else None,
+            None if self.calibration is None else (self.calibration.camera_matrix.tobytes(), self.calibration.dist_coeffs.tobytes()),
+        )
+
+    def source_points(self):
+        """Get the position in the raw frame of every pixel apply() outputs
+
+        Returns:
+            (height, width, 2) float64 array of the (x, y) positions
+        """
+        width, height = self.crop_size
+        columns = np.arange(width)
+        rows = np.arange(height)
+        if self.crop_params is not None:
+            # The pixels second_crop() keeps
+            x1, _, x2, y2 = self.crop_params
+            columns = columns[x1 + CROP_TOLERANCE:x2 - CROP_TOLERANCE]
+            rows = rows[0:y2]
+
+        points = np.stack(np.meshgrid(columns, rows), axis=-1).astype(np.float64)
+        if not points.size:
+            return points
+
+        points = cv2.perspectiveTransform(points.reshape(-1, 1, 2), np.linalg.inv(self.transformation_matrix))
+        if self.calibration is not None:
+            points = self.calibration.distort_points(points)
+        return points.reshape(len(rows), len(columns), 2)
+
+    def remap_tables(self):
+        """Get the fixed-point cv2.remap tables of apply()
+
+        Returns:
+            (map1, map2): The CV_16SC2 integer positions and CV_16UC1 interpolation table indices
+        """
+        if self._tables is None:
+            key = self.key()
+            if key not in _remap_tables:
+                if len(_remap_tables) >= MAX_REMAP_TABLES:
+                    _remap_tables.clear()
+                points = self.source_points().astype(np.float32)
+                if points.size:
+                    _remap_tables[key] = cv2.convertMaps(points[..., 0], points[..., 1], cv2.CV_16SC2)
+                else:
+                    _remap_tables[key] = (np.zeros(points.shape, np.int16), np.zeros(points.shape[:2], np.uint16))
+            self._tables = _remap_tables[key]
+        return self._tables
+
+    def apply(self, frame):
+        """Cut the vial out of a frame
+
+        Args:
+            frame: A BGR frame of the vial
+
+        Returns:
+            The undistorted, rotated and cropped frame
+        """
+        map1, map2 = self.remap_tables()
+        if not map2.size:
+            return np.zeros(map2.shape + frame.shape[2:], frame.dtype)
+
+        return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, None, cv2.BORDER_CONSTANT, ROI_BORDER)
+
+
+class RoiCache:
+    """Finds the RoiTransform of sequences, reusing the last one while it matches their frames
+
+    With a path, the transform is loaded from and saved to that file, so later runs skip
+    finding the vial. Use roi_sidecar_path() for a file per sequence, or one file per
+    camera and fixture.
+
+    Attributes:
+        path: The file the transform is saved in, or None
+        transform: The last RoiTransform
+        found: The number of times the transform was found in a frame instead of reused
+    """
+
+    def __init__(self, path=None, min_overlap=0.98, calibration=None):
+        """
+        Args:
+            path: The file to load the transform from and save it to. Default: Keep it in memory
+            min_overlap: See RoiTransform.matches()
+            calibration: The CameraCalibration of the lens. Saved transforms of other calibrations aren't reused
+        """
+        self.path = Path(path) if path is not None else None
+        self.min_overlap = min_overlap
+        self.calibration = calibration
+        self.transform = None
+        self.found = 0
+
+    def load(self):
+        """Load the saved transform, if there is a readable one"""
+        if self.path is None or not self.path.is_file():
+            return None
+        try:
+            return RoiTransform.load(self.path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def transform_for(self, frame):
+        """Get the transform of the vial in a frame
+
+        The cached transform is used if it matches the frame. Otherwise the transform is
+        found in the frame, and saved.
+
+        Args:
+            frame: A BGR frame of the vial, usually the first of a sequence
+
+        Returns:
+            The RoiTransform of the frame
+        """
+        if self.transform is None:
+            self.transform = self.load()
 
+        if self.transform is not None and self.transform.calibration == self.calibration and self.transform.matches(frame, self.min_overlap):
+            return self.transform
+
+        self.transform = RoiTransform.from_frame(frame, self.calibration)
+        self.found += 1
+        if self.path is not None:
+            self.transform.save(self.path)
+        return self.transform
+
+
+roi_transform = None
+
+
+def roi_crop(frame, first_run):
+    """ Takes an image and returns a cropped image
+        Crops frames to remove background
+
+        The transform found on the first run is shared by all calls. Use a
+        RoiTransform per image sequence when processing more than one sequence.
+
+        Args:
+            img: An gray scale openCV image
+            first_run: Find the transform of the vial in this frame
+
+        Returns:
+            first_run: False
+            A cropped image
+    """
+    global roi_transform
+
+    if first_run or roi_transform is None:
+        first_run = False
+        roi_transform = RoiTransform.from_frame(frame)
+
+    return first_run, roi_transform.apply(frame)
+
+
+CROP_TOLERANCE = 5  # remove extra pixels to be sure
+
+
+def second_crop(frame, crop_params):
     x1, y1, x2, y2 = crop_params
 
-    cropped = frame[0:y2, x1 + tolerance:x2 - tolerance]
+    cropped = frame[0:y2, x1 + CROP_TOLERANCE:x2 - CROP_TOLERANCE]
 
     return cropped
 
 
-def check_for_black(frame):
+def count_black_columns(frame, thresh=20):
+    """Count the black pixels in every column of a frame
+
+    Args:
+        frame: A BGR frame
+        thresh: The gray level at or below which a pixel is considered black
+
+    Returns:
+        black_columns: Array with the number of black pixels in each column
+    """
     gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    _, threshed = cv2.threshold(gray, 20, 255, cv2.THRESH_BINARY)
+    _, threshed = cv2.threshold(gray, thresh, 1, cv2.THRESH_BINARY)
+
+    not_black = cv2.reduce(threshed, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)[0]
 
-    not_black_count = cv2.countNonZero(threshed)
+    return gray.shape[0] - not_black
 
-    rows, cols = gray.shape
+
+def check_for_black(frame, black_columns=None):
+    """Get the percentage of black pixels in a frame
+
+    Args:
+        frame: A BGR frame
+        black_columns: The black pixel count of every column. Calculated if not given
+
+    Returns:
+        black_ratio: The percentage of black pixels
+    """
+    if black_columns is None:
+        black_columns = count_black_columns(frame)
+
+    rows, cols = frame.shape[:2]
     all_pixels = rows * cols
 
-    black_count = all_pixels - not_black_count
+    black_count = int(black_columns.sum())
     black_ratio = (black_count / all_pixels) * 100
 
     return black_ratio
 
 
-def search_vertical(frame, direction=-1):
-
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    _, threshed = cv2.threshold(gray, 20, 255, cv2.THRESH_BINARY)
+def search_vertical(frame, direction=-1, black_columns=None):
+    """Find the first column with less than 5 black pixels
 
-    rows, cols = gray.shape
-    crop_row = rows
+    Args:
+        frame: A BGR frame
+        direction: Search from the left (1) or from the right (-1)
+        black_columns: The black pixel count of every column. Calculated if not given
 
+    Returns:
+        crop_col, crop_row: The column found, or 0 if none, and the number of rows
+    """
     if direction not in [-1, 1]:
         raise ValueError("direction has to be -1 or 1")
 
+    if black_columns is None:
+        black_columns = count_black_columns(frame)
+
+    crop_row = frame.shape[0]
+
     crop_col = 0
-    for col in range(cols)[::direction]:
-        vertical_pixels = []
-        for row in range(rows):
-            vertical_pixels.append(threshed[row, col])
-
-        non_black_vertical = np.count_nonzero(vertical_pixels)
-        black_vertical = len(vertical_pixels) - non_black_vertical
-
-        if black_vertical < 5:
-            crop_col = col
-            # start_point = (0, crop_col)
-            # end_point = (crop_row, col)
-
-            #            image = cv2.line(frame, start_point, end_point, (0, 0, 255), 10)
-            #            cv2.imshow("image", image)
-            #            cv2.waitKey(0)
-            break
-        else:
-            pass
+    candidates = np.flatnonzero(black_columns < 5)
+    if len(candidates):
+        crop_col = int(candidates[0] if direction == 1 else candidates[-1])
 
     return crop_col, crop_row
 
@@ -221,7 +487,7 @@ def get_transform_params(img, rect):
 
     transformation_matrix = cv2.getPerspectiveTransform(src_pts, dst_pts)
 
-    return transformation_matrix, (width, height)
+    return transformation_matrix, (int(width), int(height))
 
 
 def order_points(pts):
@@ -280,136 +546,734 @@ def get_centroid(contours):
     return c_all
 
 
-def find_contours(frame):
+# The features of the contours of a frame, one record per contour. bbox is (x, y, width, height),
+# and index is the position of the contour in the list of contours of the frame
+CONTOUR_FEATURES = np.dtype([
+    ('centroid', np.int64, (2, )),
+    ('area', np.float64),
+    ('perimeter', np.float64),
+    ('bbox', np.int32, (4, )),
+    ('index', np.int64),
+])
 
-    kernel_size = 25
-    ca = background_equalization(frame, kernel_size)
 
-    _, binary = cv2.threshold(ca, 7, 255, cv2.THRESH_BINARY)
+def contour_features(contours):
+    """Compute the features of every contour of a frame
 
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
-    opening = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    Every contour is measured once: the centroid, rounded like get_centroid(), and the
+    area come from a single cv2.moments call.
+
+    Args:
+        contours: List of the contours of a frame
+
+    Returns:
+        Structured array of CONTOUR_FEATURES, in the order of the contours
+    """
+    features = np.zeros(len(contours), dtype=CONTOUR_FEATURES)
+    for idx, contour in enumerate(contours):
+        M = cv2.moments(contour)
+        if M["m00"] != 0:
+            features['centroid'][idx] = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+        features['area'][idx] = M["m00"]
+        features['perimeter'][idx] = cv2.arcLength(contour, True)
+        features['bbox'][idx] = cv2.boundingRect(contour)
+    features['index'] = np.arange(len(contours))
+    return features
+
+
+def as_features(detections):
+    """Get the feature table of detections given as a feature table or a list of contours"""
+    if isinstance(detections, np.ndarray) and detections.dtype == CONTOUR_FEATURES:
+        return detections
+    return contour_features(detections)
+
+
+class ContourDetector:
+    """Finds the dark particles in ROI frames, reusing its kernels and image buffers
+
+    The frame is converted to gray, a black hat transform brings out the dark spots, and
+    the result is thresholded and opened before the contours are found. The gray, black
+    hat, binary and opened images are allocated for the first frame, and written through
+    the dst arguments of OpenCV for the following frames of the same size.
+
+    With more than one thread, the frame is split into a horizontal strip per thread, and
+    the strips are converted, black hat transformed, thresholded and opened on a thread
+    pool of the detector. Every strip is padded by the reach of the kernels, so the black
+    hat and opened images are bit identical to the ones of a single thread. The pool is
+    independent of the threads OpenCV uses inside every call, see cv2.setNumThreads().
+
+    A detector is only used by one thread at a time. Pickled detectors are shared through
+    shared_detector() when unpickled, so worker processes keep their buffers between frames.
+
+    Attributes:
+        sequential: If the detector has to see the frames of a sequence in order, on a
+            single thread. The black hat only depends on the frame
+    """
+
+    sequential = False
+    equalize_stage = 'black_hat'
+
+    def __init__(self, black_hat_size=25, threshold=7, opening_size=2, max_contour_length=150, max_contour_area=200, threads=1):
+        """
+        Args:
+            black_hat_size: Side length of the square black hat kernel. Larger than the particles
+            threshold: Min black hat response of a particle pixel
+            opening_size: Side length of the square opening kernel removing single pixel noise
+            max_contour_length: Contours with more points, and an area over max_contour_area, are removed
+            max_contour_area: See max_contour_length
+            threads: The number of strips processed in parallel
+        """
+        self.black_hat_size = black_hat_size
+        self.threshold = threshold
+        self.opening_size = opening_size
+        self.max_contour_length = max_contour_length
+        self.max_contour_area = max_contour_area
+        self.threads = threads
+
+        self.black_hat_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (black_hat_size, black_hat_size))
+        self.opening_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (opening_size, opening_size))
+        # The closing of the black hat reaches black_hat_size - 1 pixels, the opening opening_size - 1 more
+        self.padding = black_hat_size + opening_size
+
+        self.shape = None
+        self.gray = self.black_hat = self.binary = self.opened = None
+        self.strips = []
+        self.executor = None
+
+    def params(self):
+        """Get the arguments the detector was created with"""
+        return (self.black_hat_size, self.threshold, self.opening_size, self.max_contour_length, self.max_contour_area, self.threads)
+
+    def __reduce__(self):
+        return shared_detector, (type(self), self.params())
+
+    def allocate(self, shape):
+        """Allocate the buffers for frames of shape (height, width)"""
+        self.shape = shape
+        self.gray = np.empty(shape, np.uint8)
+        self.black_hat = np.empty(shape, np.uint8)
+        self.binary = np.empty(shape, np.uint8)
+        self.opened = np.empty(shape, np.uint8)
+
+        self.strips = self.split(shape) if self.threads > 1 else []
+        if self.threads > 1 and self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix=type(self).__name__)
+
+    def split(self, shape):
+        """Split frames of shape (height, width) into a padded horizontal strip per thread"""
+        strips = []
+        bounds = np.linspace(0, shape[0], self.threads + 1).round().astype(int)
+        for y1, y2 in zip(bounds[:-1], bounds[1:]):
+            if y1 == y2:
+                continue
+            top, bottom = max(0, y1 - self.padding), min(shape[0], y2 + self.padding)
+            # The rows of the strip, the padded rows, and the gray, black hat, binary and opened buffers of the padded rows
+            strips.append((y1, y2, top, bottom, [np.empty((bottom - top, shape[1]), np.uint8) for _ in range(4)]))
+        return strips
+
+    def reset(self):
+        """Forget the frames of the previous sequence. The black hat doesn't keep any"""
+
+    def process_strip(self, frame, strip):
+        """Convert, black hat transform, threshold and open a strip of a BGR or gray frame
+
+        The rows of the strip, without the padding, are written to the black hat and opened images.
+        """
+        y1, y2, top, bottom, (gray, black_hat, binary, opened) = strip
+        if frame.ndim == 3:
+            cv2.cvtColor(frame[top:bottom], cv2.COLOR_BGR2GRAY, dst=gray)
+        else:
+            np.copyto(gray, frame[top:bottom])
+
+        cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, self.black_hat_kernel, dst=black_hat)
+        cv2.threshold(black_hat, self.threshold, 255, cv2.THRESH_BINARY, dst=binary)
+        cv2.morphologyEx(binary, cv2.MORPH_OPEN, self.opening_kernel, dst=opened)
+
+        self.black_hat[y1:y2] = black_hat[y1 - top:y2 - top]
+        self.opened[y1:y2] = opened[y1 - top:y2 - top]
+
+    def equalize(self, frame):
+        """Apply the black hat transform to a BGR or gray frame
+
+        Returns:
+            The black hat image. It's overwritten by the next frame
+        """
+        if frame.shape[:2] != self.shape:
+            self.allocate(frame.shape[:2])
+
+        gray = frame
+        if frame.ndim == 3:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        return cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, self.black_hat_kernel, dst=self.black_hat)
+
+    def detect(self, frame):
+        """Find the contours of the particles in a frame
+
+        Args:
+            frame: A BGR or gray ROI frame
+
+        Returns:
+            List of the contours
+        """
+        if frame.shape[:2] != self.shape:
+            self.allocate(frame.shape[:2])
+
+        if self.strips:
+            with profiler.stage('strips'):
+                # list() waits for the strips, and raises their errors
+                list(self.executor.map(partial(self.process_strip, frame), self.strips))
+        else:
+            with profiler.stage(self.equalize_stage):
+                black_hat = self.equalize(frame)
+
+            with profiler.stage('threshold'):
+                cv2.threshold(black_hat, self.threshold, 255, cv2.THRESH_BINARY, dst=self.binary)
+                cv2.morphologyEx(self.binary, cv2.MORPH_OPEN, self.opening_kernel, dst=self.opened)
+
+        with profiler.stage('find_contours'):
+            contours, hierarchy = cv2.findContours(self.opened, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+
+            # Remove large contours
+            return [c for c in contours if len(c) <= self.max_contour_length or cv2.contourArea(c) <= self.max_contour_area]
+
+
+class MotionDetector(ContourDetector):
+    """Finds the dark particles moving against the background of the recent frames
+
+    The gray ROI frames are kept in a ring of the last history + distance frames. In
+    'median' mode the background is the per pixel median of the history frames ending
+    distance frames before the current one, and the particles are the pixels that are
+    more than threshold grey levels darker than the background. Static defects like
+    scratches are part of the background, so they're removed before the contours are
+    found. With history 1 this is the plain difference to the frame distance frames back.
+
+    In 'mog2' mode the background is the cv2.BackgroundSubtractorMOG2 model learned from
+    the last history frames, and threshold is the min distance to the model in standard
+    deviations. distance isn't used.
+
+    There's no background for the first distance frames of a sequence, and no contours
+    are found in them. The detector has to see the frames of a sequence in order, and
+    reset() has to be called before a new sequence.
+    """
+
+    sequential = True
+    equalize_stage = 'background'
+    BACKGROUNDS = ('median', 'mog2')
+
+    def __init__(self, history=5, distance=1, threshold=7, background='median', opening_size=2, max_contour_length=150, max_contour_area=200):
+        """
+        Args:
+            history: The number of frames the background is made of
+            distance: The number of frames between the last frame of the background and the current one
+            threshold: Min difference to the background of a particle pixel
+            background: 'median' or 'mog2'
+            opening_size: Side length of the square opening kernel removing single pixel noise
+            max_contour_length: Contours with more points, and an area over max_contour_area, are removed
+            max_contour_area: See max_contour_length
+
+        Raises:
+            ValueError: If background isn't one of BACKGROUNDS, or history or distance is below 1
+        """
+        if background not in self.BACKGROUNDS:
+            raise ValueError(f"Unknown background {background!r}, use one of {', '.join(self.BACKGROUNDS)}")
+        if history < 1 or distance < 1:
+            raise ValueError(f"history and distance have to be at least 1, got {history} and {distance}")
+
+        self.history = history
+        self.distance = distance
+        self.background = background
+        super().__init__(threshold=threshold, opening_size=opening_size, max_contour_length=max_contour_length, max_contour_area=max_contour_area)
+        self.reset()
+
+    def params(self):
+        return (self.history, self.distance, self.threshold, self.background, self.opening_size, self.max_contour_length, self.max_contour_area)
+
+    def __reduce__(self):
+        # The frames and the background model aren't pickled, the copy starts a new sequence
+        return MotionDetector, self.params()
+
+    def allocate(self, shape):
+        super().allocate(shape)
+        self.ring = np.empty((self.history + self.distance, ) + tuple(shape), np.uint8)
+        # Sorted copies of the background frames, and a spare for swapping
+        self.sorted = [np.empty(shape, np.uint8) for _ in range(self.history + 1)]
+        self.reset()
+
+    def reset(self):
+        """Forget the frames of the previous sequence"""
+        self.count = 0
+        self.subtractor = None
+        if self.background == 'mog2':
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(self.history, self.threshold**2, detectShadows=False)
+
+    def median(self, frames):
+        """Get the per pixel median of gray frames
+
+        The frames are sorted per pixel by an odd-even transposition network of cv2.min and
+        cv2.max, which is far faster than numpy for a few frames. For an even number of
+        frames the lower of the two middle values is used.
+
+        Returns:
+            The median image. It's overwritten by the next call
+        """
+        stack = self.sorted[:len(frames)]
+        spare = self.sorted[len(frames)]
+        for buffer, frame in zip(stack, frames):
+            np.copyto(buffer, frame)
+
+        for step in range(len(stack)):
+            for i in range(step % 2, len(stack) - 1, 2):
+                cv2.min(stack[i], stack[i + 1], dst=spare)
+                cv2.max(stack[i], stack[i + 1], dst=stack[i + 1])
+                stack[i], spare = spare, stack[i]
+
+        self.sorted[:len(frames) + 1] = stack + [spare]
+        return stack[(len(stack) - 1) // 2]
+
+    def equalize(self, frame):
+        """Add a BGR or gray frame to the ring, and get its difference to the background
+
+        Returns:
+            The difference image, with the moving particles bright. It's overwritten by the next frame
+        """
+        if frame.shape[:2] != self.shape:
+            self.allocate(frame.shape[:2])
+
+        gray = frame
+        if frame.ndim == 3:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        if self.subtractor is not None:
+            self.count += 1
+            return self.subtractor.apply(gray, self.black_hat)
+
+        np.copyto(self.ring[self.count % len(self.ring)], gray)
+        self.count += 1
+
+        # The frames from distance to distance + history - 1 frames back, as far as they exist
+        frames = [self.ring[(self.count - 1 - back) % len(self.ring)] for back in range(self.distance, min(self.count, self.distance + self.history))]
+        if not frames:
+            self.black_hat.fill(0)
+            return self.black_hat
+
+        # The particles are darker than the background
+        return cv2.subtract(self.median(frames), gray, dst=self.black_hat)
+
+
+class PyramidDetector(ContourDetector):
+    """Finds the dark particles coarse to fine, only looking at the full resolution near candidates
+
+    The gray frame is halved levels times, and the black hat, with the kernel scaled down
+    to match, and the threshold run on the small frame to find the candidates. The ROI is
+    split into square blocks of block_size pixels, and the full resolution black hat,
+    threshold and opening only run in windows around the blocks that contain candidates,
+    padded by the reach of the kernels. The opened image in those blocks is the same as the
+    one of a ContourDetector, and it's empty everywhere else. The contours are found in the
+    full resolution opened image, so their coordinates are full resolution frame coordinates.
+
+    Particles that are too faint at the coarse level are missed, and contours reaching out
+    of the blocks are cut off. Compare the contours to the ones of a ContourDetector with
+    synthetic.match_centroids() to measure it. The windows are only less work than the
+    whole frame when the candidates cover a small part of it.
+
+    With more than one thread, the windows are processed on the thread pool of the detector
+    instead of strips of the frame.
+    """
+
+    def __init__(self, black_hat_size=25, threshold=7, opening_size=2, max_contour_length=150, max_contour_area=200, levels=2, coarse_threshold=None, block_size=64, threads=1):
+        """
+        Args:
+            black_hat_size: Side length of the square black hat kernel. Larger than the particles
+            threshold: Min black hat response of a particle pixel
+            opening_size: Side length of the square opening kernel removing single pixel noise
+            max_contour_length: Contours with more points, and an area over max_contour_area, are removed
+            max_contour_area: See max_contour_length
+            levels: The number of times the frame is halved for finding the candidates
+            coarse_threshold: Min black hat response of a candidate pixel in the small frame. Default: threshold
+            block_size: Side length of the blocks, in full resolution pixels. A multiple of 2**levels
+            threads: The number of windows processed in parallel
+        """
+        super().__init__(black_hat_size, threshold, opening_size, max_contour_length, max_contour_area, threads)
+        self.levels = levels
+        self.coarse_threshold = coarse_threshold
+        self.block_size = block_size
+        self.scale = 2**levels
+        coarse_size = max(3, round(black_hat_size / self.scale) | 1)
+        self.coarse_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (coarse_size, coarse_size))
+
+    def params(self):
+        return (self.black_hat_size, self.threshold, self.opening_size, self.max_contour_length, self.max_contour_area, self.levels, self.coarse_threshold, self.block_size, self.threads)
+
+    def split(self, shape):
+        """The windows are processed in parallel instead of strips"""
+        return []
+
+    def allocate(self, shape):
+        super().allocate(shape)
+        # Halving sizes that divide evenly takes the fast path of INTER_AREA
+        self.pyramid = []
+        height, width = shape
+        for _ in range(self.levels):
+            height, width = height // 2, width // 2
+            self.pyramid.append(np.empty((height, width), np.uint8))
+        self.coarse = np.empty((height, width), np.uint8)
+        self.candidates = np.empty((height, width), np.uint8)
+
+        block = self.block_size // self.scale
+        self.blocks = np.zeros((-(-height // block) * block, -(-width // block) * block), bool)
+
+    def find_candidates(self, gray):
+        """Get the mask of the candidates of a gray frame, at the coarse level"""
+        image = gray
+        for level in self.pyramid:
+            height, width = level.shape
+            cv2.resize(image[:2 * height, :2 * width], (width, height), dst=level, interpolation=cv2.INTER_AREA)
+            image = level
+
+        cv2.morphologyEx(image, cv2.MORPH_BLACKHAT, self.coarse_kernel, dst=self.coarse)
+        threshold = self.threshold if self.coarse_threshold is None else self.coarse_threshold
+        cv2.threshold(self.coarse, threshold, 255, cv2.THRESH_BINARY, dst=self.candidates)
+        # Grow the candidates by a coarse pixel, to include the faint edges of the particles
+        return cv2.dilate(self.candidates, None, dst=self.candidates)
+
+    def padded_area(self, window):
+        """Get the area of a (x1, y1, x2, y2) window in blocks, in pixels with the padding"""
+        return ((window[2] - window[0]) * self.block_size + 2 * self.padding) * ((window[3] - window[1]) * self.block_size + 2 * self.padding)
+
+    def merge_blocks(self, active):
+        """Merge the blocks with candidates into windows
+
+        Blocks in a row closer than the padding are merged, as their padded windows would
+        overlap. A run of blocks extends a window of the row above down to it, if that's
+        less work than two windows.
+
+        Args:
+            active: (rows, columns) bool array of the blocks with candidates
+
+        Returns:
+            List of (x1, y1, x2, y2) windows, in blocks
+        """
+        gap = 1 + 2 * self.padding // self.block_size
+        windows = []
+        above = []
+        for row, row_active in enumerate(active):
+            columns = np.flatnonzero(row_active)
+            runs = np.split(columns, np.flatnonzero(np.diff(columns) > gap) + 1) if len(columns) else []
+
+            current = []
+            for run in runs:
+                window = [int(run[0]), row, int(run[-1]) + 1, row + 1]
+                for other in above:
+                    merged = [min(other[0], window[0]), other[1], max(other[2], window[2]), row + 1]
+                    if other[3] == row and self.padded_area(merged) <= self.padded_area(other) + self.padded_area(window):
+                        other[:] = merged
+                        window = other
+                        break
+                else:
+                    windows.append(window)
+                current.append(window)
+            above = current
+        return windows
+
+    def windows(self, frame):
+        """Find the windows around the candidates in a BGR or gray frame
+
+        Returns:
+            List of (x1, y1, x2, y2) windows in full resolution coordinates, without the padding
+        """
+        if frame.shape[:2] != self.shape:
+            self.allocate(frame.shape[:2])
+
+        gray = frame
+        if frame.ndim == 3:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        candidates = self.find_candidates(gray)
+        self.blocks[:candidates.shape[0], :candidates.shape[1]] = candidates
+        block = self.block_size // self.scale
+        rows, columns = self.blocks.shape[0] // block, self.blocks.shape[1] // block
+        active = self.blocks.reshape(rows, block, columns, block).any(axis=(1, 3))
+
+        # The last blocks also cover the pixels the coarse level leaves out
+        height, width = self.shape
+        return [(x1 * self.block_size, y1 * self.block_size, width if x2 == columns else min(width, x2 * self.block_size), height if y2 == rows else min(height, y2 * self.block_size))
+                for x1, y1, x2, y2 in self.merge_blocks(active)]
+
+    def process_window(self, gray, window):
+        """Black hat transform, threshold and open a (x1, y1, x2, y2) window of a gray frame
+
+        The window, without the padding, is written to the opened image. Overlapping windows
+        write the same values where they overlap.
+        """
+        x1, y1, x2, y2 = window
+        height, width = self.shape
+        # Pad the window, as far as the frame goes
+        top, left = min(y1, self.padding), min(x1, self.padding)
+        bottom, right = min(height, y2 + self.padding), min(width, x2 + self.padding)
+
+        black_hat = cv2.morphologyEx(gray[y1 - top:bottom, x1 - left:right], cv2.MORPH_BLACKHAT, self.black_hat_kernel)
+        _, binary = cv2.threshold(black_hat, self.threshold, 255, cv2.THRESH_BINARY)
+        opened = cv2.morphologyEx(binary, cv2.MORPH_OPEN, self.opening_kernel)
+        self.opened[y1:y2, x1:x2] = opened[top:top + y2 - y1, left:left + x2 - x1]
+
+    def detect(self, frame):
+        """Find the contours of the particles in a frame
+
+        Args:
+            frame: A BGR or gray ROI frame
+
+        Returns:
+            List of the contours, in frame coordinates
+        """
+        with profiler.stage('coarse'):
+            windows = self.windows(frame)
+
+        gray = self.gray if frame.ndim == 3 else frame
+        self.opened.fill(0)
+        with profiler.stage('windows'):
+            if self.executor is not None and len(windows) > 1:
+                # list() waits for the windows, and raises their errors
+                list(self.executor.map(partial(self.process_window, gray), windows))
+            else:
+                for window in windows:
+                    self.process_window(gray, window)
+
+        with profiler.stage('find_contours'):
+            contours, hierarchy = cv2.findContours(self.opened, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+
+            # Remove large contours
+            return [c for c in contours if len(c) <= self.max_contour_length or cv2.contourArea(c) <= self.max_contour_area]
+
+
+_contour_detectors = threading.local()
+
+
+def shared_detector(cls, params):
+    """Get the detector of a class with these arguments, shared by all calls from this thread"""
+    detectors = _contour_detectors.__dict__.setdefault('detectors', {})
+    key = (cls, ) + tuple(params)
+    if key not in detectors:
+        detector = cls(*params)
+        # Share the detector between the calls with and without the default arguments
+        detectors[key] = detectors.setdefault((cls, ) + detector.params(), detector)
+    return detectors[key]
+
+
+def shared_contour_detector(*params):
+    """Get the ContourDetector with these arguments, shared by all calls from this thread"""
+    return shared_detector(ContourDetector, params)
+
+
+DETECTIONS = ('black_hat', 'pyramid') + MotionDetector.BACKGROUNDS
+
+
+def create_detector(detection='black_hat', threshold=7, black_hat_size=25, history=5, distance=1, pyramid_levels=2, threads=1):
+    """Create the detector of a detection mode
+
+    Args:
+        detection: 'black_hat' for a ContourDetector, 'pyramid' for a PyramidDetector, or the
+            background of a MotionDetector
+        threshold: Min black hat response, or difference to the background, of a particle pixel
+        black_hat_size: Side length of the black hat kernel
+        history: The number of frames in the background of a MotionDetector
+        distance: The number of frames between the background of a MotionDetector and the current frame
+        pyramid_levels: The number of times a PyramidDetector halves the frames
+        threads: The number of strips a ContourDetector, or windows a PyramidDetector, processes
+            in parallel. MotionDetectors don't use it
+
+    Returns:
+        The ContourDetector, PyramidDetector or MotionDetector
+    """
+    if detection == 'black_hat':
+        return ContourDetector(black_hat_size, threshold, threads=threads)
+    if detection == 'pyramid':
+        return PyramidDetector(black_hat_size, threshold, levels=pyramid_levels, threads=threads)
+    return MotionDetector(history, distance, threshold, detection)
+
+
+def find_contours(frame, draw=True, detector=None):
+    """Find the contours of the particles in a ROI frame
+
+    Args:
+        frame: A BGR ROI frame
+        draw: Draw the centroids of the contours on the frame
+        detector: The ContourDetector to use. Default: The shared one with the default arguments
+
+    Returns:
+        contours, frame
+    """
+    if detector is None:
+        detector = shared_contour_detector()
 
     # blobbed = blob_detection(closing)
 
     # Find Canny edges
     # edged = cv2.Canny(closing, 120, 255)
 
-    contours, hierarchy = cv2.findContours(opening, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-
-    for idx, c in enumerate(contours):
-        if len(c) > 150:
-            if cv2.contourArea(c) > 200:
-                del contours[idx]
+    contours = detector.detect(frame)
 
     # cv2.drawContours(frame, contours, -1, (0, 0, 255), 2)
 
-    # loop over the contours
-    for i, c in enumerate(contours):
+    if draw:
+        draw_centroids(frame, contour_features(contours)['centroid'])
 
-        centroid = get_centroid(c)
+    return contours, frame
 
-        # draw the  center of the shape on the image
-        cv2.circle(frame, (centroid[0][0], centroid[1][0]), 1, (255, 0, 0), 2)
 
-    return contours, frame
+def draw_centroids(frame, centroids):
+    """Draw the center of every contour on a frame
 
+    Args:
+        frame: The BGR frame to draw on
+        centroids: (N, 2) array of the centroids
+    """
+    for x, y in centroids:
+        cv2.circle(frame, (int(x), int(y)), 1, (255, 0, 0), 2)
 
-# [[x,y], instances, found(bool)]
-reference_points = None
 
+class StationaryFilter:
+    """Removes contours that don't move more than thresh over interval frames
 
-class ReferencePoint:
-    def __init__(self, point, area=0):
-        self.point = point
-        self.life = 0
-        self.skipped_frames = 0
-        self.found = False
-        self.area = area
+    Every contour centroid that isn't within thresh of an existing reference point
+    becomes a new reference point. A reference point that has been matched for
+    interval frames marks the contours matching it as stationary, and a reference
+    point that hasn't been matched for more than max_skipped_frames is discarded.
 
+    The reference points are kept in arrays and matched against all centroids of
+    a frame with a single KD-tree radius query. All state is kept in the instance,
+    so one filter is needed per image sequence.
+    """
 
-reference_points = None
+    def __init__(self, thresh=0.5, interval=10, max_skipped_frames=1, max_reference_points=100):
+        """
+        Args:
+            thresh: Max distance a contour can move while still being considered stationary
+            interval: The number of concecutive frames it has to be stationary for
+            max_skipped_frames: The number of frames a reference point can go unmatched before it's discarded
+            max_reference_points: The max number of reference points to keep track of
+        """
+        self.thresh = thresh
+        self.interval = interval
+        self.max_skipped_frames = max_skipped_frames
+        self.max_reference_points = max_reference_points
+        self.reset()
+
+    def reset(self):
+        """Forget all reference points"""
+        self.points = None
+        self.life = np.zeros(0, dtype=np.int64)
+        self.skipped_frames = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return 0 if self.points is None else len(self.points)
+
+    def match(self, centroids):
+        """Match the centroids of a frame against the reference points
+
+        Args:
+            centroids: (N, 2) array of contour centroids
 
+        Returns:
+            stationary: (N,) boolean mask of the centroids considered stationary
+        """
+        centroids = np.asarray(centroids, dtype=float).reshape(-1, 2)
+        stationary = np.zeros(len(centroids), dtype=bool)
+
+        # If we don't have any history, take these as reference points
+        if self.points is None:
+            self._add_points(centroids)
+            return stationary
+
+        # Get all (centroid, reference point) pairs within <thresh> of each other
+        if len(centroids) and len(self.points):
+            pairs = cKDTree(centroids).sparse_distance_matrix(cKDTree(self.points), self.thresh, output_type='ndarray')
+            idx_c, idx_rp = pairs['i'], pairs['j']
+        else:
+            idx_c = idx_rp = np.zeros(0, dtype=np.int64)
+
+        # A reference point gains one life per centroid matching it. Centroids are visited in order,
+        # so the life seen by a centroid counts the matches of the centroids before it
+        order = np.lexsort((idx_c, idx_rp))
+        idx_c, idx_rp = idx_c[order], idx_rp[order]
+        first = np.searchsorted(idx_rp, idx_rp)
+        life = self.life[idx_rp] + np.arange(len(idx_rp)) - first + 1
+        stationary[idx_c[life >= self.interval]] = True
+
+        found = np.zeros(len(self.points), dtype=bool)
+        found[idx_rp] = True
+        self.life += np.bincount(idx_rp, minlength=len(self.points))
+        self.skipped_frames[found] = 0
+
+        # Assign any unassigned centroids as new reference points
+        unassigned = np.ones(len(centroids), dtype=bool)
+        unassigned[idx_c] = False
+        new_points = centroids[unassigned][:max(self.max_reference_points - len(self.points), 0)]
+        self._add_points(new_points)
+        found = np.concatenate((found, np.zeros(len(new_points), dtype=bool)))
+
+        # Remove any reference points that haven't been found for <max_skipped_frames> frames
+        self.skipped_frames[~found] += 1
+        keep = self.skipped_frames <= self.max_skipped_frames
+        self.points = self.points[keep]
+        self.life = self.life[keep]
+        self.skipped_frames = self.skipped_frames[keep]
+
+        return stationary
+
+    def _add_points(self, centroids):
+        if self.points is None:
+            self.points = np.zeros((0, 2))
+        self.points = np.concatenate((self.points, centroids))
+        self.life = np.concatenate((self.life, np.zeros(len(centroids), dtype=np.int64)))
+        self.skipped_frames = np.concatenate((self.skipped_frames, np.zeros(len(centroids), dtype=np.int64)))
+
+    def filter(self, detections):
+        """Remove the stationary contours of a frame
 
-def remove_stationary_contours(contours, thresh=0.5, interval=10, max_skipped_frames=1, max_referance_points=100):  # noqa: C901
-    global reference_points
+        Args:
+            detections: The CONTOUR_FEATURES table of the frame, or a list of contours
+
+        Returns:
+            The detections that aren't stationary, as the same type
+        """
+        features = as_features(detections)
+        stationary = self.match(features['centroid'])
+
+        if features is detections:
+            return features[~stationary]
+        return [contour for contour, remove in zip(detections, stationary) if not remove]
+
+
+_stationary_filter = None
+
+
+def remove_stationary_contours(contours, thresh=0.5, interval=10, max_skipped_frames=1, max_referance_points=100):
     """ Removes contours that don't move
         more than threshhold over interval frames
 
+        The filter state is shared by all calls. Use a StationaryFilter per
+        image sequence when filtering more than one sequence.
+
         Args:
-            contours: List of contours to filter.
+            contours: The CONTOUR_FEATURES table of the frame, or a list of contours
             thresh: Max distance a contour can move while still being considered stationary
             interval: The number of concecutive frames it has to be stationary for
 
         Returns:
-            contours: List of contours with stationary contours removed
+            contours: The contours with stationary contours removed, as the same type
     """
+    global _stationary_filter
 
-    centroids = [get_centroid(contour) for contour in contours]
-    unassigned_centroids = centroids
-
-    # 0: Get all centroids
-
-    # 2: If first time, take these as reference point
-    # 3: If new centroids are within x range of reference point, consider them the same as reference point
-    # 4: If points aren't within any reference point, consider them as new reference points
-    # 5: If no points are wihtin x range of reference point, discard reference point
-
-    # If we don't have any history
-    if reference_points is None:
-        reference_points = [ReferencePoint(centroid) for centroid in unassigned_centroids]
-        return contours
-
-    # Set "found" state to false
-    for point in reference_points:
-        point.found = False
-
-    discarded_contours = []
-    assigned_centroids = []
-    for idx_c, centroid in enumerate(unassigned_centroids):
-        for idx_rp, point in enumerate(reference_points):
-            # If the centroid is within <thresh> of a reference point, consider it the reference point
-            # print(euclidean(centroid, point.point))
-            if euclidean(centroid, point.point) <= thresh:
-                if idx_c not in assigned_centroids:
-                    assigned_centroids.append(idx_c)
-                point.life += 1
-                point.found = True
-                point.skipped_frames = 0
-                if point.life >= interval:
-                    if idx_c not in discarded_contours:
-                        discarded_contours.append(idx_c)
-
-    # Remove assigned points from the unassigned list
-    for idx_c in sorted(assigned_centroids, reverse=True):
-        del unassigned_centroids[idx_c]
-
-    # Assign any unassigned centroids as new reference points
-    for centroid in unassigned_centroids:
-        if len(reference_points) < max_referance_points:
-            reference_points.append(ReferencePoint(centroid))
-        else:
-            pass
-            # print("Max reference points reached")
-
-    discarded_reference_points = []
-    # Remove any reference points that haven't been found for <max_skipped_frames> frames
-    for idx_rp, point in enumerate(reference_points):
-        if not point.found:
-            point.skipped_frames += 1
-            if point.skipped_frames > max_skipped_frames:
-                if idx_rp not in discarded_reference_points:
-                    discarded_reference_points.append(idx_rp)
-
-    for idx_rp in sorted(discarded_reference_points, reverse=True):
-        del reference_points[idx_rp]
+    if _stationary_filter is None:
+        _stationary_filter = StationaryFilter()
 
-    # Remove contours that appear stationary
-    for idx_c in sorted(discarded_contours, reverse=True):
-        del contours[idx_c]
-        pass
+    _stationary_filter.thresh = thresh
+    _stationary_filter.interval = interval
+    _stationary_filter.max_skipped_frames = max_skipped_frames
+    _stationary_filter.max_reference_points = max_referance_points
 
-    return contours
+    return _stationary_filter.filter(contours)
 
 
 def blob_detection(frame):
@@ -453,7 +1317,7 @@ def sort_key_func(s):
         return int(nums[0])
 
 
-def get_folder(folder, types=['jpg', 'png']):
+def get_folder(folder, types=['jpg', 'png', 'tiff', 'bmp']):
     folder = Path(folder)
 
     images = []
@@ -0,0 +1,101 @@
+"""Loads image sequences ahead of the processing that consumes them
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from defector.profiling import profiler
+
+
+def prefetch_map(func, items, executor, depth=8):
+    """Map func over items on an executor, keeping at most depth results in flight
+
+    Results are yielded in the order of items, while up to depth of the next items
+    are already being processed by the executor.
+
+    Args:
+        func: The function to apply to every item
+        items: Iterable of items
+        executor: A concurrent.futures executor to run func on
+        depth: The max number of items submitted ahead of the consumer
+
+    Returns:
+        Generator of func(item) in the order of items
+    """
+    if depth < 1:
+        raise ValueError(f"depth has to be at least 1, got {depth}")
+
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Don't decode frames nobody will use, if the consumer stopped early
+        for future in pending:
+            future.cancel()
+
+
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    """Read an image, raising an error instead of returning None if it can't be read"""
+    image = cv2.imread(str(path), flags)
+    if image is None:
+        raise IOError(f"Could not read image {path}")
+    return image
+
+
+class ImageLoader:
+    """Iterates over the images of a list of paths, decoding them ahead of time on a thread pool
+
+    OpenCV releases the GIL while decoding, so decoding the next frames overlaps with
+    the processing of the current one.
+    """
+
+    def __init__(self, paths, prefetch=8, threads=4, flags=cv2.IMREAD_COLOR, read=None):
+        """
+        Args:
+            paths: The image paths, in the order to deliver them in
+            prefetch: The max number of decoded frames waiting to be consumed
+            threads: The number of decoding threads
+            flags: The cv2.imread flags
+            read: Function reading the frame of a path, instead of reading an image file
+        """
+        if threads < 1:
+            raise ValueError(f"threads has to be at least 1, got {threads}")
+
+        self.paths = list(paths)
+        self.prefetch = prefetch
+        self.threads = threads
+        self.flags = flags
+        self.read = read
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _read(self, path):
+        if self.read is not None:
+            return self.read(path)
+        return read_image(path, self.flags)
+
+    def _read_profiled(self, path):
+        with profiler.stage('imread'):
+            image = self._read(path)
+        return image, profiler.collect()
+
+    def __iter__(self):
+        with ThreadPoolExecutor(self.threads, thread_name_prefix='ImageLoader') as executor:
+            if not profiler.enabled:
+                yield from prefetch_map(self._read, self.paths, executor, self.prefetch)
+                return
+
+            # Hand the read times from the loader threads to the consumer of the frames
+            for image, timings in prefetch_map(self._read_profiled, self.paths, executor, self.prefetch):
+                profiler.add(timings)
+                yield image
@@ -0,0 +1,353 @@
+"""The detection and tracking pipeline for image sequences
+
+Detection (roi_crop, find_contours and the contour features) only depends on
+the frame and the ROI transform, so it can run on many frames at once.
+The stationary filter and the tracker are stateful and consume the detections
+of one sequence in order.
+"""
+
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import perf_counter
+
+from defector.helpers import ContourDetector, RoiCache, contour_features, draw_centroids, find_contours, get_folder, StationaryFilter
+from defector.loader import ImageLoader, prefetch_map, read_image
+from defector.profiling import profiler, set_profiling
+from defector.sequence import SequenceFile, SequenceWriter, is_sequence_file, read_sequence_image
+from defector.tracker import Tracker
+
+
+class FrameDetections:
+    """The detections of a single frame
+
+    Attributes:
+        contours: List of the contours found
+        features: CONTOUR_FEATURES table of the contours, with the centroid, area, perimeter and bounding box
+        frame: The ROI frame the contours were found in, if it was kept
+        timings: The stage times of the detection, when profiling
+    """
+
+    def __init__(self, contours, features, frame=None, timings=None):
+        self.contours = contours
+        self.features = features
+        self.frame = frame
+        self.timings = timings
+
+    @property
+    def centroids(self):
+        """(N, 2) array with the centroid of every contour"""
+        return self.features['centroid']
+
+    def __len__(self):
+        return len(self.contours)
+
+
+def detect(image, roi_transform=None, keep_frame=False, draw=False, detector=None):
+    """Find the contours in a frame
+
+    Args:
+        image: A BGR frame
+        roi_transform: The RoiTransform to cut the vial out with, or None to use the whole frame
+        keep_frame: Return the ROI frame
+        draw: Draw the centroids on the ROI frame
+        detector: The ContourDetector to use. Default: The shared one with the default arguments
+
+    Returns:
+        FrameDetections of the frame
+    """
+    if roi_transform is not None:
+        with profiler.stage('roi_crop'):
+            image = roi_transform.apply(image)
+
+    contours, frame = find_contours(image, False, detector)
+    with profiler.stage('features'):
+        features = contour_features(contours)
+
+    if keep_frame and draw:
+        draw_centroids(frame, features['centroid'])
+
+    # The stage times travel with the detections, as they may come from another process
+    timings = profiler.collect() if profiler.enabled else None
+    return FrameDetections(contours, features, frame if keep_frame else None, timings)
+
+
+def open_input(input):
+    """Get the frames of an image folder or a sequence file
+
+    Args:
+        input: A folder of images or a sequence file
+
+    Returns:
+        frames: List of the frames, in sequence order
+        read: Function reading a frame as a BGR image
+    """
+    if is_sequence_file(input):
+        return SequenceFile(input).good_frames().tolist(), partial(read_sequence_image, str(input))
+
+    return get_folder(input), read_image
+
+
+def skip_last_frames(frames, distance, detector=None):
+    """Drop the last distance frames for the detectors that work frame by frame
+
+    The frame pair diff needed a frame distance frames ahead, so the last ones were skipped.
+    Sequential detectors use distance for the background of the previous frames, and detect
+    in every frame.
+
+    Args:
+        frames: The frames of the sequence
+        distance: The number of frames to drop
+        detector: The detector the frames are for. Default: The shared ContourDetector
+
+    Returns:
+        The frames to detect in
+    """
+    if not distance or (detector is not None and detector.sequential):
+        return frames
+    return frames[:-distance]
+
+
+def detect_path(path, roi_transform=None, keep_frame=False, draw=False, read=read_image, detector=None):
+    """Read a frame and find the contours in it. See detect()"""
+    with profiler.stage('imread'):
+        image = read(path)
+    return detect(image, roi_transform, keep_frame, draw, detector)
+
+
+def detect_sequence(paths, roi=True, workers=1, prefetch=8, threads=4, keep_frames=False, draw=False, read=read_image, detector=None):
+    """Find the contours in every frame of an image sequence
+
+    The ROI transform is found on the first frame, or reused from a RoiCache if it
+    still matches the first frame. With more than one worker the
+    frames are read and processed on a process pool, otherwise they're decoded
+    on a thread pool and processed in this process. Sequential detectors, like the
+    MotionDetector, always process the frames in this process, and are reset first.
+
+    Args:
+        paths: The frames, in sequence order. Image paths, or the frames given by open_input()
+        roi: Cut the vial out of every frame. A RoiCache to reuse its transform
+        workers: The number of detection processes
+        prefetch: The max number of frames processed ahead of the consumer
+        threads: The number of decoding threads, when using a single worker
+        keep_frames: Keep the ROI frames in the detections
+        draw: Draw the centroids on the kept frames
+        read: Function reading a frame as a BGR image. Default read_image
+        detector: The ContourDetector or MotionDetector to use. Every worker process gets its own copy
+
+    Returns:
+        Generator of FrameDetections in sequence order
+    """
+    paths = list(paths)
+    if not paths:
+        return
+
+    roi_transform = None
+    if roi:
+        roi_cache = roi if isinstance(roi, RoiCache) else RoiCache()
+        with profiler.stage('roi_find'):
+            roi_transform = roi_cache.transform_for(read(paths[0]))
+
+    if detector is not None:
+        detector.reset()
+        if detector.sequential:
+            workers = 1
+
+    if workers > 1:
+        work = partial(detect_path, roi_transform=roi_transform, keep_frame=keep_frames, draw=draw, read=read, detector=detector)
+        with ProcessPoolExecutor(workers, initializer=set_profiling, initargs=(profiler.enabled, )) as executor:
+            yield from prefetch_map(work, paths, executor, max(prefetch, workers))
+    else:
+        for image in ImageLoader(paths, prefetch, threads, read=read):
+            yield detect(image, roi_transform, keep_frames, draw, detector)
+
+
+class SequenceTracker:
+    """Removes stationary contours and tracks the moving ones through a sequence
+
+    Attributes:
+        stationary_filter: The StationaryFilter of the sequence
+        tracker: The Tracker of the sequence
+        detections: Counter of the number of frames every track ID was detected in
+        frames: The number of frames so far
+        moving: The number of moving contours in all frames so far
+        stationary: The number of stationary contours in all frames so far
+    """
+
+    def __init__(self, stationary_filter=None, tracker=None):
+        """
+        Args:
+            stationary_filter: Default StationaryFilter(5, 5, 10)
+            tracker: Default Tracker(50, 5, 5, 100, 0.5)
+        """
+        self.stationary_filter = stationary_filter if stationary_filter is not None else StationaryFilter(5, 5, 10)
+        self.tracker = tracker if tracker is not None else Tracker(50, 5, 5, 100, 0.5)
+        self.first_track_id = self.tracker.trackIdCount
+        self.detections = Counter()
+        self.frames = 0
+        self.moving = 0
+        self.stationary = 0
+
+    def update(self, detections):
+        """Add the detections of the next frame
+
+        Args:
+            detections: FrameDetections of the frame
+
+        Returns:
+            moving: CONTOUR_FEATURES table of the contours that aren't stationary. The
+                contours are detections.contours[moving['index']]
+        """
+        with profiler.stage('stationary_filter'):
+            moving = self.stationary_filter.filter(detections.features)
+
+        with profiler.stage('tracker'):
+            self.tracker.Update(moving)
+
+        table = self.tracker.table
+        slots = table.active()
+        self.detections.update(table.ids[slots[table.has_point[slots]]].tolist())
+        self.frames += 1
+        self.moving += len(moving)
+        self.stationary += len(detections) - len(moving)
+
+        profiler.record(detections.timings, contours=len(detections), stationary=len(detections) - len(moving), tracks=len(slots))
+
+        return moving
+
+    @property
+    def tracks_started(self):
+        """The number of tracks started so far"""
+        return self.tracker.trackIdCount - self.first_track_id
+
+    def particles(self, min_detections=5):
+        """Get the number of tracks detected in at least min_detections frames"""
+        return sum(count >= min_detections for count in self.detections.values())
+
+
+class LiveInspector:
+    """Runs the detection and tracking pipeline on frames as they arrive from the camera
+
+    The inspector consumes the frames of a FrameRingBuffer on a background thread, in the
+    same way as the frame writers, so it can be given to PymbaCam.capture(). The ring
+    buffer is the bounded queue between the camera and the pipeline: while the pipeline
+    is behind, frames wait in the buffer, and when the buffer is full new frames are
+    dropped and counted.
+
+    A track that has been detected in min_detections frames is counted as a particle.
+    The vial is rejected if more than max_particles particles are found.
+    """
+
+    def __init__(self, convert=None, roi=True, save=None, pixel_format='BGR8', capacity=1000, sequence_tracker=None, min_detections=5, max_particles=0, detector=None):
+        """
+        Args:
+            convert: Function converting raw frames to BGR images. Default: Use the raw frames
+            roi: Cut the vial out of every frame. A RoiCache to reuse its transform
+            save: Sequence file to save the raw frames in. Default: Don't save the frames
+            pixel_format: The pixel format of the raw frames, for the sequence file
+            capacity: The max number of frames to save
+            sequence_tracker: Default SequenceTracker()
+            min_detections: The number of frames a track has to be detected in to count as a particle
+            max_particles: The max number of particles in an accepted vial
+            detector: The ContourDetector to use. Default ContourDetector()
+        """
+        self.convert = convert
+        self.roi = roi
+        self.save = save
+        self.pixel_format = pixel_format
+        self.capacity = capacity
+        self.sequence_tracker = sequence_tracker if sequence_tracker is not None else SequenceTracker()
+        self.min_detections = min_detections
+        self.max_particles = max_particles
+        self.detector = detector if detector is not None else ContourDetector()
+
+        self.buffer = None
+        self.writer = None
+        self.roi_transform = None
+        self.frames = 0
+        self.incomplete = 0
+        self.max_backlog = 0
+        self.processing_time = 0
+        self._thread = None
+
+    def start(self, buffer):
+        """Start processing the frames of a buffer
+
+        Args:
+            buffer: The FrameRingBuffer to consume
+        """
+        self.buffer = buffer
+        self.detector.reset()
+        if self.save is not None:
+            self.writer = SequenceWriter(self.save, buffer.shape, buffer.frames.dtype, self.pixel_format, capacity=self.capacity)
+        self._thread = threading.Thread(target=self._run, name='LiveInspector', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            seq = self.buffer.get()
+            if seq is None:
+                return
+
+            self.max_backlog = max(self.max_backlog, len(self.buffer))
+            try:
+                self.process(seq)
+            finally:
+                self.buffer.release(seq)
+
+    def process(self, seq):
+        """Run one frame of the buffer through the pipeline"""
+        slot = self.buffer.slot(seq)
+        raw = self.buffer.frame(seq)
+        complete = self.buffer.complete[slot]
+
+        if self.writer is not None and self.writer.count < self.capacity:
+            self.writer.append(raw, self.buffer.frame_ids[slot], self.buffer.timestamps[slot], complete)
+
+        if not complete:
+            self.incomplete += 1
+            return
+
+        start = perf_counter()
+        with profiler.stage('convert'):
+            image = self.convert(raw) if self.convert is not None else raw.copy()
+        if self.roi and self.roi_transform is None:
+            roi_cache = self.roi if isinstance(self.roi, RoiCache) else RoiCache()
+            with profiler.stage('roi_find'):
+                self.roi_transform = roi_cache.transform_for(image)
+
+        self.sequence_tracker.update(detect(image, self.roi_transform, detector=self.detector))
+
+        self.frames += 1
+        self.processing_time += perf_counter() - start
+
+    def finish(self, framerate=0):
+        """Process the remaining frames and stop the inspector
+
+        Args:
+            framerate: The measured framerate of the capture
+
+        Returns:
+            summary (dict): The verdict and the statistics of the inspection
+        """
+        if self.buffer is not None:
+            self.buffer.close()
+            self._thread.join()
+        if self.writer is not None:
+            self.writer.close(framerate)
+
+        return self.summary()
+
+    def summary(self):
+        """Get the verdict and the statistics of the inspection so far"""
+        particles = self.sequence_tracker.particles(self.min_detections)
+        return {
+            'verdict': 'reject' if particles > self.max_particles else 'accept',
+            'particles': particles,
+            'frames': self.frames,
+            'incomplete': self.incomplete,
+            'dropped': self.buffer.overflows if self.buffer is not None else 0,
+            'max_backlog': self.max_backlog,
+            'fps': self.frames / self.processing_time if self.processing_time else 0,
+        }
@@ -0,0 +1,215 @@
+"""Per-stage timing of the detection and tracking pipeline
+
+The stages of the pipeline are wrapped in `with profiler.stage(name):`. While the profiler
+is disabled, stage() returns a shared context manager that does nothing, so the
+instrumentation costs a method call per stage.
+
+Stage times are collected per thread, and handed from the thread or process that ran the
+stages to the one recording the frames, together with the frame they belong to. Every call
+to record() ends a frame, and stores its stage times, counts, wall time and the peak memory
+of the process.
+"""
+
+import csv
+import json
+import threading
+from time import perf_counter
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PERCENTILES = (50, 90, 99)
+
+
+def peak_memory():
+    """Get the peak resident memory of this process in MB, or None if it isn't available"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timings[self.name] = self.timings.get(self.name, 0) + perf_counter() - self.start
+        return False
+
+
+class Profiler:
+    """Records the wall time of named pipeline stages, and counts, for every frame
+
+    Attributes:
+        enabled: If stages are timed
+        frames: List of the records of every frame
+        counts: The names of the counts recorded
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Forget all recorded frames"""
+        self.frames = []
+        self.counts = set()
+        self._last = None
+
+    @property
+    def timings(self):
+        """The stage times recorded by this thread, since the last collect()"""
+        if not hasattr(self._local, 'timings'):
+            self._local.timings = {}
+        return self._local.timings
+
+    def stage(self, name):
+        """Time a stage of the current frame
+
+        Returns:
+            A context manager timing the block it wraps
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self.timings, name)
+
+    def add(self, timings):
+        """Add stage times recorded by another thread or process to the current frame"""
+        for name, seconds in timings.items():
+            self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def collect(self):
+        """Take the stage times recorded by this thread"""
+        timings = self.timings
+        self._local.timings = {}
+        return timings
+
+    def record(self, timings=None, **counts):
+        """End a frame
+
+        Args:
+            timings: Stage times of the frame recorded elsewhere, added to the ones of this thread
+            counts: Counts of the frame, like the number of contours
+        """
+        if not self.enabled:
+            return
+
+        if timings:
+            self.add(timings)
+
+        now = perf_counter()
+        frame = {'frame': len(self.frames), 'wall': now - self._last if self._last is not None else None}
+        frame.update(self.collect())
+        frame.update(counts)
+        frame['peak_memory_mb'] = peak_memory()
+        self.counts.update(counts)
+
+        self.frames.append(frame)
+        self._last = now
+
+    def columns(self):
+        """Get the names of all stages and counts, in the order they were first recorded"""
+        columns = {}
+        for frame in self.frames:
+            columns.update(dict.fromkeys(frame))
+        return list(columns)
+
+    def summary(self):
+        """Summarize every stage and count over all frames
+
+        Returns:
+            Dict of {name: {'frames', 'mean', 'p50', 'p90', 'p99', 'max', 'total'}}.
+            Stage times are in seconds
+        """
+        summary = {}
+        for column in self.columns():
+            if column == 'frame':
+                continue
+            values = np.array([frame[column] for frame in self.frames if frame.get(column) is not None], dtype=float)
+            if not len(values):
+                continue
+
+            summary[column] = {'frames': len(values), 'mean': values.mean(), 'max': values.max(), 'total': values.sum()}
+            for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                summary[column][f'p{percentile}'] = value
+        return summary
+
+    def format_summary(self, stages=None):
+        """Format the summary as a table. Stage times are shown in ms
+
+        Args:
+            stages: The names of the stage times. Default: All names that aren't counts or memory
+        """
+        summary = self.summary()
+        if stages is None:
+            stages = [name for name in summary if name not in self.counts and name != 'peak_memory_mb']
+        frame_time = sum(summary[name]['total'] for name in stages if name != 'wall')
+
+        lines = [f"{'stage':<24} {'frames':>7} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'share':>6}"]
+        for name in stages:
+            row = summary[name]
+            values = ' '.join(f"{row[key] * 1000:>9.3f}" for key in ('mean', 'p50', 'p90', 'p99', 'max'))
+            share = f"{row['total'] / frame_time:>6.1%}" if name != 'wall' and frame_time else ''
+            lines.append(f"{name + ' [ms]':<24} {row['frames']:>7} {values} {share}")
+
+        for name in summary:
+            if name in stages:
+                continue
+            row = summary[name]
+            values = ' '.join(f"{row[key]:>9.1f}" for key in ('mean', 'p50', 'p90', 'p99', 'max'))
+            lines.append(f"{name:<24} {row['frames']:>7} {values}")
+
+        return '\n'.join(lines)
+
+    def write_trace(self, path):
+        """Write the records of every frame to a CSV file, or a JSON file if path ends in .json"""
+        path = str(path)
+        with open(path, 'w', newline='') as trace_file:
+            if path.endswith('.json'):
+                json.dump({'frames': self.frames, 'summary': self.summary()}, trace_file, indent=1)
+                return
+
+            writer = csv.DictWriter(trace_file, self.columns())
+            writer.writeheader()
+            writer.writerows(self.frames)
+
+
+profiler = Profiler()
+
+
+def set_profiling(enabled):
+    """Enable or disable the profiler of this process. Used to initialize worker processes
+
+    Forked workers inherit the stage times the parent hadn't recorded yet, like roi_find.
+    They're dropped, so only the parent records them.
+    """
+    profiler.enable(enabled)
+    profiler.collect()
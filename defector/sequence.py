@@ -0,0 +1,293 @@
+"""A single-file container format for frame sequences
+
+A sequence file has a fixed size header, followed by a table with the frame ID,
+timestamp and completeness of every frame, followed by the frames as contiguous
+raw arrays. The frames are read through numpy.memmap, so any frame can be read
+without copying or decoding it.
+
+Layout:
+    header      HEADER, see below
+    table       TABLE_DTYPE records, table_capacity of them
+    padding     up to the next multiple of ALIGNMENT
+    frames      frame_count frames of shape (height, width[, channels]) and dtype
+"""
+
+import json
+import struct
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+from defector.helpers import get_folder, sort_key_func
+
+MAGIC = b'DFSEQ\0\0\0'
+VERSION = 1
+SUFFIX = '.dfseq'
+ALIGNMENT = 4096
+
+# magic, version, frame_count, table_capacity, height, width, channels, dtype, pixel_format, framerate, data_offset
+HEADER = struct.Struct('<8sIIIIII8s16sdQ')
+
+TABLE_DTYPE = np.dtype([('frame_id', '<i8'), ('timestamp', '<u8'), ('complete', '<u8')])
+
+# Conversions from the stored pixel format to BGR for the analysis. BayerRG8 is converted
+# the same way PymbaCam converts it before saving images
+PIXEL_FORMATS_CONVERSIONS = {
+    'BayerRG8': cv.COLOR_BAYER_RG2RGB,
+    'Mono8': cv.COLOR_GRAY2BGR,
+}
+
+
+def is_sequence_file(path):
+    """Check if a path is a sequence file"""
+    path = Path(path)
+    if not path.is_file():
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class SequenceWriter:
+    """Writes frames to a sequence file"""
+
+    def __init__(self, path, shape, dtype=np.uint8, pixel_format='BGR8', framerate=0, capacity=1000):
+        """
+        Args:
+            path: The file to write
+            shape: The shape of a single frame, (height, width) or (height, width, channels)
+            dtype: The data type of the frames
+            pixel_format: The pixel format of the frames, e.g. BayerRG8 or BGR8
+            framerate: The framerate of the sequence, can also be given to close()
+            capacity: The max number of frames the table has room for
+        """
+        if len(shape) not in (2, 3):
+            raise ValueError(f"Frames have to be 2 or 3 dimensional, got shape {shape}")
+
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.pixel_format = pixel_format
+        self.framerate = framerate
+        self.capacity = capacity
+        self.table = np.zeros(capacity, dtype=TABLE_DTYPE)
+        self.count = 0
+
+        table_end = HEADER.size + self.table.nbytes
+        self.data_offset = -(-table_end // ALIGNMENT) * ALIGNMENT
+        self.frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self.file = open(self.path, 'wb')
+        self._write_header()
+        self.file.seek(self.data_offset)
+
+    def _write_header(self):
+        height, width = self.shape[:2]
+        channels = self.shape[2] if len(self.shape) == 3 else 1
+        header = HEADER.pack(MAGIC, VERSION, self.count, self.capacity, height, width, channels, self.dtype.str.encode(), self.pixel_format.encode(), self.framerate, self.data_offset)
+
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.write(self.table.tobytes())
+
+    def append(self, frame, frame_id, timestamp=0, complete=True):
+        """Append a frame to the sequence
+
+        Args:
+            frame: The frame data, or None for an incomplete frame. Incomplete frames are stored as zeros
+            frame_id: The camera frame ID
+            timestamp: The camera timestamp
+            complete: If the frame was received completely
+        """
+        if self.count >= self.capacity:
+            raise IndexError(f"The sequence file only has room for {self.capacity} frames")
+
+        if frame is None or not complete:
+            self.file.write(bytes(self.frame_size))
+        else:
+            if frame.shape != self.shape or frame.dtype != self.dtype:
+                raise ValueError(f"Expected a {self.shape} {self.dtype} frame, got {frame.shape} {frame.dtype}")
+            self.file.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+
+        self.table[self.count] = (frame_id, timestamp, complete and frame is not None)
+        self.count += 1
+
+    def close(self, framerate=None):
+        """Write the header and frame table, and close the file
+
+        Args:
+            framerate: The framerate of the sequence. Default: The framerate given when created
+        """
+        if framerate is not None:
+            self.framerate = framerate
+        self._write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SequenceFile:
+    """Random access to the frames of a sequence file, through numpy.memmap
+
+    Attributes:
+        frames: memmap of all frames, (frame_count, height, width[, channels])
+        frame_ids: The camera frame ID of every frame
+        timestamps: The camera timestamp of every frame
+        complete: If every frame was received completely
+        pixel_format: The pixel format of the frames
+        framerate: The framerate of the sequence
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: The sequence file to read
+        """
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER.size)
+
+        magic, version, count, capacity, height, width, channels, dtype, pixel_format, framerate, data_offset = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a sequence file")
+        if version != VERSION:
+            raise ValueError(f"{path} is a version {version} sequence file, only version {VERSION} is supported")
+
+        self.pixel_format = pixel_format.rstrip(b'\0').decode()
+        self.framerate = framerate
+        self.shape = (height, width) if channels == 1 else (height, width, channels)
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode())
+
+        table = np.memmap(self.path, dtype=TABLE_DTYPE, mode='r', offset=HEADER.size, shape=(capacity, ))[:count]
+        self.frame_ids = table['frame_id']
+        self.timestamps = table['timestamp']
+        self.complete = table['complete'].astype(bool)
+
+        if count:
+            self.frames = np.memmap(self.path, dtype=self.dtype, mode='r', offset=data_offset, shape=(count, ) + self.shape)
+        else:
+            self.frames = np.zeros((0, ) + self.shape, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        """Get a raw frame, without copying it"""
+        return self.frames[idx]
+
+    def good_frames(self):
+        """Get the indices of the complete frames"""
+        return np.flatnonzero(self.complete)
+
+    def image(self, idx):
+        """Get a frame converted to BGR for the analysis"""
+        raw = self.frames[idx]
+        try:
+            return cv.cvtColor(raw, PIXEL_FORMATS_CONVERSIONS[self.pixel_format])
+        except KeyError:
+            return raw
+
+
+_open_files = {}
+
+
+def read_sequence_image(path, idx):
+    """Read a BGR frame from a sequence file, keeping the file open for later reads in this process"""
+    path = str(path)
+    if path not in _open_files:
+        _open_files[path] = SequenceFile(path)
+    return _open_files[path].image(idx)
+
+
+def close_sequence_file(path):
+    """Forget a sequence file opened by read_sequence_image, so its memory map can be freed"""
+    _open_files.pop(str(path), None)
+
+
+def read_folder_image(path):
+    """Read an image of a folder sequence, as a BGR8 or Mono8 frame
+
+    Args:
+        path: The image file
+
+    Returns:
+        frame: (height, width, 3) BGR or (height, width) grayscale uint8 array
+
+    Raises:
+        IOError: If the image can't be read
+        ValueError: If the image isn't 8 bit, or has a channel count without a pixel format
+    """
+    frame = cv.imread(str(path), cv.IMREAD_UNCHANGED)
+    if frame is None:
+        raise IOError(f"Could not read image {path}")
+    if frame.dtype != np.uint8:
+        raise ValueError(f"{path} is {frame.dtype}, only 8 bit images can be converted")
+
+    channels = 1 if frame.ndim == 2 else frame.shape[2]
+    if channels == 4:
+        return cv.cvtColor(frame, cv.COLOR_BGRA2BGR)
+    if channels == 1:
+        return frame.reshape(frame.shape[:2])
+    if channels != 3:
+        raise ValueError(f"{path} has {channels} channels, expected 1, 3 or 4")
+    return frame
+
+
+def convert_folder(folder, path, overwrite=False):
+    """Convert a folder of images to a sequence file
+
+    The frame ID of every image is the number in its name. The framerate and timestamps are
+    read from the framerate and index.json files if the folder has them. The pixel format is
+    BGR8 for colour images and Mono8 for grayscale images, alpha channels are dropped.
+
+    Args:
+        folder: The folder with the image sequence
+        path: The sequence file to write
+        overwrite: If the sequence file should be replaced if it exists
+
+    Returns:
+        The number of frames converted
+
+    Raises:
+        IOError: If an image can't be read
+        ValueError: If an image can't be stored in the pixel format and shape of the first one.
+            The partly written sequence file is removed
+    """
+    folder = Path(folder)
+    path = Path(path)
+    if path.exists() and not overwrite:
+        raise FileExistsError(f"{path} already exists, and overwrite=False")
+
+    images = get_folder(folder)
+    if not images:
+        raise FileNotFoundError(f"{folder} has no images")
+
+    framerate = 0
+    if folder.joinpath('framerate').is_file():
+        framerate = float(folder.joinpath('framerate').read_text())
+
+    timestamps = {}
+    if folder.joinpath('index.json').is_file():
+        index = json.loads(folder.joinpath('index.json').read_text())
+        timestamps = {frame['frame_id']: frame['timestamp'] for frame in index['frames']}
+
+    first = read_folder_image(images[0])
+    pixel_format = 'BGR8' if first.ndim == 3 else 'Mono8'
+
+    try:
+        with SequenceWriter(path, first.shape, first.dtype, pixel_format, framerate, len(images)) as writer:
+            for image_path in images:
+                frame = read_folder_image(image_path)
+                if frame.shape != first.shape:
+                    raise ValueError(f"{image_path} has shape {frame.shape}, but the sequence is {first.shape} {pixel_format}")
+                frame_id = sort_key_func(image_path)
+                writer.append(frame, frame_id, timestamps.get(frame_id, 0))
+    except (IOError, ValueError):
+        path.unlink()
+        raise
+
+    return len(images)
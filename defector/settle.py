@@ -0,0 +1,132 @@
+"""Detects when the liquid in the vial has settled after spinning it
+"""
+
+from time import monotonic, sleep
+
+import cv2
+import numpy as np
+
+from defector.communication import set_speed
+from defector.helpers import RoiTransform
+
+
+class SettleDetector:
+    """Measures the bulk motion in the vial on low resolution frames
+
+    The motion of a frame is the mean absolute difference to the previous frame, inside the
+    vial. The frames are downscaled before they're compared, and the vial is masked with the
+    RoiTransform of the first frame, scaled to the low resolution.
+
+    The vial is settled when the motion of settled_frames frames in a row is below threshold,
+    but never before min_time. After max_time the vial is considered settled regardless.
+
+    Attributes:
+        motion: The motion of every frame so far
+        timed_out: If the last settle ended at max_time
+    """
+
+    def __init__(self, threshold=2.0, min_time=0.5, max_time=4.0, scale=0.125, settled_frames=3, roi=True, convert=None):
+        """
+        Args:
+            threshold: The max mean absolute difference of a settled frame, in grey levels
+            min_time: Min seconds to wait
+            max_time: Max seconds to wait
+            scale: The scale of the frames the motion is measured on
+            settled_frames: The number of frames in a row that have to be below threshold
+            roi: Only measure the motion inside the vial
+            convert: Function converting raw frames to BGR, for finding the vial. Default: The frames are BGR
+        """
+        self.threshold = threshold
+        self.min_time = min_time
+        self.max_time = max_time
+        self.scale = scale
+        self.settled_frames = settled_frames
+        self.roi = roi
+        self.convert = convert
+        self.mask = None
+        self.reset()
+
+    def reset(self):
+        """Start a new settle. The vial mask is kept"""
+        self.start = None
+        self.previous = None
+        self.motion = []
+        self.below = 0
+        self.timed_out = False
+
+    def size(self, shape):
+        """Get the low resolution (width, height) of a frame shape"""
+        return round(shape[1] * self.scale), round(shape[0] * self.scale)
+
+    def downscale(self, frame):
+        """Get the low resolution grey version of a frame"""
+        small = cv2.resize(frame, self.size(frame.shape), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small
+
+    def find_mask(self, frame):
+        """Find the low resolution mask of the vial in a full resolution frame"""
+        image = self.convert(frame) if self.convert is not None else frame
+        transform = RoiTransform.from_frame(image)
+
+        scale = np.diag([self.scale, self.scale, 1])
+        matrix = scale @ transform.transformation_matrix @ np.linalg.inv(scale)
+
+        crop = np.full((round(transform.crop_size[1] * self.scale), round(transform.crop_size[0] * self.scale)), 255, dtype=np.uint8)
+        return cv2.warpPerspective(crop, matrix, self.size(frame.shape), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+
+    def update(self, frame, time=None):
+        """Add the next frame
+
+        Args:
+            frame: A full resolution frame, raw or BGR
+            time: The time of the frame in seconds. Default: Now
+
+        Returns:
+            settled (bool): If the vial is settled, or max_time has passed
+        """
+        time = monotonic() if time is None else time
+        if self.start is None:
+            self.start = time
+        if self.roi and self.mask is None:
+            self.mask = self.find_mask(frame)
+
+        small = self.downscale(frame)
+        if self.previous is not None:
+            motion = cv2.mean(cv2.absdiff(small, self.previous), self.mask)[0]
+            self.motion.append(motion)
+            self.below = self.below + 1 if motion < self.threshold else 0
+        self.previous = small
+
+        elapsed = time - self.start
+        if elapsed >= self.max_time:
+            self.timed_out = True
+            return True
+
+        return elapsed >= self.min_time and self.below >= self.settled_frames
+
+
+def spin_and_settle(cam, detector, speed, spin_time=4, acceleration=5000):
+    """Spin the vial, stop it, and wait until the liquid has settled
+
+    Args:
+        cam: The PymbaCam to watch the vial with
+        detector: The SettleDetector deciding when the vial is settled
+        speed: The speed to spin the vial at
+        spin_time: Seconds to spin the vial for
+        acceleration: The acceleration and deceleration of the jig
+
+    Returns:
+        elapsed (float): Seconds from stopping the vial until it was settled
+
+    Raises:
+        TimeoutError: If the jig doesn't acknowledge a speed command
+    """
+    set_speed(speed, acceleration, acceleration)
+    sleep(spin_time)
+    set_speed(0, acceleration, acceleration)
+
+    start = monotonic()
+    cam.wait_until_settled(detector)
+    return monotonic() - start
@@ -0,0 +1,186 @@
+"""Generates synthetic vial sequences with known particle trajectories
+
+The frames look like the captures of the jig: a dark background with a rotated bright vial,
+a dark plug at one end of the vial, static scratches on the glass, and dark particles moving
+through the liquid. The particle positions of every frame are known, so the output of the
+pipeline can be checked against them, and the sequences can be generated at any resolution
+for benchmarks.
+"""
+
+import cv2
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from defector.helpers import CROP_TOLERANCE
+from defector.sequence import SequenceWriter
+
+VIAL_COLOR = (200, 200, 200)
+PLUG_COLOR = (25, 25, 25)
+SCRATCH_COLOR = (150, 150, 150)
+PARTICLE_COLOR = (60, 60, 60)
+
+
+class SyntheticVial:
+    """A synthetic vial sequence
+
+    Positions are in frame coordinates. The vial is centered in the frame, and its long axis
+    is rotated angle degrees from the x axis.
+
+    Attributes:
+        trajectories: (frames, particles, 2) array of the particle centers in every frame
+        scratches: (scratches, 2, 2) array of the end points of the scratches
+        vial_rect: The cv2.RotatedRect ((x, y), (width, height), angle) of the vial
+        plug_rect: The cv2.RotatedRect of the plug
+    """
+
+    def __init__(self, width=1280, height=720, particles=10, scratches=5, frames=50, angle=3, particle_radius=3, noise=0, seed=0):
+        """
+        Args:
+            width: Frame width
+            height: Frame height
+            particles: The number of moving particles
+            scratches: The number of static scratches
+            frames: The number of frames
+            angle: The rotation of the vial in degrees
+            particle_radius: The radius of the particles, in pixels
+            noise: The standard deviation of the Gaussian noise added to every frame
+            seed: Seed of the random positions and velocities
+        """
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.particle_radius = particle_radius
+        self.noise = noise
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        self.center = np.array([width / 2, height / 2])
+        self.vial_size = np.array([0.7 * width, 0.4 * height])
+        self.plug_length = 0.08 * width
+        theta = np.deg2rad(angle)
+        self.axes = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
+
+        plug_center = self.to_frame(np.array([(self.vial_size[0] + self.plug_length) / 2, 0]))
+        self.vial_rect = (tuple(self.center), tuple(self.vial_size), angle)
+        self.plug_rect = (tuple(plug_center), (self.plug_length, self.vial_size[1]), angle)
+
+        # Everything inside the vial stays clear of the walls and the plug
+        inner = self.vial_size / 2 - 4 * particle_radius - 10
+
+        starts = rng.uniform(-0.3, 0.3, (scratches, 2)) * self.vial_size
+        directions = rng.uniform(-1, 1, (scratches, 2)) * 0.05 * self.vial_size
+        self.scratches = self.to_frame(np.stack((starts, starts + directions), axis=1))
+
+        # Particles swirl down the vial: a constant drift along the vial plus a sideways oscillation
+        start = rng.uniform(-inner, inner, (particles, 2)) * [1, 0.5]
+        drift = rng.uniform(-1, 1, (particles, 2)) * [0.004, 0.002] * self.vial_size
+        amplitude = rng.uniform(0, 0.1, particles) * inner[1]
+        phase = rng.uniform(0, 2 * np.pi, particles)
+        t = np.arange(frames)[:, None]
+        local = start + drift * t[:, :, None]
+        local[:, :, 1] += amplitude * np.sin(0.3 * t + phase)
+
+        # Fold the particles back into the vial, like the walls reflecting them
+        period = 4 * inner
+        local = np.abs((local + inner) % period - 2 * inner) - inner
+
+        self.trajectories = self.to_frame(local)
+        self._background = None
+
+    def to_frame(self, points):
+        """Convert points in vial coordinates (along the vial, across the vial) to frame coordinates"""
+        return points @ self.axes + self.center
+
+    def roi_positions(self, roi_transform):
+        """Get the particle trajectories in the coordinates of the frames cut out by a RoiTransform
+
+        Returns:
+            (frames, particles, 2) array of the particle centers
+        """
+        points = self.trajectories.reshape(-1, 1, 2).astype(np.float64)
+        positions = cv2.perspectiveTransform(points, roi_transform.transformation_matrix).reshape(self.trajectories.shape)
+        if roi_transform.crop_params is not None:
+            positions[..., 0] -= roi_transform.crop_params[0] + CROP_TOLERANCE
+        return positions
+
+    def background(self):
+        """Get the static part of the frames: the vial, the plug and the scratches"""
+        if self._background is None:
+            frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+            cv2.fillPoly(frame, [cv2.boxPoints(self.vial_rect).astype(np.int32)], VIAL_COLOR)
+            cv2.fillPoly(frame, [cv2.boxPoints(self.plug_rect).astype(np.int32)], PLUG_COLOR)
+            for start, end in np.round(self.scratches).astype(np.int32):
+                cv2.line(frame, tuple(start.tolist()), tuple(end.tolist()), SCRATCH_COLOR, 2)
+            self._background = frame
+        return self._background
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, idx):
+        return self.frame(idx)
+
+    def __iter__(self):
+        return (self.frame(idx) for idx in range(self.frames))
+
+    def frame(self, idx):
+        """Draw a frame of the sequence"""
+        if not 0 <= idx < self.frames:
+            raise IndexError(f"Frame {idx} is outside the sequence of {self.frames} frames")
+
+        frame = self.background().copy()
+        for x, y in np.round(self.trajectories[idx]).astype(np.int32):
+            cv2.circle(frame, (int(x), int(y)), self.particle_radius, PARTICLE_COLOR, -1)
+
+        if self.noise:
+            rng = np.random.default_rng((self.seed, idx))
+            noisy = frame + rng.normal(0, self.noise, frame.shape)
+            frame = np.clip(noisy, 0, 255).astype(np.uint8)
+
+        return frame
+
+    def write_folder(self, folder):
+        """Write the sequence as VimbaImage_<idx>.png files
+
+        Returns:
+            List of the image paths
+        """
+        paths = []
+        for idx, frame in enumerate(self):
+            paths.append(folder.joinpath(f'VimbaImage_{idx}.png'))
+            cv2.imwrite(str(paths[-1]), frame)
+        return paths
+
+    def write_sequence(self, path):
+        """Write the sequence as a sequence file"""
+        with SequenceWriter(path, (self.height, self.width, 3), np.uint8, 'BGR8', capacity=self.frames) as writer:
+            for idx, frame in enumerate(self):
+                writer.append(frame, idx)
+        return path
+
+
+def match_centroids(found, expected, max_distance=3.0):
+    """Compare detected centroids to the expected ones, like the centroids of a full resolution detection or the particle positions
+
+    Args:
+        found: (N, 2) array of the detected centroids
+        expected: (M, 2) array of the expected centroids
+        max_distance: The max distance of a found centroid to the expected one it matches
+
+    Returns:
+        dict with the recall, the share of the expected centroids that were found, the precision,
+        the share of the found centroids that were expected, and the mean error of the matches in pixels
+    """
+    found = np.asarray(found, dtype=np.float64).reshape(-1, 2)
+    expected = np.asarray(expected, dtype=np.float64).reshape(-1, 2)
+    if not len(found) or not len(expected):
+        return {'recall': float(not len(expected)), 'precision': float(not len(found)), 'error': 0.0}
+
+    distance = cdist(expected, found)
+    nearest_found = distance.min(axis=1)
+    matched = nearest_found <= max_distance
+    return {
+        'recall': matched.mean(),
+        'precision': (distance.min(axis=0) <= max_distance).mean(),
+        'error': nearest_found[matched].mean() if matched.any() else 0.0,
+    }
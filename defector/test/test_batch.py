@@ -0,0 +1,87 @@
+"""Tests for the parallel batch runner"""
+
+import json
+
+from defector.batch import find_sequences, read_results, run_batch, summarize_sequence
+from defector.helpers import ContourDetector, MotionDetector
+from defector.synthetic import SyntheticVial
+from defector.test.test_pipeline import write_sequence
+
+
+def make_sequences(tmp_path, count=3):
+    folders = []
+    for i in range(count):
+        folder = tmp_path / f'vial{i}'
+        folder.mkdir()
+        write_sequence(folder, 6)
+        folders.append(folder)
+    return folders
+
+
+def test_batch_summaries_match_sequential_runs(tmp_path):
+    folders = make_sequences(tmp_path)
+    results = tmp_path / 'results.jsonl'
+
+    summaries = list(run_batch(find_sequences([tmp_path / 'vial*']), results, workers=2))
+    assert len(summaries) == 3
+
+    lines = results.read_text().splitlines()
+    assert sorted(json.loads(line)['sequence'] for line in lines) == [str(folder.resolve()) for folder in folders]
+
+    reference = summarize_sequence(folders[0].resolve())
+    batched = read_results(results)[str(folders[0].resolve())]
+    for key in ('frames', 'tracks', 'particles', 'moving', 'stationary'):
+        assert batched[key] == reference[key]
+    assert batched['frames'] == 5
+    assert batched['tracks'] >= 3
+
+
+def test_only_frame_by_frame_detection_skips_the_last_frames(tmp_path):
+    folder = make_sequences(tmp_path, 1)[0].resolve()
+
+    assert summarize_sequence(folder, distance=2, detector=ContourDetector())['frames'] == 4
+    assert summarize_sequence(folder, distance=0)['frames'] == 6
+    assert summarize_sequence(folder, distance=2, detector=MotionDetector(distance=2))['frames'] == 6
+
+
+def test_batch_resumes(tmp_path):
+    folders = make_sequences(tmp_path)
+    results = tmp_path / 'results.jsonl'
+
+    # A finished sequence, a failed one and a line cut off by a crash
+    done = summarize_sequence(folders[0].resolve())
+    failed = {'sequence': str(folders[1].resolve()), 'error': 'IOError'}
+    results.write_text(json.dumps(done) + '\n' + json.dumps(failed) + '\n{"sequence": "/cut')
+
+    summaries = list(run_batch(find_sequences(folders), results, workers=2))
+
+    assert sorted(summary['sequence'] for summary in summaries) == [str(folder.resolve()) for folder in folders[1:]]
+    assert all('error' not in summary for summary in summaries)
+    assert len(read_results(results)) == 3
+    assert list(run_batch(find_sequences(folders), results)) == []
+
+
+def test_errors_are_recorded(tmp_path):
+    broken = tmp_path / 'broken'
+    broken.mkdir()
+    for i in range(3):
+        (broken / f'VimbaImage_{i}.png').write_bytes(b'not a png')
+
+    summary = summarize_sequence(broken)
+    assert summary['sequence'] == str(broken)
+    assert summary['error'].startswith('OSError')
+
+
+def test_roi_sidecar_is_reused(tmp_path):
+    path = SyntheticVial(640, 360, frames=8).write_sequence(tmp_path / 'vial.dfseq')
+
+    first = summarize_sequence(path, roi_sidecar=True)
+    assert not first['roi_reused']
+    assert (tmp_path / 'vial.roi.json').is_file()
+
+    assert find_sequences([tmp_path / '*']) == [path.resolve()]
+
+    second = summarize_sequence(path, roi_sidecar=True)
+    assert second['roi_reused']
+    for key in ('frames', 'tracks', 'particles', 'moving', 'stationary'):
+        assert second[key] == first[key]
@@ -0,0 +1,180 @@
+"""Benchmarks of the vision hot paths on synthetic vial sequences
+
+Only run with --benchmark, see conftest.py. For example:
+
+    python -m pytest defector/test/test_benchmark.py --benchmark --benchmark-save baseline.json
+    python -m pytest defector/test/test_benchmark.py --benchmark --benchmark-compare baseline.json
+"""
+
+import subprocess
+import sys
+import tracemalloc
+from functools import lru_cache
+
+import numpy as np
+import pytest
+
+from defector import helpers
+from defector.helpers import DETECTIONS, ContourDetector, contour_features, create_detector, find_contours, remove_stationary_contours, roi_crop
+from defector.pipeline import SequenceTracker, detect_sequence, open_input
+from defector.synthetic import SyntheticVial, match_centroids
+from defector.test.test_cli import DEFECTOR
+from defector.tracker import Tracker
+
+pytestmark = pytest.mark.benchmark
+
+FRAMES = 20
+RESOLUTIONS = {'360p': (640, 360), '720p': (1280, 720), '1216p': (1936, 1216)}
+PARTICLES = (10, 100)
+
+
+@lru_cache(maxsize=None)
+def sequence(resolution, particles):
+    """Generate a sequence, and the input of every stage of the pipeline"""
+    vial = SyntheticVial(*RESOLUTIONS[resolution], particles=particles, frames=FRAMES)
+    frames = list(vial)
+
+    roi_frames = [roi_crop(frame, idx == 0)[1] for idx, frame in enumerate(frames)]
+    contours = [find_contours(frame, draw=False)[0] for frame in roi_frames]
+
+    helpers._stationary_filter = None
+    moving = [remove_stationary_contours(frame_contours, 5, 5, 10) for frame_contours in contours]
+
+    return vial, frames, roi_frames, contours, moving
+
+
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_roi_crop(bench, resolution):
+    _, frames, _, _, _ = sequence(resolution, PARTICLES[0])
+
+    def run():
+        roi_crop(frames[0], True)
+        for frame in frames[1:]:
+            roi_crop(frame, False)
+
+    bench(run, FRAMES)
+
+
+@pytest.mark.parametrize('particles', PARTICLES)
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_find_contours(bench, resolution, particles):
+    _, _, roi_frames, _, _ = sequence(resolution, particles)
+
+    def run():
+        for frame in roi_frames:
+            find_contours(frame, draw=False)
+
+    bench(run, FRAMES)
+
+
+@pytest.mark.parametrize('buffers', ('reused', 'allocated'))
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_contour_detector(bench, resolution, buffers):
+    """ContourDetector reusing its buffers, against a new detector per frame like the old find_contours"""
+    _, _, roi_frames, _, _ = sequence(resolution, PARTICLES[0])
+    detector = ContourDetector()
+
+    def detect(frame):
+        (detector if buffers == 'reused' else ContourDetector()).detect(frame)
+
+    def run():
+        for frame in roi_frames:
+            detect(frame)
+
+    bench(run, FRAMES)
+
+    # Peak memory allocated while detecting a frame, after the first
+    detect(roi_frames[0])
+    tracemalloc.start()
+    detect(roi_frames[1])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    bench.note(peak_alloc_mb=peak / 2**20)
+
+
+@pytest.mark.parametrize('threads', (1, 2, 4))
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_black_hat_threads(bench, resolution, threads):
+    """The black hat, threshold and opening of strips of the frame on a thread pool"""
+    _, _, roi_frames, _, _ = sequence(resolution, PARTICLES[0])
+    detector = ContourDetector(threads=threads)
+
+    def run():
+        for frame in roi_frames:
+            detector.detect(frame)
+
+    bench(run, FRAMES)
+
+
+@pytest.mark.parametrize('detection', DETECTIONS)
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_detection(bench, resolution, detection):
+    """The detection modes. recall is the share of the black hat contours found, the motion detections skip the static ones"""
+    _, _, roi_frames, reference, _ = sequence(resolution, PARTICLES[1])
+    detector = create_detector(detection)
+    contours = []
+
+    def run():
+        detector.reset()
+        contours[:] = [detector.detect(frame) for frame in roi_frames]
+
+    bench(run, FRAMES)
+    recall = [match_centroids(contour_features(found)['centroid'], contour_features(expected)['centroid'])['recall'] for found, expected in zip(contours, reference)]
+    bench.note(contours=sum(len(frame_contours) for frame_contours in contours) / FRAMES, recall=np.mean(recall))
+
+
+@pytest.mark.parametrize('particles', PARTICLES)
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_remove_stationary_contours(bench, resolution, particles):
+    _, _, _, contours, _ = sequence(resolution, particles)
+
+    def reset():
+        helpers._stationary_filter = None
+
+    def run(_):
+        for frame_contours in contours:
+            remove_stationary_contours(frame_contours, 5, 5, 10)
+
+    bench(run, FRAMES, setup=reset)
+
+
+@pytest.mark.parametrize('particles', PARTICLES)
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_tracker_update(bench, resolution, particles):
+    _, _, _, _, moving = sequence(resolution, particles)
+
+    def run(tracker):
+        for frame_contours in moving:
+            tracker.Update(frame_contours)
+
+    bench(run, FRAMES, setup=lambda: Tracker(50, 5, 5, 100, 0.5))
+
+
+@pytest.mark.parametrize('input', ('png', 'dfseq'))
+@pytest.mark.parametrize('particles', PARTICLES)
+@pytest.mark.parametrize('resolution', RESOLUTIONS)
+def test_framediff(bench, tmp_path, resolution, particles, input):
+    """The headless framediff pipeline, from reading the frames to tracking"""
+    vial = sequence(resolution, particles)[0]
+    if input == 'png':
+        vial.write_folder(tmp_path)
+        path = tmp_path
+    else:
+        path = vial.write_sequence(tmp_path / 'vial.dfseq')
+
+    def run():
+        frames, read = open_input(path)
+        sequence_tracker = SequenceTracker()
+        for detections in detect_sequence(frames[:-1], read=read):
+            sequence_tracker.update(detections)
+
+    bench(run, FRAMES - 1)
+
+
+def test_startup(bench):
+    """Starts of `defector hello` per second"""
+
+    def run():
+        subprocess.run([sys.executable, DEFECTOR, 'hello'], check=True, capture_output=True)
+
+    bench(run, 1)
@@ -0,0 +1,185 @@
+"""Tests for the lens calibration and the fused ROI remap"""
+
+import pickle
+
+import cv2
+import numpy as np
+import pytest
+
+from defector.calibration import CameraCalibration, board_points, find_checkerboard
+from defector.helpers import CROP_TOLERANCE, RoiCache, RoiTransform
+from defector.synthetic import SyntheticVial
+
+PATTERN = (9, 6)
+SQUARE = 40
+IMAGE_SIZE = (800, 600)
+CAMERA_MATRIX = np.array([[700, 0, 410], [0, 700, 290], [0, 0, 1]], dtype=np.float64)
+DIST_COEFFS = np.array([-0.25, 0.1, 0.001, -0.001, 0])
+
+# (rvec, tvec) of the board in every view, in units of squares
+POSES = [
+    ((0.0, 0.0, 0.0), (-4, -2.5, 14)),
+    ((0.3, 0.0, 0.0), (-4, -2.5, 13)),
+    ((-0.3, 0.1, 0.0), (-4.5, -3, 14)),
+    ((0.0, 0.35, 0.1), (-4, -2.5, 13)),
+    ((0.0, -0.35, -0.1), (-3.5, -2.5, 15)),
+    ((0.25, 0.25, 0.2), (-5, -3, 14)),
+    ((-0.2, -0.3, 0.0), (-2.5, -1.5, 12)),
+]
+
+
+def draw_board():
+    """An image of the checkerboard, one pixel per 1/SQUARE square, with a white margin of one square"""
+    columns, rows = PATTERN[0] + 1, PATTERN[1] + 1
+    board = np.full(((rows + 2) * SQUARE, (columns + 2) * SQUARE), 255, np.uint8)
+    for row in range(rows):
+        for column in range(columns):
+            if (row + column) % 2 == 0:
+                board[(row + 1) * SQUARE:(row + 2) * SQUARE, (column + 1) * SQUARE:(column + 2) * SQUARE] = 0
+    return board
+
+
+def render_view(board, rvec, tvec):
+    """Render the board seen by the distorted camera
+
+    The board points are in units of squares, with the first inner corner at the origin.
+    """
+    # Undistorted, normalized camera coordinates of every pixel
+    xx, yy = np.meshgrid(np.arange(IMAGE_SIZE[0], dtype=np.float64), np.arange(IMAGE_SIZE[1], dtype=np.float64))
+    pixels = np.stack((xx, yy), axis=-1).reshape(-1, 1, 2)
+    normalized = cv2.undistortPoints(pixels, CAMERA_MATRIX, DIST_COEFFS).reshape(-1, 2)
+
+    # Homography from the board plane to the normalized image plane
+    rotation, _ = cv2.Rodrigues(np.array(rvec, dtype=np.float64))
+    homography = np.column_stack((rotation[:, 0], rotation[:, 1], tvec))
+    board_coords = cv2.perspectiveTransform(normalized.reshape(-1, 1, 2), np.linalg.inv(homography)).reshape(-1, 2)
+
+    # Inner corner (0, 0) is at (2 * SQUARE, 2 * SQUARE) in the board image
+    maps = ((board_coords + 2) * SQUARE - 0.5).astype(np.float32).reshape(IMAGE_SIZE[1], IMAGE_SIZE[0], 2)
+    return cv2.remap(board, maps[..., 0], maps[..., 1], cv2.INTER_LINEAR, None, cv2.BORDER_CONSTANT, 255)
+
+
+@pytest.fixture(scope='module')
+def calibration():
+    board = draw_board()
+    views = [render_view(board, rvec, tvec) for rvec, tvec in POSES]
+    return CameraCalibration.from_images(views, PATTERN, square_size=1)
+
+
+def test_board_points():
+    points = board_points(PATTERN, 2)
+    assert points.shape == (54, 3)
+    assert tuple(points[1]) == (2, 0, 0)
+    assert tuple(points[PATTERN[0]]) == (0, 2, 0)
+
+
+def test_find_checkerboard():
+    view = render_view(draw_board(), *POSES[0])
+    assert find_checkerboard(view, PATTERN).shape == (54, 1, 2)
+    assert find_checkerboard(np.full_like(view, 255), PATTERN) is None
+
+
+def test_calibration_recovers_the_lens(calibration):
+    assert calibration.views == len(POSES)
+    assert calibration.image_size == IMAGE_SIZE
+    assert calibration.rms < 0.5
+    assert np.allclose(calibration.camera_matrix, CAMERA_MATRIX, rtol=0.02, atol=5)
+
+    # The calibrated lens distorts the image like the true one
+    xx, yy = np.meshgrid(np.linspace(50, 750, 15), np.linspace(50, 550, 11))
+    points = np.stack((xx, yy), axis=-1)
+    truth = CameraCalibration(CAMERA_MATRIX, DIST_COEFFS, IMAGE_SIZE).distort_points(points)
+    assert np.abs(calibration.distort_points(points) - truth).max() < 1.5
+
+
+def test_distort_points_inverts_undistort_points():
+    lens = CameraCalibration(CAMERA_MATRIX, DIST_COEFFS, IMAGE_SIZE)
+    raw = np.array([[[100.0, 80.0]], [[700.0, 500.0]], [[410.0, 290.0]]])
+    undistorted = cv2.undistortPoints(raw, CAMERA_MATRIX, DIST_COEFFS, P=CAMERA_MATRIX)
+    assert np.allclose(lens.distort_points(undistorted), raw, atol=0.01)
+
+
+def test_too_few_views():
+    with pytest.raises(ValueError):
+        CameraCalibration.from_images([np.full((600, 800), 255, np.uint8)] * 3, PATTERN)
+
+
+def test_calibration_save_and_load(tmp_path, calibration):
+    calibration.save(tmp_path / 'calibration.json')
+    loaded = CameraCalibration.load(tmp_path / 'calibration.json')
+    assert loaded == calibration
+    assert loaded.rms == calibration.rms
+    assert loaded != CameraCalibration(CAMERA_MATRIX, DIST_COEFFS, IMAGE_SIZE)
+
+
+def reference_apply(transform, frame):
+    """Cut the vial out with a separate undistortion, perspective warp and crop"""
+    if transform.calibration is not None:
+        frame = transform.calibration.undistort(frame)
+    rotated = transform.rotate(frame)
+    if transform.crop_params is not None:
+        x1, _, x2, y2 = transform.crop_params
+        rotated = rotated[0:y2, x1 + CROP_TOLERANCE:x2 - CROP_TOLERANCE]
+    return rotated
+
+
+@pytest.mark.parametrize('crop_params', (None, (20, 0, 400, 130)))
+def test_fused_remap_matches_warp_and_crop(crop_params):
+    frame = SyntheticVial(640, 360, frames=1, noise=5)[0]
+    transform = RoiTransform.from_frame(frame)
+    transform.crop_params = crop_params
+
+    fused = transform.apply(frame)
+    reference = reference_apply(transform, frame)
+
+    # Only the rounding of the positions to 1/32 pixel differs, at the sharp edges
+    assert fused.shape == reference.shape
+    difference = np.abs(fused.astype(int) - reference)
+    assert difference.mean() < 0.1
+    assert np.percentile(difference, 99) <= 1
+
+
+def test_fused_remap_undistorts():
+    lens = CameraCalibration(CAMERA_MATRIX * [[0.8], [0.8], [1]], [-0.1, 0.02, 0, 0, 0], (640, 360))
+    lens.camera_matrix[:2, 2] = (320, 180)
+    frame = cv2.GaussianBlur(SyntheticVial(640, 360, frames=1)[0], (7, 7), 0)
+    transform = RoiTransform.from_frame(frame, lens)
+
+    fused = transform.apply(frame)
+    reference = reference_apply(transform, frame)
+
+    # The reference interpolates twice, so only compare the smooth frame away from the border
+    assert fused.shape == reference.shape
+    assert np.abs(fused[5:-5, 5:-5].astype(int) - reference[5:-5, 5:-5]).mean() < 1
+    # Without the calibration, the vial is cut out of the distorted frame
+    assert not np.array_equal(RoiTransform(transform.transformation_matrix, transform.crop_size, transform.crop_params).apply(frame), fused)
+
+
+def test_remap_tables_are_shared_and_not_pickled():
+    frame = SyntheticVial(640, 360, frames=1)[0]
+    transform = RoiTransform.from_frame(frame)
+    tables = transform.remap_tables()
+    assert tables[0].dtype == np.int16 and tables[1].dtype == np.uint16
+
+    copy = pickle.loads(pickle.dumps(transform))
+    assert copy._tables is None
+    assert copy.remap_tables()[0] is tables[0]
+    assert np.array_equal(copy.apply(frame), transform.apply(frame))
+
+
+def test_roi_cache_calibration(tmp_path):
+    lens = CameraCalibration(CAMERA_MATRIX * [[0.8], [0.8], [1]], [-0.1, 0.02, 0, 0, 0], (640, 360))
+    frame = SyntheticVial(640, 360, frames=1)[0]
+    path = tmp_path / 'fixture.roi.json'
+
+    RoiCache(path).transform_for(frame)
+
+    # A transform found without the calibration isn't reused with it
+    cache = RoiCache(path, calibration=lens)
+    transform = cache.transform_for(frame)
+    assert cache.found == 1
+    assert transform.calibration == lens
+
+    cache = RoiCache(path, calibration=lens)
+    assert cache.transform_for(frame).calibration == lens
+    assert cache.found == 0
@@ -0,0 +1,145 @@
+"""Tests for the capture logic of PymbaCam, with a simulated camera"""
+
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+from defector.cameras import PymbaCam
+from defector.framebuffer import FrameRingBuffer
+from defector.settle import SettleDetector
+
+
+class FakeFrame:
+    def __init__(self, frame_id, timestamp, data, complete=True):
+        self.data = SimpleNamespace(frameID=frame_id, timestamp=timestamp, receiveStatus=0 if complete else -1)
+        self._data = data
+
+    def buffer_data_numpy(self):
+        return self._data
+
+
+class FakeCamera:
+    """Delivers frames at 1000 ticks per frame to the callback until stopped. Still frames are all zeros"""
+
+    def __init__(self, callback, max_frames=1000, still=False, incomplete=()):
+        self.callback = callback
+        self.max_frames = max_frames
+        self.still = still
+        self.incomplete = incomplete
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start_frame_acquisition(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for i in range(self.max_frames):
+            if self._stop.is_set():
+                return
+            self.callback(FakeFrame(i, 1000 * i, np.full((4, 6), 0 if self.still else i % 256, dtype=np.uint8), i not in self.incomplete))
+
+    def stop_frame_acquisition(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def feature(self, name):
+        return SimpleNamespace(value={'Height': 4, 'Width': 6}[name])
+
+    def disarm(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ListWriter:
+    """Drains the buffer like a FrameWriter, keeping the frame ID and completeness of every frame"""
+
+    def __init__(self):
+        self.frames = []
+        self._thread = None
+
+    def start(self, buffer):
+        self.buffer = buffer
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            seq = self.buffer.get()
+            if seq is None:
+                return
+            slot = self.buffer.slot(seq)
+            self.frames.append((int(self.buffer.frame_ids[slot]), bool(self.buffer.complete[slot])))
+            self.buffer.release(seq)
+
+    def finish(self, framerate=0):
+        self.buffer.close()
+        self._thread.join()
+
+
+def make_cam(max_frames=1000, still=False, incomplete=()):
+    cam = PymbaCam.__new__(PymbaCam)
+    cam.__dict__.update(framerate=0, frame_count=0, target_count=0, consumer=False, first_frame=None, last_frame=None, done=threading.Event())
+    cam.camera = FakeCamera(cam.continous_cb, max_frames, still, incomplete)
+    cam.pixel_format = 'Mono8'
+    cam.tick_frequency = 100000
+    cam.buffer = FrameRingBuffer(5, (4, 6))
+    return cam
+
+
+def test_capture_stops_at_exactly_n_frames():
+    cam = make_cam()
+    cam.capture(20)
+
+    assert cam.buffer.count == cam.frame_count == 20
+    assert cam.buffer.frame_ids[cam.buffer.slot(19)] == 19
+    assert cam.framerate == 100
+
+    # Frames delivered after the target are ignored
+    cam.continous_cb(FakeFrame(99, 99000, np.zeros((4, 6), dtype=np.uint8)))
+    assert cam.buffer.count == 20
+
+
+def test_capture_counts_only_complete_frames():
+    cam = make_cam(incomplete=(3, 7))
+    cam.buffer = FrameRingBuffer(20, (4, 6))
+    writer = ListWriter()
+    cam.capture(10, writer)
+
+    # The incomplete frames are still recorded, but 10 good frames are captured
+    assert cam.frame_count == 10
+    assert writer.frames == [(i, i not in (3, 7)) for i in range(12)]
+
+
+def test_capture_stops_when_the_buffer_is_full():
+    cam = make_cam(incomplete=(3, ))
+    cam.capture(5, timeout=5)
+
+    # Nothing frees the slots without a writer, so the incomplete frame costs a good one
+    assert cam.buffer.count == 5
+    assert cam.frame_count == 4
+
+
+def test_capture_times_out():
+    cam = make_cam(max_frames=7)
+    cam.capture(20, timeout=0.5)
+
+    assert cam.buffer.count == 7
+
+
+def test_wait_until_settled_stops_acquisition():
+    cam = make_cam(still=True)
+    detector = SettleDetector(threshold=2, min_time=0, max_time=5, scale=1, roi=False)
+
+    assert not cam.wait_until_settled(detector)
+    assert len(detector.motion) >= detector.settled_frames
+    assert not cam.camera._thread.is_alive()
+
+    # The next capture starts from an empty buffer
+    cam.capture(3)
+    assert cam.buffer.count == 3
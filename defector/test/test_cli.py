@@ -0,0 +1,84 @@
+"""Tests for the startup of the defector command"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+from defector import helpers
+from defector.cli.capture import ENCODINGS
+from defector.cli.framediff import DETECTIONS
+from defector.synthetic import SyntheticVial
+from defector.writer import FrameWriter
+
+PROJECT_DIR = Path(__file__).resolve().parents[2]
+DEFECTOR = str(PROJECT_DIR.joinpath('bin', 'defector'))
+
+# Dependencies only some subcommands need, and that aren't installed on every machine
+HEAVY_MODULES = ('cv2', 'numpy', 'scipy', 'pymba', 'serial', 'crcmod', 'filterpy')
+
+# Runs bin/defector with pymba, the Vimba SDK wrapper, missing
+WITHOUT_VIMBA = """
+import runpy, sys
+sys.modules['pymba'] = None
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def run_python(code, *args):
+    return subprocess.run([sys.executable, '-c', code, *args], cwd=PROJECT_DIR, capture_output=True, text=True)
+
+
+def test_import_cli_loads_no_heavy_dependencies():
+    code = "import json, sys, milc, defector.cli; print(json.dumps([sorted(milc.cli.subcommands), sorted(sys.modules)]))"
+    result = run_python(code)
+    assert result.returncode == 0, result.stderr
+
+    subcommands, modules = json.loads(result.stdout)
+    assert {'batch', 'capture', 'convert', 'framediff', 'hello', 'inspect'} <= set(subcommands)
+    assert not [module for module in modules if module.split('.')[0] in HEAVY_MODULES]
+
+
+def test_cameras_import_without_vimba():
+    result = run_python("import sys; sys.modules['pymba'] = None; import defector.cameras")
+    assert result.returncode == 0, result.stderr
+
+
+def test_help_lists_subcommands():
+    result = subprocess.run([sys.executable, DEFECTOR, '--help'], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    for subcommand in ('batch', 'capture', 'convert', 'framediff', 'inspect'):
+        assert subcommand in result.stdout
+
+
+def test_framediff_without_vimba(tmp_path):
+    path = SyntheticVial(640, 360, frames=5).write_sequence(tmp_path / 'vial.dfseq')
+
+    result = run_python(WITHOUT_VIMBA, DEFECTOR, 'framediff', '-i', str(path), '--headless', '--no-save')
+    assert result.returncode == 0, result.stderr
+    assert 'moving' in result.stdout
+
+
+def test_invalid_input_path_is_a_usage_error(tmp_path):
+    for subcommand in ('framediff', 'convert'):
+        result = run_python(WITHOUT_VIMBA, DEFECTOR, subcommand, '-i', str(tmp_path / 'missing'))
+        assert result.returncode == 2, result.stderr
+        assert 'is not a directory' in result.stderr
+        assert 'Traceback' not in result.stderr
+
+
+def test_framediff_motion_detection(tmp_path):
+    path = SyntheticVial(640, 360, frames=5).write_sequence(tmp_path / 'vial.dfseq')
+
+    result = run_python(WITHOUT_VIMBA, DEFECTOR, 'framediff', '-i', str(path), '--headless', '--no-save', '--detection', 'median', '--history', '3')
+    assert result.returncode == 0, result.stderr
+    assert 'moving' in result.stdout
+
+
+def test_detections_match_the_helpers():
+    assert DETECTIONS == helpers.DETECTIONS
+
+
+def test_capture_encodings_match_the_writer():
+    assert set(ENCODINGS) == set(FrameWriter.ENCODINGS)
@@ -0,0 +1,90 @@
+"""Tests for the jig controller, against the firmware emulator"""
+
+import sys
+from concurrent.futures import CancelledError, Future
+
+import pytest
+
+from defector.communication import JigController, crc16, make_packet
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="The emulator needs a pseudo-terminal")
+
+
+@pytest.fixture
+def emulator():
+    from defector.emulator import JigEmulator
+
+    with JigEmulator() as emulator:
+        yield emulator
+
+
+def test_packet_matches_firmware_layout():
+    # The CRC-16/CCITT-FALSE check value, as computed by FastCRC16::ccitt
+    assert crc16(b'123456789') == 0x29b1
+
+    # int16 speed, uint16 accel, uint16 decel, uint16 CRC, all little endian
+    assert make_packet(-200, 5000, 125) == b'!' + bytes.fromhex('38ff 8813 7d00 bc4a')
+
+    with pytest.raises(ValueError):
+        make_packet(1001, 5000)
+
+
+def test_commands_are_acked(emulator):
+    with JigController(emulator.port) as jig:
+        assert jig.set_speed(200, 5000)
+        futures = [jig.send(speed, 5000, 4000) for speed in range(100, 1000, 100)]
+        assert all(future.result() for future in futures)
+
+    assert emulator.packets[0] == (200, 5000, 5000)
+    assert emulator.packets[1:] == [(speed, 5000, 4000) for speed in range(100, 1000, 100)]
+    assert emulator.speed == 900
+
+
+def test_nack_and_timeout(emulator):
+    with JigController(emulator.port, ack_timeout=0.2) as jig:
+        # A corrupted packet is rejected by the firmware
+        jig.serial.write(make_packet(200, 5000)[:-1] + b'\0')
+        assert emulator.wait_for(1)
+
+    assert emulator.rejected == 1
+
+
+def test_packets_with_start_byte_are_nudged(emulator):
+    # The CRC of speed 235 at 5000 contains '!', which restarts the packet in the firmware
+    data = (235).to_bytes(2, 'little', signed=True) + (5000).to_bytes(2, 'little') * 2
+    packet = b'!' + data + crc16(data).to_bytes(2, 'little')
+    assert b'!' in packet[1:]
+
+    # The acceleration and deceleration are moved by one instead, and speed 33 is 0x21 itself
+    assert b'!' not in make_packet(235, 5000)[1:]
+    assert b'!' not in make_packet(33, 5000)[1:]
+
+    with JigController(emulator.port, ack_timeout=0.2) as jig:
+        assert jig.set_speed(235, 5000)
+
+        # A command that is never acked times out, and the ack of the next one isn't attributed to it
+        dropped = Future()
+        jig._commands.put((packet, 0, dropped))
+        assert jig.set_speed(100, 5000)
+        with pytest.raises(TimeoutError):
+            dropped.result()
+
+    assert emulator.packets == [(235, 5001, 5001), (100, 5000, 5000)]
+
+
+def test_close_without_open():
+    JigController('/dev/null').close()
+
+
+def test_stop_drops_queued_profile(emulator):
+    with JigController(emulator.port) as jig:
+        profile = jig.run_profile([(200, 5000, 5000, 10), (400, 5000, 5000, 10), (0, 5000, 5000, 0)])
+        assert profile[0].result()
+        assert jig.stop().result()
+
+        for future in profile[1:]:
+            with pytest.raises(CancelledError):
+                future.result()
+
+    assert emulator.packets == [(200, 5000, 5000), (0, 5000, 5000)]
+    assert emulator.speed == 0
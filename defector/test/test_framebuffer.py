@@ -0,0 +1,79 @@
+"""Tests for the frame ring buffer"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from defector.framebuffer import FrameRingBuffer
+
+
+def test_frames_in_order():
+    buffer = FrameRingBuffer(4, (2, 3))
+    for i in range(10):
+        seq = buffer.put(np.full((2, 3), i, dtype=np.uint8), 100 + i, 1000 * i)
+        assert buffer.get(0) == seq
+        assert buffer.frame(seq)[0, 0] == i
+        assert buffer.frame_ids[buffer.slot(seq)] == 100 + i
+        buffer.release(seq)
+
+    assert buffer.count == 10
+    assert len(buffer) == 0
+    assert buffer.overflows == 0
+
+
+def test_overflow_is_counted():
+    buffer = FrameRingBuffer(3, (2, 2))
+    results = [buffer.put(np.zeros((2, 2), dtype=np.uint8), i) for i in range(5)]
+
+    assert results == [0, 1, 2, None, None]
+    assert buffer.overflows == 2
+    assert list(buffer.stored()) == [0, 1, 2]
+
+
+def test_out_of_order_release():
+    buffer = FrameRingBuffer(2, (1, ))
+    a = buffer.put(np.zeros(1, dtype=np.uint8), 0)
+    b = buffer.put(np.zeros(1, dtype=np.uint8), 1)
+    buffer.get(0), buffer.get(0)
+
+    buffer.release(b)
+    assert buffer.put(np.zeros(1, dtype=np.uint8), 2) is None
+    buffer.release(a)
+    assert buffer.put(np.zeros(1, dtype=np.uint8), 3) == 2
+
+
+def test_incomplete_frames_are_not_copied():
+    buffer = FrameRingBuffer(2, (2, ))
+    seq = buffer.put(None, 7, complete=False)
+    assert not buffer.complete[buffer.slot(seq)]
+    assert buffer.frame_ids[buffer.slot(seq)] == 7
+
+
+def test_wrong_dtype_is_rejected():
+    buffer = FrameRingBuffer(2, (2, ))
+    with pytest.raises(TypeError):
+        buffer.put(np.zeros(2, dtype=np.uint16), 0)
+
+
+def test_threaded_consumer():
+    buffer = FrameRingBuffer(8, (16, ))
+    received = []
+
+    def consume():
+        while True:
+            seq = buffer.get()
+            if seq is None:
+                return
+            received.append(int(buffer.frame(seq)[0]))
+            buffer.release(seq)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    for i in range(200):
+        while buffer.put(np.full(16, i % 256, dtype=np.uint8), i) is None:
+            pass
+    buffer.close()
+    consumer.join()
+
+    assert received == [i % 256 for i in range(200)]
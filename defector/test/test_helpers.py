@@ -0,0 +1,443 @@
+"""Tests for the helper functions"""
+
+import pickle
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist, euclidean
+
+from defector.helpers import ContourDetector, MotionDetector, PyramidDetector, RoiCache, RoiTransform, contour_features, create_detector, find_contours, get_centroid, shared_contour_detector, StationaryFilter, check_for_black, get_plug_crop, locate_plug, roi_sidecar_path, search_vertical
+from defector.synthetic import SyntheticVial, match_centroids
+
+
+class ReferencePoint:
+    def __init__(self, point):
+        self.point = point
+        self.life = 0
+        self.skipped_frames = 0
+        self.found = False
+
+
+def reference_filter(reference_points, centroids, thresh, interval, max_skipped_frames, max_reference_points):  # noqa: C901
+    """The original per-pair implementation of remove_stationary_contours, returning the kept indices"""
+    if reference_points is None:
+        return [ReferencePoint(c) for c in centroids], list(range(len(centroids)))
+
+    for point in reference_points:
+        point.found = False
+
+    discarded, assigned = [], []
+    for idx_c, centroid in enumerate(centroids):
+        for point in reference_points:
+            if euclidean(centroid, point.point) <= thresh:
+                if idx_c not in assigned:
+                    assigned.append(idx_c)
+                point.life += 1
+                point.found = True
+                point.skipped_frames = 0
+                if point.life >= interval and idx_c not in discarded:
+                    discarded.append(idx_c)
+
+    for idx_c, centroid in enumerate(centroids):
+        if idx_c not in assigned and len(reference_points) < max_reference_points:
+            reference_points.append(ReferencePoint(centroid))
+
+    for point in reference_points:
+        if not point.found:
+            point.skipped_frames += 1
+    reference_points = [point for point in reference_points if point.skipped_frames <= max_skipped_frames]
+
+    return reference_points, [i for i in range(len(centroids)) if i not in discarded]
+
+
+def test_stationary_filter_matches_reference():
+    rng = np.random.default_rng(0)
+    params = (5, 5, 2, 40)
+    stationary_filter = StationaryFilter(*params)
+    reference_points = None
+
+    static = rng.integers(0, 200, (30, 2))
+    for frame in range(50):
+        moving = rng.integers(0, 200, (rng.integers(0, 20), 2))
+        jittered = static + rng.integers(-3, 4, static.shape)
+        centroids = np.concatenate((jittered[rng.random(len(static)) > 0.2], moving))
+        rng.shuffle(centroids)
+
+        stationary = stationary_filter.match(centroids)
+        reference_points, kept = reference_filter(reference_points, list(centroids), *params)
+
+        assert np.flatnonzero(~stationary).tolist() == kept
+        assert len(stationary_filter) == len(reference_points)
+        np.testing.assert_array_equal(stationary_filter.life, [p.life for p in reference_points])
+
+
+def test_stationary_filter_accepts_feature_table():
+    vial = SyntheticVial(640, 360, particles=30, frames=6, noise=3)
+    transform = RoiTransform.from_frame(vial[0])
+    from_contours = StationaryFilter(5, 2)
+    from_features = StationaryFilter(5, 2)
+
+    for frame in vial:
+        contours = find_contours(transform.apply(frame), draw=False)[0]
+        moving = from_features.filter(contour_features(contours))
+        expected = from_contours.filter(contours)
+        assert [contours[idx] for idx in moving['index']] == expected
+
+
+def test_stationary_filter_instances_are_independent():
+    a = StationaryFilter(2, 2)
+    b = StationaryFilter(2, 2)
+    for _ in range(3):
+        a.match([[10, 10]])
+    assert a.match([[10, 10]]).all()
+    assert not b.match([[10, 10]]).any()
+
+    restored = pickle.loads(pickle.dumps(a))
+    assert restored.match([[10, 10]]).all()
+
+
+def reference_search_vertical(frame, direction):
+    """The original pixel-by-pixel implementation of search_vertical"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    _, threshed = cv2.threshold(gray, 20, 255, cv2.THRESH_BINARY)
+    rows, cols = gray.shape
+    for col in range(cols)[::direction]:
+        black_vertical = rows - np.count_nonzero([threshed[row, col] for row in range(rows)])
+        if black_vertical < 5:
+            return col, rows
+    return 0, rows
+
+
+def make_vial_frame(seed, rows=60, cols=120):
+    """A bright frame with a dark plug on the left, dark background on the right and black noise"""
+    rng = np.random.default_rng(seed)
+    frame = np.full((rows, cols, 3), 200, dtype=np.uint8)
+    frame[:, :rng.integers(0, 30)] = 10
+    frame[:, cols - rng.integers(0, 30):] = 15
+    frame[rng.integers(0, rows, 100), rng.integers(0, cols, 100)] = 0
+    return frame
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_plug_search_matches_reference(seed):
+    frame = make_vial_frame(seed)
+
+    for direction in (1, -1):
+        assert search_vertical(frame, direction) == reference_search_vertical(frame, direction)
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    assert check_for_black(frame) == (gray <= 20).sum() / gray.size * 100
+
+    x, y, w, h = get_plug_crop(frame)
+    assert (x, y, w, h) == reference_search_vertical(frame, 1) + reference_search_vertical(frame, -1)
+    assert locate_plug(frame) == ((x, y, w, h) if check_for_black(frame) > 1.5 else None)
+
+
+def test_search_vertical_direction():
+    with pytest.raises(ValueError):
+        search_vertical(make_vial_frame(0), 0)
+
+
+def test_roi_transform_save_and_load(tmp_path):
+    frame = SyntheticVial(640, 360, frames=1)[0]
+    transform = RoiTransform.from_frame(frame)
+
+    transform.save(tmp_path / 'vial.roi.json')
+    loaded = RoiTransform.load(tmp_path / 'vial.roi.json')
+
+    assert np.array_equal(loaded.apply(frame), transform.apply(frame))
+    assert np.array_equal(loaded.silhouette, transform.silhouette)
+    assert loaded.frame_shape == frame.shape
+    assert loaded.matches(frame)
+    assert list(tmp_path.iterdir()) == [tmp_path / 'vial.roi.json']
+
+
+def test_roi_transform_matches():
+    transform = RoiTransform.from_frame(SyntheticVial(640, 360, frames=1)[0])
+
+    # Other particles in the same fixture
+    assert transform.matches(SyntheticVial(640, 360, particles=30, frames=1, seed=1)[0])
+    # A rotated vial, or another camera resolution
+    assert not transform.matches(SyntheticVial(640, 360, frames=1, angle=8)[0])
+    assert not transform.matches(SyntheticVial(800, 360, frames=1)[0])
+    # Transforms without a silhouette are never reused
+    assert not RoiTransform(transform.transformation_matrix, transform.crop_size).matches(SyntheticVial(640, 360, frames=1)[0])
+
+
+def test_roi_cache_reuses_saved_transform(tmp_path, monkeypatch):
+    path = tmp_path / 'fixture.roi.json'
+    frame = SyntheticVial(640, 360, frames=1)[0]
+
+    cache = RoiCache(path)
+    found = cache.transform_for(frame)
+    assert cache.found == 1
+    assert path.is_file()
+
+    def from_frame(frame):
+        raise AssertionError('The transform should have been reused')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(RoiTransform, 'from_frame', from_frame)
+        cache = RoiCache(path)
+        reused = cache.transform_for(SyntheticVial(640, 360, frames=1, seed=1)[0])
+    assert cache.found == 0
+    assert np.array_equal(reused.transformation_matrix, found.transformation_matrix)
+
+    # The fixture changed, so the transform is found again and replaces the saved one
+    rotated = SyntheticVial(640, 360, frames=1, angle=8)[0]
+    cache.transform_for(rotated)
+    assert cache.found == 1
+    assert RoiTransform.load(path).matches(rotated)
+
+
+def test_roi_cache_ignores_corrupt_files(tmp_path):
+    path = tmp_path / 'fixture.roi.json'
+    path.write_text('{"crop_size": ')
+
+    cache = RoiCache(path)
+    cache.transform_for(SyntheticVial(640, 360, frames=1)[0])
+    assert cache.found == 1
+    assert RoiTransform.load(path).silhouette is not None
+
+
+def test_roi_sidecar_path(tmp_path):
+    (tmp_path / 'vial0').mkdir()
+    (tmp_path / 'vial0.dfseq').touch()
+
+    assert roi_sidecar_path(tmp_path / 'vial0') == tmp_path / 'vial0.roi.json'
+    assert roi_sidecar_path(tmp_path / 'vial0.dfseq') == tmp_path / 'vial0.roi.json'
+
+
+def reference_find_contours(frame):
+    """The original find_contours, allocating every image and kernel"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    black_hat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (25, 25)))
+    _, binary = cv2.threshold(black_hat, 7, 255, cv2.THRESH_BINARY)
+    opening = cv2.morphologyEx(binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2)))
+    contours, _ = cv2.findContours(opening, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    return [c for c in contours if len(c) <= 150 or cv2.contourArea(c) <= 200]
+
+
+def test_contour_detector_matches_reference():
+    vial = SyntheticVial(640, 360, particles=30, frames=4, noise=3)
+    transform = RoiTransform.from_frame(vial[0])
+    detector = ContourDetector()
+
+    for frame in vial:
+        roi = transform.apply(frame)
+        contours = detector.detect(roi)
+        reference = reference_find_contours(roi)
+        assert len(contours) == len(reference)
+        assert all(np.array_equal(a, b) for a, b in zip(contours, reference))
+        assert all(np.array_equal(a, b) for a, b in zip(find_contours(roi, draw=False)[0], reference))
+
+
+def test_contour_detector_reuses_buffers():
+    vial = SyntheticVial(1280, 720, particles=30, frames=3)
+    transform = RoiTransform.from_frame(vial[0])
+    frames = [transform.apply(frame) for frame in vial]
+    detector = ContourDetector()
+
+    detector.detect(frames[0])
+    buffers = (detector.gray, detector.black_hat, detector.binary, detector.opened)
+
+    tracemalloc.start()
+    try:
+        detector.detect(frames[1])
+        _, reused_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        reference_find_contours(frames[2])
+        _, reference_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert all(a is b for a, b in zip(buffers, (detector.gray, detector.black_hat, detector.binary, detector.opened)))
+    # The reference holds a gray, black hat, binary and opened image at once
+    gray_size = frames[1].shape[0] * frames[1].shape[1]
+    assert reused_peak < gray_size / 2
+    assert reference_peak >= 2 * gray_size
+
+    # Another ROI size reallocates
+    detector.detect(frames[1][:100])
+    assert detector.gray.shape == (100, frames[1].shape[1])
+
+
+def test_contour_detector_parameters():
+    vial = SyntheticVial(640, 360, particles=30, frames=1, noise=3)
+    roi = RoiTransform.from_frame(vial[0]).apply(vial[0])
+
+    detector = ContourDetector()
+    default = detector.detect(roi)
+    strict = ContourDetector(threshold=60)
+    strict.detect(roi)
+    assert np.count_nonzero(strict.opened) < np.count_nonzero(detector.opened)
+    assert ContourDetector(black_hat_size=3).detect(roi) != default
+    assert len(ContourDetector(max_contour_length=0, max_contour_area=0).detect(roi)) == 0
+
+
+@pytest.mark.parametrize('threads', (2, 3, 7))
+def test_contour_detector_strips_match_single_call(threads):
+    vial = SyntheticVial(1280, 720, particles=30, frames=2, noise=3)
+    roi = RoiTransform.from_frame(vial[0]).apply(vial[1])
+    detector = ContourDetector(threads=threads)
+    single = ContourDetector()
+
+    for frame in (roi, cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY), roi[:threads * 3], roi):
+        contours = detector.detect(frame)
+        reference = single.detect(frame)
+        np.testing.assert_array_equal(detector.black_hat, single.black_hat)
+        np.testing.assert_array_equal(detector.opened, single.opened)
+        assert len(contours) == len(reference)
+        assert all(np.array_equal(a, b) for a, b in zip(contours, reference))
+    assert 1 < len(detector.strips) <= threads
+
+
+def test_contour_detector_pickles_to_shared_detector():
+    detector = ContourDetector(31, 9)
+    copy = pickle.loads(pickle.dumps(detector))
+    assert copy.params() == detector.params()
+    assert copy is shared_contour_detector(31, 9)
+    assert pickle.loads(pickle.dumps(detector)) is copy
+
+
+@pytest.mark.parametrize('levels', (1, 2, 3))
+def test_pyramid_detector_matches_full_resolution(levels):
+    vial = SyntheticVial(1280, 720, particles=20, frames=4, noise=3)
+    transform = RoiTransform.from_frame(vial[0])
+    positions = vial.roi_positions(transform)
+    pyramid = PyramidDetector(levels=levels)
+    full = ContourDetector()
+
+    for idx, frame in enumerate(vial):
+        roi = transform.apply(frame)
+        contours = pyramid.detect(roi)
+        reference = full.detect(roi)
+
+        # The contours found are the ones of the full resolution detection
+        assert {c.tobytes() for c in contours} <= {c.tobytes() for c in reference}
+        centroids = contour_features(contours)['centroid']
+        assert match_centroids(centroids, contour_features(reference)['centroid'], 0)['recall'] >= 0.9
+        assert match_centroids(centroids, positions[idx])['recall'] == match_centroids(contour_features(reference)['centroid'], positions[idx])['recall']
+
+
+def test_pyramid_detector_threads_match_single_thread():
+    vial = SyntheticVial(1280, 720, particles=30, frames=2, noise=3)
+    roi = RoiTransform.from_frame(vial[0]).apply(vial[1])
+    detector = PyramidDetector(threads=3)
+    single = PyramidDetector()
+
+    contours = detector.detect(roi)
+    reference = single.detect(roi)
+    assert len(detector.windows(roi)) > 1 and detector.strips == []
+    np.testing.assert_array_equal(detector.opened, single.opened)
+    assert len(contours) == len(reference)
+    assert all(np.array_equal(a, b) for a, b in zip(contours, reference))
+
+    copy = pickle.loads(pickle.dumps(detector))
+    assert copy.threads == 3
+    assert create_detector('pyramid', threads=3).params() == detector.params()
+
+
+def test_pyramid_detector_skips_empty_frames():
+    frame = np.full((300, 500), 200, np.uint8)
+    detector = PyramidDetector()
+    assert detector.windows(frame) == []
+    assert detector.detect(frame) == []
+
+    cv2.circle(frame, (250, 150), 3, 60, -1)
+    windows = detector.windows(frame)
+    assert len(windows) == 1
+    x1, y1, x2, y2 = windows[0]
+    assert x1 <= 250 < x2 and y1 <= 150 < y2 and (x2 - x1) * (y2 - y1) < frame.size / 4
+    assert len(detector.detect(frame)) == 1
+
+    copy = pickle.loads(pickle.dumps(PyramidDetector(levels=3)))
+    assert type(copy) is PyramidDetector and copy.levels == 3
+
+
+def test_contour_features_match_per_contour_functions():
+    vial = SyntheticVial(640, 360, particles=30, frames=1, noise=3)
+    roi = RoiTransform.from_frame(vial[0]).apply(vial[0])
+    contours = find_contours(roi, draw=False)[0] + [np.array([[[3, 4]]], dtype=np.int32)]
+
+    features = contour_features(contours)
+    assert len(features) == len(contours)
+    np.testing.assert_array_equal(features['index'], np.arange(len(contours)))
+    np.testing.assert_array_equal(features['centroid'], [get_centroid(c).ravel() for c in contours])
+    np.testing.assert_array_equal(features['area'], [cv2.contourArea(c) for c in contours])
+    np.testing.assert_array_equal(features['perimeter'], [cv2.arcLength(c, True) for c in contours])
+    np.testing.assert_array_equal(features['bbox'], [cv2.boundingRect(c) for c in contours])
+    assert len(contour_features([])) == 0
+
+
+@pytest.mark.parametrize('count', range(1, 8))
+def test_motion_detector_median(count):
+    rng = np.random.default_rng(count)
+    frames = rng.integers(0, 256, (count, 30, 40), dtype=np.uint8)
+    detector = MotionDetector(history=7)
+    detector.allocate((30, 40))
+
+    for _ in range(2):
+        np.testing.assert_array_equal(detector.median(list(frames)), np.sort(frames, axis=0)[(count - 1) // 2])
+    assert len({id(buffer) for buffer in detector.sorted}) == len(detector.sorted)
+
+
+def test_motion_detector_is_frame_difference_with_history_1():
+    vial = SyntheticVial(640, 360, particles=30, frames=6, noise=3)
+    transform = RoiTransform.from_frame(vial[0])
+    grays = [cv2.cvtColor(transform.apply(frame), cv2.COLOR_BGR2GRAY) for frame in vial]
+    detector = MotionDetector(history=1, distance=2)
+
+    for idx, gray in enumerate(grays):
+        contours = detector.detect(gray)
+        if idx < 2:
+            assert contours == []
+            continue
+        _, binary = cv2.threshold(cv2.subtract(grays[idx - 2], gray), 7, 255, cv2.THRESH_BINARY)
+        opened = cv2.morphologyEx(binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2)))
+        np.testing.assert_array_equal(detector.opened, opened)
+
+
+@pytest.mark.parametrize('background', MotionDetector.BACKGROUNDS)
+def test_motion_detector_removes_static_contours(background):
+    vial = SyntheticVial(640, 360, particles=20, scratches=8, frames=16, noise=3)
+    transform = RoiTransform.from_frame(vial[0])
+    positions = vial.roi_positions(transform)
+    detector = MotionDetector(background=background)
+
+    static = moving = 0
+    for idx, frame in enumerate(vial):
+        roi = transform.apply(frame)
+        contours = detector.detect(roi)
+        if idx < 8:
+            continue
+
+        centroids = contour_features(contours)['centroid']
+        assert (cdist(centroids, positions[idx]).min(axis=1) < 6).all()
+        moving += len(contours)
+        # The black hat also finds the scratches
+        static += (cdist(contour_features(ContourDetector().detect(roi))['centroid'], positions[idx]).min(axis=1) >= 6).sum()
+
+    assert moving >= 8 * 15
+    assert static > 0
+
+
+def test_motion_detector_reset_and_pickle():
+    vial = SyntheticVial(640, 360, particles=10, frames=4)
+    roi = RoiTransform.from_frame(vial[0]).apply(vial[0])
+    detector = MotionDetector(3, 2, 9, 'mog2')
+    for _ in range(3):
+        detector.detect(roi)
+    assert detector.count == 3
+
+    copy = pickle.loads(pickle.dumps(detector))
+    assert copy.params() == detector.params() and copy.count == 0
+    detector.reset()
+    assert detector.count == 0
+
+    with pytest.raises(ValueError):
+        MotionDetector(background='mean')
+    with pytest.raises(ValueError):
+        MotionDetector(distance=0)
@@ -0,0 +1,50 @@
+"""Tests for the prefetching image loader"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+
+from defector.helpers import get_folder
+from defector.loader import ImageLoader, prefetch_map
+
+
+def slow_identity(item):
+    time.sleep(random.random() / 100)
+    return item
+
+
+def test_prefetch_map_keeps_order():
+    with ThreadPoolExecutor(4) as executor:
+        assert list(prefetch_map(slow_identity, range(50), executor, 6)) == list(range(50))
+
+
+def test_prefetch_map_is_bounded():
+    submitted = []
+
+    def record(item):
+        submitted.append(item)
+        return item
+
+    with ThreadPoolExecutor(2) as executor:
+        results = prefetch_map(record, range(100), executor, 3)
+        next(results)
+        time.sleep(0.05)
+        assert len(submitted) <= 4
+        results.close()
+
+
+def test_image_loader_in_sort_order(tmp_path):
+    for i in (10, 2, 1, 33):
+        cv2.imwrite(str(tmp_path / f'VimbaImage_{i}.png'), np.full((4, 4, 3), i, dtype=np.uint8))
+
+    images = [image[0, 0, 0] for image in ImageLoader(get_folder(tmp_path), prefetch=2, threads=3)]
+    assert images == [1, 2, 10, 33]
+
+
+def test_image_loader_missing_file(tmp_path):
+    with pytest.raises(IOError):
+        list(ImageLoader([tmp_path / 'missing.png']))
@@ -0,0 +1,89 @@
+"""Tests for the detection and tracking pipeline"""
+
+import pickle
+
+import cv2
+import numpy as np
+
+from defector.framebuffer import FrameRingBuffer
+from defector.helpers import MotionDetector, RoiTransform
+from defector.pipeline import LiveInspector, SequenceTracker, detect_sequence
+from defector.sequence import SequenceFile
+
+
+def write_sequence(folder, count=6):
+    """Write a rotated bright vial with a few dark particles moving down it"""
+    paths = []
+    for i in range(count):
+        frame = np.zeros((240, 400, 3), dtype=np.uint8)
+        box = cv2.boxPoints(((200, 120), (300, 120), 4)).astype(np.int32)
+        cv2.fillPoly(frame, [box], (200, 200, 200))
+        for x in (120, 200, 280):
+            cv2.circle(frame, (x, 80 + 5 * i), 3, (60, 60, 60), -1)
+        paths.append(folder / f'VimbaImage_{i}.png')
+        cv2.imwrite(str(paths[-1]), frame)
+    return paths
+
+
+def test_parallel_detection_matches_sequential(tmp_path):
+    paths = write_sequence(tmp_path)
+
+    sequential = list(detect_sequence(paths, workers=1))
+    parallel = list(detect_sequence(paths, workers=2, prefetch=2))
+
+    assert len(sequential) == len(parallel) == len(paths)
+    for a, b in zip(sequential, parallel):
+        np.testing.assert_array_equal(a.centroids, b.centroids)
+        assert len(a.centroids) >= 3
+
+
+def test_motion_detection_runs_sequentially(tmp_path):
+    paths = write_sequence(tmp_path)
+    detector = MotionDetector(history=2)
+
+    sequential = list(detect_sequence(paths, workers=1, detector=detector))
+    parallel = list(detect_sequence(paths, workers=2, detector=detector))
+
+    assert len(sequential[0]) == 0
+    for a, b in zip(sequential, parallel):
+        np.testing.assert_array_equal(a.centroids, b.centroids)
+    assert all(len(detections) >= 3 for detections in sequential[1:])
+
+
+def test_sequence_tracker(tmp_path):
+    sequence_tracker = SequenceTracker()
+    for detections in detect_sequence(write_sequence(tmp_path)):
+        sequence_tracker.update(detections)
+
+    assert len(sequence_tracker.tracker.tracks) >= 3
+
+
+def test_roi_transform_pickles(tmp_path):
+    frame = cv2.imread(str(write_sequence(tmp_path, 1)[0]))
+    transform = RoiTransform.from_frame(frame)
+
+    restored = pickle.loads(pickle.dumps(transform))
+    np.testing.assert_array_equal(restored.apply(frame), transform.apply(frame))
+
+
+def test_live_inspector(tmp_path):
+    frames = [cv2.imread(str(path)) for path in write_sequence(tmp_path, 8)]
+    buffer = FrameRingBuffer(2, frames[0].shape)
+    inspector = LiveInspector(save=tmp_path / 'live.dfseq', capacity=len(frames), min_detections=3)
+
+    inspector.start(buffer)
+    for i, frame in enumerate(frames):
+        while buffer.put(frame, i) is None:
+            pass
+    summary = inspector.finish(25)
+
+    assert summary['frames'] == len(frames)
+    assert summary['dropped'] == buffer.overflows > 0
+    assert summary['particles'] >= 3
+    assert summary['verdict'] == 'reject'
+    assert len(SequenceFile(tmp_path / 'live.dfseq')) == len(frames)
+
+    sequential = SequenceTracker()
+    for detections in detect_sequence(write_sequence(tmp_path, 8)):
+        sequential.update(detections)
+    assert inspector.sequence_tracker.tracker.table.ids.tolist() == sequential.tracker.table.ids.tolist()
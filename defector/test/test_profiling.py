@@ -0,0 +1,89 @@
+"""Tests for the per-stage profiling of the pipeline"""
+
+import csv
+import json
+
+import pytest
+
+from defector.batch import summarize_sequence
+from defector.pipeline import SequenceTracker, detect_sequence, open_input
+from defector.profiling import profiler
+from defector.synthetic import SyntheticVial
+
+STAGES = ('imread', 'roi_crop', 'black_hat', 'threshold', 'find_contours', 'stationary_filter', 'tracker')
+COUNTS = ('contours', 'stationary', 'tracks')
+
+
+@pytest.fixture
+def profiling():
+    profiler.enable()
+    profiler.reset()
+    yield profiler
+    profiler.disable()
+    profiler.reset()
+
+
+def run_pipeline(path, workers=1):
+    frames, read = open_input(path)
+    sequence_tracker = SequenceTracker()
+    for detections in detect_sequence(frames[:-1], workers=workers, read=read):
+        sequence_tracker.update(detections)
+    return len(frames) - 1
+
+
+@pytest.mark.parametrize('workers', (1, 2))
+def test_stages_are_recorded_per_frame(tmp_path, profiling, workers):
+    path = SyntheticVial(640, 360, frames=8).write_sequence(tmp_path / 'vial.dfseq')
+    frames = run_pipeline(path, workers)
+
+    assert len(profiling.frames) == frames
+    for frame in profiling.frames:
+        for stage in STAGES:
+            assert frame[stage] >= 0
+        assert frame['stationary'] <= frame['contours']
+        assert isinstance(frame['contours'], int)
+
+    # The ROI is found once, in this process, before the workers start
+    assert sum('roi_find' in frame for frame in profiling.frames) == 1
+
+    summary = profiling.summary()
+    assert set(STAGES) <= set(summary)
+    assert summary['imread']['p50'] <= summary['imread']['p99'] <= summary['imread']['max']
+    assert summary['wall']['frames'] == frames - 1
+    assert 'stationary_filter [ms]' in profiling.format_summary()
+
+
+def test_disabled_profiler_records_nothing(tmp_path):
+    path = SyntheticVial(640, 360, frames=5).write_sequence(tmp_path / 'vial.dfseq')
+    run_pipeline(path)
+
+    assert not profiler.frames
+    assert not profiler.timings
+
+
+def test_traces(tmp_path, profiling):
+    path = SyntheticVial(640, 360, frames=5).write_sequence(tmp_path / 'vial.dfseq')
+    frames = run_pipeline(path)
+
+    profiling.write_trace(tmp_path / 'trace.csv')
+    with open(tmp_path / 'trace.csv', newline='') as trace_file:
+        rows = list(csv.DictReader(trace_file))
+    assert len(rows) == frames
+    assert set(STAGES + COUNTS) <= set(rows[0])
+
+    profiling.write_trace(tmp_path / 'trace.json')
+    trace = json.loads((tmp_path / 'trace.json').read_text())
+    assert len(trace['frames']) == frames
+    assert trace['summary']['tracker']['frames'] == frames
+
+
+def test_batch_profile(tmp_path):
+    path = SyntheticVial(640, 360, frames=5).write_sequence(tmp_path / 'vial.dfseq')
+    try:
+        summary = summarize_sequence(path, profile=True)
+    finally:
+        profiler.disable()
+        profiler.reset()
+
+    assert summary['profile']['contours']['frames'] == summary['frames']
+    json.dumps(summary)
@@ -0,0 +1,98 @@
+"""Tests for the sequence file format"""
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from defector.framebuffer import FrameRingBuffer
+from defector.sequence import SequenceFile, SequenceWriter, convert_folder, is_sequence_file
+from defector.writer import SequenceFrameWriter
+
+
+def test_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, (5, 6, 8), dtype=np.uint8)
+    path = tmp_path / 'a.dfseq'
+
+    with SequenceWriter(path, (6, 8), pixel_format='BayerRG8', framerate=12.5, capacity=10) as writer:
+        for i, frame in enumerate(frames):
+            writer.append(frame if i != 2 else None, 10 + i, 1000 + i, complete=i != 2)
+
+    assert is_sequence_file(path)
+    sequence = SequenceFile(path)
+    assert len(sequence) == 5
+    assert sequence.framerate == 12.5
+    assert sequence.pixel_format == 'BayerRG8'
+    assert sequence.frame_ids.tolist() == [10, 11, 12, 13, 14]
+    assert sequence.timestamps.tolist() == [1000, 1001, 1002, 1003, 1004]
+    assert sequence.good_frames().tolist() == [0, 1, 3, 4]
+    assert isinstance(sequence.frames, np.memmap)
+    np.testing.assert_array_equal(sequence[4], frames[4])
+    np.testing.assert_array_equal(sequence.image(1), cv.cvtColor(frames[1], cv.COLOR_BAYER_RG2RGB))
+
+
+def test_capacity(tmp_path):
+    with SequenceWriter(tmp_path / 'a.dfseq', (2, 2, 3), capacity=1) as writer:
+        writer.append(np.zeros((2, 2, 3), dtype=np.uint8), 0)
+        with pytest.raises(IndexError):
+            writer.append(np.zeros((2, 2, 3), dtype=np.uint8), 1)
+        with pytest.raises(ValueError):
+            SequenceWriter(tmp_path / 'b.dfseq', (2, )).close()
+
+
+def test_convert_folder(tmp_path):
+    rng = np.random.default_rng(1)
+    frames = {i: rng.integers(0, 256, (4, 5, 3), dtype=np.uint8) for i in (3, 12, 7)}
+    for i, frame in frames.items():
+        cv.imwrite(str(tmp_path / f'VimbaImage_{i}.png'), frame)
+    (tmp_path / 'framerate').write_text('30.0')
+
+    assert convert_folder(tmp_path, tmp_path / 'out.dfseq') == 3
+    sequence = SequenceFile(tmp_path / 'out.dfseq')
+    assert sequence.frame_ids.tolist() == [3, 7, 12]
+    assert sequence.framerate == 30.0
+    for idx, frame_id in enumerate(sequence.frame_ids):
+        np.testing.assert_array_equal(sequence.image(idx), frames[frame_id])
+
+    with pytest.raises(FileExistsError):
+        convert_folder(tmp_path, tmp_path / 'out.dfseq')
+
+
+def test_convert_folder_pixel_formats(tmp_path):
+    rng = np.random.default_rng(2)
+    bgra = rng.integers(0, 256, (4, 5, 4), dtype=np.uint8)
+    bgr = rng.integers(0, 256, (4, 5, 3), dtype=np.uint8)
+    cv.imwrite(str(tmp_path / 'VimbaImage_1.png'), bgra)
+    cv.imwrite(str(tmp_path / 'VimbaImage_2.png'), bgr)
+
+    # The alpha channel is dropped, so the frames match the BGR8 pixel format
+    assert convert_folder(tmp_path, tmp_path / 'out.dfseq') == 2
+    sequence = SequenceFile(tmp_path / 'out.dfseq')
+    assert sequence.pixel_format == 'BGR8'
+    np.testing.assert_array_equal(sequence.image(0), bgra[..., :3])
+    np.testing.assert_array_equal(sequence.image(1), bgr)
+
+    # A grayscale frame doesn't fit a BGR8 sequence, and nothing is left behind
+    cv.imwrite(str(tmp_path / 'VimbaImage_3.png'), bgr[..., 0])
+    with pytest.raises(ValueError):
+        convert_folder(tmp_path, tmp_path / 'out.dfseq', overwrite=True)
+    assert not (tmp_path / 'out.dfseq').exists()
+
+    (tmp_path / 'VimbaImage_3.png').write_bytes(b'not a png')
+    with pytest.raises(IOError):
+        convert_folder(tmp_path, tmp_path / 'out.dfseq')
+
+
+def test_stream_from_ring_buffer(tmp_path):
+    buffer = FrameRingBuffer(2, (3, 4))
+    writer = SequenceFrameWriter(tmp_path / 'a.dfseq', 'Mono8', 20)
+    writer.start(buffer)
+    for i in range(20):
+        while buffer.put(np.full((3, 4), i, dtype=np.uint8), i) is None:
+            pass
+    writer.finish(50)
+
+    sequence = SequenceFile(tmp_path / 'a.dfseq')
+    assert sequence.framerate == 50
+    assert [frame[0, 0] for frame in sequence.frames] == list(range(20))
+    assert sequence.image(0).shape == (3, 4, 3)
@@ -0,0 +1,55 @@
+"""Tests for the spin-settle detection"""
+
+import cv2
+import numpy as np
+
+from defector.settle import SettleDetector
+
+
+def vial_frame(motion, rng):
+    """A rotated bright vial with swirling dark blobs, moving by motion pixels, and noise outside the vial"""
+    frame = rng.integers(0, 30, (480, 800, 3), dtype=np.uint8)
+    box = cv2.boxPoints(((400, 240), (600, 240), 4)).astype(np.int32)
+    cv2.fillPoly(frame, [box], (200, 200, 200))
+    for x in range(200, 620, 60):
+        offset = int(motion * rng.standard_normal())
+        cv2.circle(frame, (x, 240 + offset), 20, (60, 60, 60), -1)
+    return frame
+
+
+def test_settles_when_motion_stops():
+    rng = np.random.default_rng(0)
+    detector = SettleDetector(threshold=1.0, min_time=0.1, max_time=10, settled_frames=3)
+
+    motions = [40] * 10 + [0] * 10
+    settled = [detector.update(vial_frame(motion, rng), time=i * 0.02) for i, motion in enumerate(motions)]
+
+    # The first still frame is compared to a moving one, then 3 still frames are needed
+    assert settled.index(True) == 13
+    assert not detector.timed_out
+    assert min(detector.motion[:9]) > 1.0
+    assert max(detector.motion[10:]) < 1.0
+
+
+def test_min_and_max_time():
+    rng = np.random.default_rng(0)
+    detector = SettleDetector(threshold=1.0, min_time=0.5, max_time=1.0)
+
+    still = [detector.update(vial_frame(0, rng), time=i * 0.1) for i in range(8)]
+    assert still.index(True) == 5
+
+    detector.reset()
+    moving = [detector.update(vial_frame(40, rng), time=i * 0.1) for i in range(12)]
+    assert moving.index(True) == 10
+    assert detector.timed_out
+
+
+def test_mask_ignores_background():
+    rng = np.random.default_rng(0)
+    frame = vial_frame(0, rng)
+    detector = SettleDetector()
+    mask = detector.find_mask(frame)
+
+    assert mask.shape == detector.downscale(frame).shape
+    assert mask[30, 50] == 255
+    assert mask[2, 2] == 0
@@ -0,0 +1,58 @@
+"""Tests for the synthetic vial sequences"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from defector.helpers import RoiTransform
+from defector.pipeline import SequenceTracker, detect, detect_sequence
+from defector.sequence import SequenceFile
+from defector.synthetic import SyntheticVial, match_centroids
+
+
+def test_particles_are_detected_at_their_trajectories():
+    vial = SyntheticVial(640, 360, particles=8, scratches=4, frames=12)
+    roi_transform = RoiTransform.from_frame(vial[0])
+    positions = vial.roi_positions(roi_transform)
+
+    # Particles crossing each other or a scratch merge into one contour, so not every particle is found every frame
+    found = []
+    for idx, frame in enumerate(vial):
+        detections = detect(frame, roi_transform)
+        found.append(cdist(positions[idx], detections.centroids).min(axis=1) <= 2)
+    assert np.mean(found) >= 0.9
+
+
+def test_match_centroids():
+    expected = [[10, 10], [50, 50], [90, 90]]
+    result = match_centroids([[11, 10], [50, 52], [200, 200], [300, 300]], expected, max_distance=2)
+    assert result['recall'] == 2 / 3
+    assert result['precision'] == 0.5
+    assert result['error'] == 1.5
+
+    assert match_centroids([], expected)['recall'] == 0
+    assert match_centroids([], [])['recall'] == 1
+
+
+def test_scratches_are_stationary():
+    vial = SyntheticVial(640, 360, particles=0, scratches=4, frames=15)
+    sequence_tracker = SequenceTracker()
+    roi_transform = RoiTransform.from_frame(vial[0])
+
+    moving = [len(sequence_tracker.update(detect(frame, roi_transform))) for frame in vial]
+    assert moving[-1] == 0
+    assert sequence_tracker.stationary > 0
+
+
+def test_written_sequences_match(tmp_path):
+    vial = SyntheticVial(320, 200, particles=3, frames=4, noise=2)
+    np.testing.assert_array_equal(vial[2], vial.frame(2))
+
+    paths = vial.write_folder(tmp_path)
+    sequence = SequenceFile(vial.write_sequence(tmp_path / 'vial.dfseq'))
+
+    assert len(paths) == len(sequence) == 4
+    np.testing.assert_array_equal(sequence[3], vial[3])
+    from_folder = [d.centroids for d in detect_sequence(paths)]
+    from_frames = [detect(frame, RoiTransform.from_frame(vial[0])).centroids for frame in vial]
+    for a, b in zip(from_folder, from_frames):
+        np.testing.assert_array_equal(a, b)
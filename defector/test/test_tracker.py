@@ -0,0 +1,194 @@
+"""Tests for the object tracker"""
+
+import numpy as np
+from cv2 import contourArea
+from filterpy.kalman import KalmanFilter
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import euclidean
+
+from defector.helpers import contour_features, get_centroid
+from defector.tracker import Tracker
+
+
+def make_contours(count, seed=0):
+    """Create a list of random rectangular contours"""
+    rng = np.random.default_rng(seed)
+    contours = []
+    for x, y, w, h in zip(rng.integers(0, 1000, count), rng.integers(0, 1000, count), rng.integers(1, 20, count), rng.integers(1, 20, count)):
+        contours.append(np.array([[[x, y]], [[x + w, y]], [[x + w, y + h]], [[x, y + h]]], dtype=np.int32))
+    return contours
+
+
+def make_tracker(num_tracks, seed=1):
+    rng = np.random.default_rng(seed)
+    tracker = Tracker(50, 5, 5, 100, 0.5)
+    tracker.add_tracks(rng.normal(500, 300, (num_tracks, 2)), rng.uniform(0, 400, num_tracks))
+    return tracker
+
+
+def reference_cost_matrix(tracker, detections):
+    """The original per-cell implementation of Tracker.get_cost_matrix"""
+    cost_matrix = np.zeros(shape=(len(tracker.tracks), len(detections)))
+    centroids = [get_centroid(c) for c in detections]
+    for i, track in enumerate(tracker.tracks):
+        for j, centroid in enumerate(centroids):
+            distance = euclidean(np.ravel(track.prediction), np.ravel(centroid))
+            size_diff = np.abs(track.previous_size - contourArea(detections[j]))
+            cost_matrix[i][j] = tracker.distance_weight * (0.5) * distance - tracker.size_weight * size_diff
+    return cost_matrix
+
+
+def test_cost_matrix_matches_reference():
+    detections = make_contours(60)
+    tracker = make_tracker(40)
+
+    cost = tracker.get_cost_matrix((40, 60), detections)
+    expected = reference_cost_matrix(tracker, detections)
+
+    np.testing.assert_allclose(cost, expected, rtol=1e-12, atol=1e-9)
+    for a, b in zip(linear_sum_assignment(cost), linear_sum_assignment(expected)):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_cost_matrix_empty():
+    tracker = make_tracker(3)
+    assert tracker.get_cost_matrix((3, 0), []).shape == (3, 0)
+    assert Tracker(50, 5, 5, 100).get_cost_matrix((0, 4), make_contours(4)).shape == (0, 4)
+
+
+def make_filter():
+    kf = KalmanFilter(2, 2)
+    kf.F = np.array([[1, 0.005], [0, 1]])
+    kf.P = np.diag((3.0, 3.0))
+    kf.H = np.array([[1, 0], [0, 1]])
+    return kf
+
+
+class ReferenceTracker:
+    """The original list-of-filterpy-filters tracker, used as a reference"""
+    def __init__(self, dist_thresh, max_frames_to_skip, max_trace_length, size_weight):
+        self.dist_thresh = dist_thresh
+        self.max_frames_to_skip = max_frames_to_skip
+        self.max_trace_length = max_trace_length
+        self.size_weight = size_weight
+        self.tracks = []
+        self.track_id = 0
+
+    def new_track(self, contour):
+        self.tracks.append({'id': self.track_id, 'KF': make_filter(), 'prediction': get_centroid(contour), 'size': contourArea(contour), 'skipped': 0, 'trace': []})
+        self.track_id += 1
+
+    def Update(self, detections):  # noqa: C901
+        if len(self.tracks) == 0:
+            for c in detections:
+                self.new_track(c)
+
+        cost = np.zeros((len(self.tracks), len(detections)))
+        for i, track in enumerate(self.tracks):
+            for j, c in enumerate(detections):
+                distance = euclidean(np.ravel(track['prediction']), np.ravel(get_centroid(c)))
+                cost[i][j] = 0.5 * distance - self.size_weight * np.abs(track['size'] - contourArea(c))
+
+        row_ind, col_ind = linear_sum_assignment(cost)
+        assignment = [-1] * len(self.tracks)
+        for r, c in zip(row_ind, col_ind):
+            assignment[r] = c
+
+        for i in range(len(assignment)):
+            if assignment[i] != -1:
+                if cost[i][assignment[i]] > self.dist_thresh:
+                    assignment[i] = -1
+            else:
+                self.tracks[i]['skipped'] += 1
+
+        for i in reversed(range(len(self.tracks))):
+            if self.tracks[i]['skipped'] > self.max_frames_to_skip:
+                del self.tracks[i]
+                del assignment[i]
+
+        un_assigned_detects = [i for i in range(len(detections)) if i not in assignment]
+
+        for i in range(len(assignment)):
+            track = self.tracks[i]
+            track['KF'].predict()
+            if assignment[i] != -1:
+                track['skipped'] = 0
+                track['KF'].update(get_centroid(detections[assignment[i]]))
+                track['size'] = contourArea(detections[assignment[i]])
+            else:
+                track['KF'].update(None)
+            track['prediction'] = track['KF'].x
+            track['trace'] = (track['trace'] + [track['prediction']])[-(self.max_trace_length + 1):]
+
+        for i in un_assigned_detects:
+            self.new_track(detections[i])
+
+
+def test_batched_filter_matches_filterpy():
+    rng = np.random.default_rng(2)
+    tracker = Tracker(50, 5, 5, 0)
+    table = tracker.table
+    slots = tracker.add_tracks(rng.normal(0, 100, (8, 2)), np.zeros(8))
+    filters = [make_filter() for _ in slots]
+
+    for _ in range(20):
+        measured = rng.random(len(slots)) > 0.3
+        z = rng.normal(0, 100, (len(slots), 2))
+
+        table.predict(slots)
+        table.update(slots[measured], z[measured])
+        for kf, m, measurement in zip(filters, measured, z):
+            kf.predict()
+            kf.update(measurement.reshape(2, 1) if m else None)
+
+        np.testing.assert_allclose(table.x[slots], [kf.x for kf in filters], rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(table.P[slots], [kf.P for kf in filters], rtol=1e-10, atol=1e-10)
+
+
+def test_update_matches_reference():
+    rng = np.random.default_rng(3)
+    tracker = Tracker(50, 5, 5, 0, 0.5)
+    reference = ReferenceTracker(50, 5, 5, 0.5)
+
+    positions = rng.uniform(100, 900, (30, 2))
+    for frame in range(40):
+        positions += rng.normal(0, 3, positions.shape)
+        visible = rng.random(len(positions)) > 0.2
+        detections = [np.array([[[x, y]], [[x + 4, y]], [[x + 4, y + 4]], [[x, y + 4]]], dtype=np.int32) for x, y in positions[visible].astype(int)]
+
+        tracker.Update(detections)
+        reference.Update(detections)
+
+        tracks = tracker.tracks
+        assert [t.track_id for t in tracks] == [t['id'] for t in reference.tracks]
+        for track, expected in zip(tracks, reference.tracks):
+            assert track.skipped_frames == expected['skipped']
+            np.testing.assert_allclose(track.prediction, expected['prediction'], rtol=1e-9)
+            np.testing.assert_allclose(np.reshape(track.trace, (-1, 2)), np.reshape(expected['trace'], (-1, 2)), rtol=1e-9)
+
+
+def test_update_accepts_feature_table():
+    from_contours = make_tracker(0)
+    from_features = make_tracker(0)
+
+    for frame in range(5):
+        contours = make_contours(20, seed=frame % 2)
+        from_contours.Update(contours)
+        from_features.Update(contour_features(contours))
+
+    assert [t.track_id for t in from_features.tracks] == [t.track_id for t in from_contours.tracks]
+    for track, expected in zip(from_features.tracks, from_contours.tracks):
+        np.testing.assert_array_equal(track.prediction, expected.prediction)
+        np.testing.assert_array_equal(np.reshape(track.trace, (-1, 2)), np.reshape(expected.trace, (-1, 2)))
+
+
+def test_removed_tracks_are_reclaimed():
+    tracker = Tracker(50, 1, 5, 0)
+    tracker.table._allocate(4)
+
+    for frame in range(10):
+        tracker.Update(make_contours(3, seed=frame))
+
+    assert len(tracker.table) == len(tracker.tracks)
+    assert len(tracker.table.ids) < 30
+    assert [t.track_id for t in tracker.tracks] == sorted(t.track_id for t in tracker.tracks)
@@ -0,0 +1,52 @@
+"""Tests for the streaming frame writer"""
+
+import json
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from defector.framebuffer import FrameRingBuffer
+from defector.writer import FrameWriter
+
+
+def bayer_to_rgb(raw):
+    return cv.cvtColor(raw, cv.COLOR_BAYER_RG2RGB)
+
+
+@pytest.mark.parametrize('encoding', list(FrameWriter.ENCODINGS))
+def test_writer_streams_all_frames(tmp_path, encoding):
+    rng = np.random.default_rng(0)
+    raw_frames = rng.integers(0, 256, (12, 8, 10), dtype=np.uint8)
+
+    buffer = FrameRingBuffer(3, (8, 10))
+    writer = FrameWriter(tmp_path / 'out', encoding, threads=2, convert=bayer_to_rgb)
+    writer.start(buffer)
+    for i, raw in enumerate(raw_frames):
+        while buffer.put(raw, 100 + i, 10 * i, complete=i != 5) is None:
+            pass
+    writer.finish(30.5)
+
+    index = json.loads((tmp_path / 'out' / 'index.json').read_text())
+    assert index['framerate'] == 30.5
+    assert [frame['frame_id'] for frame in index['frames']] == list(range(100, 112))
+    assert [frame['timestamp'] for frame in index['frames']] == list(range(0, 120, 10))
+    assert index['frames'][5] == {'frame_id': 105, 'timestamp': 50, 'complete': False, 'file': None}
+
+    for i, frame in enumerate(index['frames']):
+        if i == 5:
+            continue
+        path = tmp_path / 'out' / frame['file']
+        np.testing.assert_array_equal(cv.imread(str(path)), bayer_to_rgb(raw_frames[i]))
+
+    assert (tmp_path / 'out' / 'framerate').read_text() == '30.5'
+
+
+def test_writer_refuses_existing_dir(tmp_path):
+    with pytest.raises(FileExistsError):
+        FrameWriter(tmp_path)
+
+
+def test_writer_unknown_encoding(tmp_path):
+    with pytest.raises(ValueError):
+        FrameWriter(tmp_path / 'out', 'jpg')
@@ -14,46 +14,206 @@
 import numpy as np
 
 from scipy.optimize import linear_sum_assignment
-from scipy.spatial.distance import euclidean
-from filterpy.kalman import KalmanFilter
+from scipy.spatial.distance import cdist
 
-from defector.helpers import get_centroid
-from cv2 import contourArea
+from defector.helpers import as_features
 
 
 class Track:
-    """Track class for every object to be tracked
+    """A view of a single track in a TrackTable
     Attributes:
-        None
+        track_id: identification of the track object
+        prediction: predicted centroid (x,y) as a 2x1 array
+        previous_size: the size of the previous contour
+        skipped_frames: number of frames skipped undetected
+        trace: trace path, a list of 2x1 predictions
+        point: the last point associated with the trace, or None
     """
-    def __init__(self, prediction, trackIdCount, contour_size):
-        """Initialize variables used by Track class
+    def __init__(self, table, slot):
+        """Initialize a view of one slot in a TrackTable
         Args:
-            prediction: predicted centroids of object to be tracked
-            trackIdCount: identification of each track object
+            table: the TrackTable holding the track
+            slot: the index of the track in the table
+        Return:
+            None
+        """
+        self.table = table
+        self.slot = slot
+
+    @property
+    def track_id(self):
+        return int(self.table.ids[self.slot])
+
+    @property
+    def prediction(self):
+        return self.table.prediction[self.slot].reshape(-1, 1)
+
+    @property
+    def previous_size(self):
+        return self.table.previous_size[self.slot]
+
+    @property
+    def skipped_frames(self):
+        return int(self.table.skipped_frames[self.slot])
+
+    @property
+    def trace(self):
+        return [point.reshape(-1, 1) for point in self.table.trace[self.slot, :self.table.trace_length[self.slot]]]
+
+    @property
+    def point(self):
+        if not self.table.has_point[self.slot]:
+            return None
+        return self.table.point[self.slot].reshape(-1, 1)
+
+
+class TrackTable:
+    """Contiguous array storage for all tracks, with a batched Kalman filter
+
+    Every track occupies a slot in the arrays. Tracks are added at the end of the
+    table and removed by clearing their slot in the `alive` mask, so the active
+    tracks always keep the order they were created in. Removed slots are reclaimed
+    when the table has to grow.
+
+    Attributes:
+        x: Kalman filter states, (capacity, dim_x, 1)
+        P: Kalman filter covariances, (capacity, dim_x, dim_x)
+        ids: identification of each track
+        skipped_frames: number of frames each track has been skipped undetected
+        alive: mask of the slots holding a track
+    """
+    _fields = ('x', 'P', 'ids', 'skipped_frames', 'alive', 'prediction', 'previous_size', 'point', 'has_point', 'trace', 'trace_length')
+
+    def __init__(self, F, H, P, Q, R, max_trace_length, capacity=64):
+        """Initialize an empty track table
+        Args:
+            F: state transition matrix
+            H: measurement function
+            P: initial covariance matrix of new tracks
+            Q: process noise matrix
+            R: measurement noise matrix
+            max_trace_length: trace path history length
+            capacity: number of slots to preallocate
         Return:
             None
         """
-        self.track_id = trackIdCount  # identification of each track object
-        self.KF = KalmanFilter(2, 2)  # KF instance to track this object
-        self.dt = 0.005
-        self.KF.F = np.array([[1, self.dt], [0, 1]])  # State transition matrix
-        self.KF.P = np.diag((3.0, 3.0))  # covarianse matrix
-        self.KF.H = np.array([[1, 0], [0, 1]])  # matrix in observation equations / measurment function
+        self.F = np.asarray(F, dtype=float)
+        self.H = np.asarray(H, dtype=float)
+        self.P0 = np.asarray(P, dtype=float)
+        self.Q = np.asarray(Q, dtype=float)
+        self.R = np.asarray(R, dtype=float)
+        self.dim_x = self.F.shape[0]
+        self.dim_z = self.H.shape[0]
+        self.max_trace_length = max_trace_length
+
+        self.count = 0  # number of slots in use, including removed tracks
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.x = np.zeros((capacity, self.dim_x, 1))
+        self.P = np.zeros((capacity, self.dim_x, self.dim_x))
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.skipped_frames = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.prediction = np.zeros((capacity, self.dim_z))
+        self.previous_size = np.zeros(capacity)
+        self.point = np.zeros((capacity, self.dim_z), dtype=np.int64)
+        self.has_point = np.zeros(capacity, dtype=bool)
+        self.trace = np.zeros((capacity, self.max_trace_length + 1, self.dim_z))
+        self.trace_length = np.zeros(capacity, dtype=np.int64)
+
+    def _reserve(self, count):
+        """Make room for count more tracks at the end of the table"""
+        if self.count + count <= len(self.ids):
+            return
+
+        active = self.active()
+        arrays = {name: getattr(self, name)[active] for name in self._fields}
+        self._allocate(max(2 * len(active) + count, len(self.ids)))
+        for name, values in arrays.items():
+            getattr(self, name)[:len(active)] = values
+        self.count = len(active)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive[:self.count]))
+
+    def active(self):
+        """Get the slots of all active tracks, in creation order"""
+        return np.flatnonzero(self.alive[:self.count])
+
+    def add(self, ids, centroids, sizes):
+        """Start new tracks
+        Args:
+            ids: identification of each new track
+            centroids: (n, dim_z) array of the initial centroids
+            sizes: the contour size of each new track
+        Return:
+            slots: the slots of the new tracks
+        """
+        count = len(ids)
+        self._reserve(count)
+        slots = np.arange(self.count, self.count + count)
+        self.count += count
+
+        self.x[slots] = 0
+        self.P[slots] = self.P0
+        self.ids[slots] = ids
+        self.skipped_frames[slots] = 0
+        self.alive[slots] = True
+        self.prediction[slots] = centroids
+        self.previous_size[slots] = sizes
+        self.has_point[slots] = False
+        self.trace_length[slots] = 0
+        return slots
 
-        self.prediction = np.asarray(prediction)  # predicted centroids (x,y)
-        self.previous_size = contour_size  # the size of the previous contour
-        self.skipped_frames = 0  # number of frames skipped undetected
-        self.trace = []  # trace path
-        self.point = []  # the last point associated with the trace
+    def remove(self, slots):
+        """Remove tracks by masking their slots"""
+        self.alive[slots] = False
+
+    def predict(self, slots):
+        """Run the Kalman filter predict step for the tracks in slots"""
+        F = self.F
+        self.x[slots] = np.matmul(F, self.x[slots])
+        self.P[slots] = np.matmul(np.matmul(F, self.P[slots]), F.T) + self.Q
+
+    def update(self, slots, measurements):
+        """Run the Kalman filter update step for the tracks in slots
+        Args:
+            slots: the tracks to update
+            measurements: (n, dim_z) array with a measurement for each track
+        Return:
+            None
+        """
+        H, R = self.H, self.R
+        x = self.x[slots]
+        P = self.P[slots]
+        z = np.asarray(measurements, dtype=float).reshape(-1, self.dim_z, 1)
+
+        y = z - np.matmul(H, x)
+        PHT = np.matmul(P, H.T)
+        S = np.matmul(H, PHT) + R
+        K = np.matmul(PHT, np.linalg.inv(S))
+
+        self.x[slots] = x + np.matmul(K, y)
+        I_KH = np.eye(self.dim_x) - np.matmul(K, H)
+        self.P[slots] = np.matmul(np.matmul(I_KH, P), I_KH.transpose(0, 2, 1)) + np.matmul(np.matmul(K, R), K.transpose(0, 2, 1))
+
+    def append_trace(self, slots):
+        """Append the current prediction to the trace of the tracks in slots"""
+        full = slots[self.trace_length[slots] > self.max_trace_length]
+        self.trace[full, :-1] = self.trace[full, 1:]
+        self.trace_length[full] -= 1
+
+        self.trace[slots, self.trace_length[slots]] = self.prediction[slots]
+        self.trace_length[slots] += 1
 
 
 class Tracker:
     """Tracker class that updates track vectors of object tracked
     Attributes:
-        None
+        table: TrackTable with the state of all tracks
     """
-    def __init__(self, dist_thresh, max_frames_to_skip, max_trace_length, trackIdCount, size_weight=0.2, distance_weight=1.0):
+    def __init__(self, dist_thresh, max_frames_to_skip, max_trace_length, trackIdCount, size_weight=0.2, distance_weight=1.0, dt=0.005):
         """Initialize variable used by Tracker class
         Args:
             dist_thresh: distance threshold. When exceeds the threshold,
@@ -62,40 +222,66 @@ class Tracker:
                                 the track object undetected
             max_trace_lenght: trace path history length
             trackIdCount: identification of each track object
+            dt: time step of the state transition matrix
         Return:
             None
         """
         self.dist_thresh = dist_thresh
         self.max_frames_to_skip = max_frames_to_skip
         self.max_trace_length = max_trace_length
-        self.tracks = []
         self.trackIdCount = trackIdCount
         self.size_weight = size_weight
         self.distance_weight = distance_weight
 
-    def get_cost_matrix(self, size, detections):
-        cost_matrix = np.zeros(shape=size)
+        F = np.array([[1, dt], [0, 1]])  # State transition matrix
+        P = np.diag((3.0, 3.0))  # covarianse matrix
+        H = np.array([[1, 0], [0, 1]])  # matrix in observation equations / measurment function
+        self.table = TrackTable(F, H, P, np.eye(2), np.eye(2), max_trace_length)
+
+    @property
+    def tracks(self):
+        """Views of all active tracks, in creation order"""
+        return [Track(self.table, slot) for slot in self.table.active()]
+
+    def add_tracks(self, centroids, sizes):
+        """Start a new track for every centroid"""
+        ids = np.arange(self.trackIdCount, self.trackIdCount + len(sizes))
+        self.trackIdCount += len(sizes)
+        return self.table.add(ids, centroids, sizes)
 
-        centroids = [get_centroid(c) for c in detections]
+    def get_cost_matrix(self, size, detections, slots=None):
+        """Calculate the cost of assigning every detection to every track
 
-        for i in range(len(self.tracks)):
-            for j in range(len(centroids)):
-                try:
-                    distance = euclidean(self.tracks[i].prediction, centroids[j])
-                    size_diff = np.abs(self.tracks[i].previous_size - contourArea(detections[j]))
+        The matrix is built in one batched step from the track predictions and
+        previous sizes, and the centroid and area of every detection.
 
-                    # Let's average the squared ERROR
-                    distance_cost = (0.5) * distance
+        Args:
+            size: The (N, M) shape of the cost matrix
+            detections: The CONTOUR_FEATURES table of the M detections, or a list of contours
+            slots: The N tracks to calculate the cost for.
+                Default all active tracks
+        Return:
+            cost_matrix: N x M matrix of assignment costs
+        """
+        if 0 in size:
+            return np.zeros(shape=size)
 
-                    cost = self.distance_weight * distance_cost - self.size_weight * size_diff
+        if slots is None:
+            slots = self.table.active()
 
-                    cost_matrix[i][j] = cost
-                except NotADirectoryError:  # placed here to see what error the above try is trying to catch
-                    pass
+        centroids, areas = get_centroids_and_areas(detections)
+
+        distance = cdist(self.table.prediction[slots], centroids, 'euclidean')
+        size_diff = np.abs(self.table.previous_size[slots][:, np.newaxis] - areas[np.newaxis, :])
+
+        # Let's average the squared ERROR
+        distance_cost = (0.5) * distance
+
+        cost_matrix = self.distance_weight * distance_cost - self.size_weight * size_diff
 
         return cost_matrix
 
-    def Update(self, detections):  # noqa: C901
+    def Update(self, detections):
         """Update tracks vector using following steps:
             - Create tracks if no tracks vector found
             - Calculate cost using sum of square distance
@@ -105,92 +291,82 @@ class Tracker:
               https://en.wikipedia.org/wiki/Hungarian_algorithm
             - Identify tracks with no assignment, if any
             - If tracks are not detected for long time, remove them
+            - Update KalmanFilter state, lastResults and tracks trace
             - Now look for un_assigned detects
             - Start new tracks
-            - Update KalmanFilter state, lastResults and tracks trace
         Args:
-            detections: detected contours of object to be tracked
+            detections: CONTOUR_FEATURES table, or list of contours, of the objects to be tracked
         Return:
             None
         """
 
+        table = self.table
+        detections = as_features(detections)
+        centroids, areas = get_centroids_and_areas(detections)
+
         # Create tracks if no tracks vector found
-        if (len(self.tracks) == 0):
-            for i in range(len(detections)):
-                track = Track(get_centroid(detections[i]), self.trackIdCount, contourArea(detections[i]))
-                self.trackIdCount += 1
-                self.tracks.append(track)
+        if len(table) == 0:
+            self.add_tracks(centroids, areas)
 
         # Calculate cost using sum of square distance between
         # predicted vs detected centroids
-        N = len(self.tracks)
+        slots = table.active()
+        N = len(slots)
         M = len(detections)
-        cost = self.get_cost_matrix((N, M), detections)
+        cost = self.get_cost_matrix((N, M), detections, slots)
 
         # Using Hungarian Algorithm assign the correct detected measurements
         # to predicted tracks
         row_ind, col_ind = linear_sum_assignment(cost)
 
-        assignment = [-1 for _ in range(N)]
-        for i in range(len(row_ind)):
-            assignment[row_ind[i]] = col_ind[i]
-
-        # Identify tracks with no assignment, if any
-        un_assigned_tracks = []
-        for i in range(len(assignment)):
-            if (assignment[i] != -1):
-                # check for cost distance threshold.
-                # If cost is very high then un_assign (delete) the track
-                if (cost[i][assignment[i]] > self.dist_thresh):
-                    assignment[i] = -1
-                    un_assigned_tracks.append(i)
-            else:
-                self.tracks[i].skipped_frames += 1
+        assignment = np.full(N, -1)
+        assignment[row_ind] = col_ind
+
+        # Tracks with no assignment skip a frame
+        table.skipped_frames[slots[assignment == -1]] += 1
+
+        # check for cost distance threshold.
+        # If cost is very high then un_assign the track
+        assigned = assignment != -1
+        too_far = np.zeros(N, dtype=bool)
+        too_far[assigned] = cost[assigned, assignment[assigned]] > self.dist_thresh
+        assignment[too_far] = -1
 
         # If tracks are not detected for long time, remove them
-        del_tracks = []
-        for i in range(len(self.tracks)):
-            if (self.tracks[i].skipped_frames > self.max_frames_to_skip):
-                del_tracks.append(i)
-        if len(del_tracks) > 0:  # only when skipped frame exceeds max
-            for id in del_tracks:
-                if id < len(self.tracks):
-                    del self.tracks[id]
-                    del assignment[id]
-                else:
-                    print("ERROR: id is greater than length of tracks")
-
-        # Now look for un_assigned detects
-        un_assigned_detects = []
-        for i in range(len(detections)):
-            if i not in assignment:
-                un_assigned_detects.append(i)
-
-        # Start new tracks
-        if (len(un_assigned_detects) != 0):
-            for i in range(len(un_assigned_detects)):
-                track = Track(get_centroid(detections[un_assigned_detects[i]]), self.trackIdCount, contourArea(detections[un_assigned_detects[i]]))
-                self.trackIdCount += 1
-                self.tracks.append(track)
+        removed = table.skipped_frames[slots] > self.max_frames_to_skip
+        table.remove(slots[removed])
+        slots = slots[~removed]
+        assignment = assignment[~removed]
 
         # Update KalmanFilter state, lastResults and tracks trace
-        for i in range(len(assignment)):
-            self.tracks[i].KF.predict()
-
-            if (assignment[i] != -1):
-                self.tracks[i].skipped_frames = 0
-                self.tracks[i].KF.update(get_centroid(detections[assignment[i]]))
-                self.tracks[i].prediction = self.tracks[i].KF.x
-                self.tracks[i].previous_size = contourArea(detections[assignment[i]])
-                self.tracks[i].point = get_centroid(detections[assignment[i]])
-            else:
-                self.tracks[i].KF.update(None)
-                self.tracks[i].prediction = self.tracks[i].KF.x
-                self.tracks[i].point = None
-
-            if (len(self.tracks[i].trace) > self.max_trace_length):
-                for j in range(len(self.tracks[i].trace) - self.max_trace_length):
-                    del self.tracks[i].trace[j]
-
-            self.tracks[i].trace.append(self.tracks[i].prediction)
-            # self.tracks[i].KF.lastResult = self.tracks[i].prediction
+        table.predict(slots)
+
+        assigned = assignment != -1
+        updated = slots[assigned]
+        detected = assignment[assigned]
+        table.update(updated, centroids[detected])
+        table.skipped_frames[updated] = 0
+        table.previous_size[updated] = areas[detected]
+        table.point[updated] = centroids[detected]
+        table.has_point[slots] = assigned
+
+        table.prediction[slots] = table.x[slots, :, 0]
+        table.append_trace(slots)
+
+        # Start new tracks for un_assigned detects. This is done last, as adding
+        # tracks can compact the table and move the slots of existing tracks
+        un_assigned_detects = np.setdiff1d(np.arange(M), assignment)
+        if len(un_assigned_detects) != 0:
+            self.add_tracks(centroids[un_assigned_detects], areas[un_assigned_detects])
+
+
+def get_centroids_and_areas(detections):
+    """Get the centroid and area of every detection
+    Args:
+        detections: CONTOUR_FEATURES table or list of contours
+    Return:
+        centroids: (M, 2) array of centroids
+        areas: (M,) array of contour areas
+    """
+    features = as_features(detections)
+    return features['centroid'], features['area']
@@ -0,0 +1,212 @@
+"""Writes captured frames to disk while the capture is still running
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+from shutil import rmtree
+
+import cv2 as cv
+
+from defector.sequence import SequenceWriter
+
+
+def make_output_dir(dir, overwrite=False):
+    """Create an empty output directory
+
+    Args:
+        dir:        The directory to create.
+        overwrite:  If the folder should be removed if it exists. Default: False
+
+    Returns:
+        out_dir (Path): The created directory
+    """
+    out_dir = Path(dir)
+    if out_dir.is_dir():
+        if not overwrite:
+            raise FileExistsError(f"{dir} already exists, and overwrite=False")
+
+        rmtree(out_dir)
+        while out_dir.is_dir():
+            pass
+
+    os.makedirs(out_dir)
+    return out_dir
+
+
+class FrameWriter:
+    """Drains frames from a FrameRingBuffer to image files on background threads
+
+    Every complete frame is written as VimbaImage_<frame ID>.<ext>. When the writer is
+    finished, the frame IDs, timestamps, completeness, file names and the framerate of
+    all frames are written to index.json, and the framerate to the framerate file.
+
+    Encodings:
+        png:    PNG with the given compression level (0-9, 0 is fastest)
+        tiff:   Lossless LZW compressed TIFF
+        bmp:    Uncompressed BMP, the fastest to write
+
+    To keep the raw sensor data without colour conversion, use SequenceFrameWriter.
+    """
+
+    ENCODINGS = {
+        'png': '.png',
+        'tiff': '.tiff',
+        'bmp': '.bmp',
+    }
+
+    def __init__(self, dir, encoding='png', png_compression=3, threads=2, convert=None, overwrite=False):
+        """
+        Args:
+            dir: The directory to save the images in
+            encoding: The file encoding, one of ENCODINGS
+            png_compression: The PNG compression level
+            threads: The number of writer threads
+            convert: Function converting raw frames to the image to save
+            overwrite: If the folder should be removed if it exists
+        """
+        if encoding not in self.ENCODINGS:
+            raise ValueError(f"{encoding} is not a valid encoding. Use one of {', '.join(self.ENCODINGS)}")
+
+        self.out_dir = make_output_dir(dir, overwrite)
+        self.encoding = encoding
+        self.params = [cv.IMWRITE_PNG_COMPRESSION, png_compression] if encoding == 'png' else []
+        self.threads = threads
+        self.convert = convert
+
+        self.buffer = None
+        self.index = []
+        self._index_lock = threading.Lock()
+        self._threads = []
+
+    def start(self, buffer):
+        """Start writing the frames of a buffer
+
+        Args:
+            buffer: The FrameRingBuffer to consume
+        """
+        self.buffer = buffer
+        self._threads = [threading.Thread(target=self._run, name=f'FrameWriter-{i}', daemon=True) for i in range(self.threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            seq = self.buffer.get()
+            if seq is None:
+                return
+
+            try:
+                self._write(seq)
+            finally:
+                self.buffer.release(seq)
+
+    def _write(self, seq):
+        slot = self.buffer.slot(seq)
+        frame_id = int(self.buffer.frame_ids[slot])
+        entry = {
+            'seq': seq,
+            'frame_id': frame_id,
+            'timestamp': int(self.buffer.timestamps[slot]),
+            'complete': bool(self.buffer.complete[slot]),
+            'file': None,
+        }
+
+        if entry['complete']:
+            path = self.out_dir.joinpath(f'VimbaImage_{frame_id}{self.ENCODINGS[self.encoding]}')
+            self.write_frame(path, self.buffer.frame(seq))
+            entry['file'] = path.name
+
+        with self._index_lock:
+            self.index.append(entry)
+
+    def write_frame(self, path, raw):
+        """Encode and write a single raw frame"""
+        image = self.convert(raw) if self.convert is not None else raw
+        if not cv.imwrite(str(path), image, self.params):
+            raise IOError(f"Could not write {path}")
+
+    def finish(self, framerate=0):
+        """Write the remaining frames and the index, and stop the writer threads
+
+        Args:
+            framerate: The measured framerate of the capture
+        """
+        if self.buffer is not None:
+            self.buffer.close()
+        for thread in self._threads:
+            thread.join()
+
+        self.index.sort(key=lambda entry: entry['seq'])
+        for entry in self.index:
+            del entry['seq']
+        with open(self.out_dir.joinpath('index.json'), 'w') as index_file:
+            json.dump({'framerate': framerate, 'encoding': self.encoding, 'frames': self.index}, index_file, indent=1)
+
+        with open(self.out_dir.joinpath('framerate'), 'w') as framerate_file:
+            framerate_file.write(str(framerate))
+
+        written = sum(entry['file'] is not None for entry in self.index)
+        print(f"Wrote {written}/{len(self.index)} frames to {self.out_dir.as_posix()}")
+
+
+class SequenceFrameWriter:
+    """Drains the raw frames from a FrameRingBuffer into a sequence file on a background thread
+
+    The frames are stored without conversion in a single file, see defector.sequence.
+    """
+
+    def __init__(self, path, pixel_format, capacity, overwrite=False):
+        """
+        Args:
+            path: The sequence file to write
+            pixel_format: The pixel format of the raw frames
+            capacity: The max number of frames to store
+            overwrite: If the file should be replaced if it exists
+        """
+        self.path = Path(path)
+        if self.path.exists() and not overwrite:
+            raise FileExistsError(f"{path} already exists, and overwrite=False")
+
+        self.pixel_format = pixel_format
+        self.capacity = capacity
+        self.buffer = None
+        self.writer = None
+        self._thread = None
+
+    def start(self, buffer):
+        """Start writing the frames of a buffer
+
+        Args:
+            buffer: The FrameRingBuffer to consume
+        """
+        self.buffer = buffer
+        self.writer = SequenceWriter(self.path, buffer.shape, buffer.frames.dtype, self.pixel_format, capacity=self.capacity)
+        self._thread = threading.Thread(target=self._run, name='SequenceFrameWriter', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            seq = self.buffer.get()
+            if seq is None:
+                return
+
+            try:
+                slot = self.buffer.slot(seq)
+                if self.writer.count < self.capacity:
+                    self.writer.append(self.buffer.frame(seq), self.buffer.frame_ids[slot], self.buffer.timestamps[slot], self.buffer.complete[slot])
+            finally:
+                self.buffer.release(seq)
+
+    def finish(self, framerate=0):
+        """Write the remaining frames, the frame table and the framerate
+
+        Args:
+            framerate: The measured framerate of the capture
+        """
+        if self.buffer is not None:
+            self.buffer.close()
+            self._thread.join()
+            self.writer.close(framerate)
+            print(f"Wrote {self.writer.count} frames to {self.path.as_posix()}")
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+"""Benchmarks the per-frame cost of Tracker.get_cost_matrix against the original per-cell loop
+"""
+
+import sys
+from pathlib import Path
+from timeit import repeat
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from defector.test.test_tracker import make_contours, make_tracker, reference_cost_matrix  # noqa: E402
+
+
+def benchmark(size, number):
+    detections = make_contours(size)
+    tracker = make_tracker(size)
+
+    vectorized = min(repeat(lambda: tracker.get_cost_matrix((size, size), detections), number=number, repeat=3)) / number
+    loop = min(repeat(lambda: reference_cost_matrix(tracker, detections), number=1, repeat=1))
+
+    return vectorized, loop
+
+
+if __name__ == '__main__':
+    print(f"{'N = M':>8} {'vectorized [ms]':>16} {'loop [ms]':>12} {'speedup':>8}")
+    for size, number in ((10, 1000), (100, 20), (1000, 2)):
+        vectorized, loop = benchmark(size, number)
+        print(f"{size:>8} {vectorized * 1000:>16.3f} {loop * 1000:>12.1f} {loop / vectorized:>7.0f}x")
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""Benchmarks the command latency and throughput of JigController against opening the port per command,
+using the firmware emulator
+"""
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import serial
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from defector.communication import JigController, make_packet  # noqa: E402
+from defector.emulator import JigEmulator  # noqa: E402
+
+
+def reopen_per_command(port, speed):
+    """The original set_speed, opening and closing the port for every command"""
+    ser = serial.Serial()
+    ser.baudrate = 115200
+    ser.port = port
+    ser.timeout = 0.1
+    ser.dtr = None
+
+    with ser as com:
+        com.write(make_packet(speed, 5000))
+        return com.read(1) == b'A'
+
+
+def benchmark(reply_delay, count):
+    with JigEmulator(reply_delay) as emulator:
+        start = perf_counter()
+        for i in range(count):
+            reopen_per_command(emulator.port, i % 20)
+        reopen = (perf_counter() - start) / count
+
+        with JigController(emulator.port) as jig:
+            start = perf_counter()
+            for i in range(count):
+                jig.set_speed(i % 20, 5000)
+            latency = (perf_counter() - start) / count
+
+            start = perf_counter()
+            futures = [jig.send(i % 20, 5000) for i in range(count)]
+            assert all(future.result() for future in futures)
+            throughput = count / (perf_counter() - start)
+
+    return reopen, latency, throughput
+
+
+if __name__ == '__main__':
+    print(f"{'reply delay [ms]':>16} {'reopen [ms]':>12} {'persistent [ms]':>16} {'queued [cmd/s]':>15}")
+    for reply_delay in (0, 0.001):
+        reopen, latency, throughput = benchmark(reply_delay, 200)
+        print(f"{reply_delay * 1000:>16.0f} {reopen * 1000:>12.3f} {latency * 1000:>16.3f} {throughput:>15.0f}")